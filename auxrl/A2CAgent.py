@@ -32,6 +32,8 @@ class Agent(acme.Actor):
 
         self._env_spec = env_spec
         self._loss_weights = loss_weights
+        # Auxiliary losses with zero weight are pruned from the update graph
+        self._live_losses = [weight != 0 for weight in loss_weights[:3]]
         self._n_actions = env_spec.actions.num_values
         self._network = network
         self._lr = lr
@@ -54,7 +56,7 @@ class Agent(acme.Actor):
     def select_action(
         self, obs, force_greedy=False, verbose=False, return_latent=False
         ):
-        """ action selection. """
+        """ action selection; the action is a plain int. """
 
         with torch.no_grad():
             z = self._network.encoder(
@@ -62,7 +64,7 @@ class Agent(acme.Actor):
             policy_dist, _ = self._network.A2C(z)
         if force_greedy:
             if verbose: print(policy_dist)
-            action = policy_dist.argmax(axis=-1) # TODO: doublecheck
+            action = int(policy_dist.argmax(axis=-1)) # TODO: doublecheck
         else:
             action = policy_dist.multinomial(num_samples=1).item()
         if return_latent:
@@ -87,7 +89,7 @@ class Agent(acme.Actor):
 
         # Set up optimizer
         device = self._device
-        self._optimizer.zero_grad()
+        self._optimizer.zero_grad(set_to_none=False) # Flat grad buffer
 
         # A2C loss
         Qvals = np.zeros_like(values)
@@ -110,39 +112,54 @@ class Agent(acme.Actor):
         a2c_loss = actor_loss + critic_loss - 0.00001 * entropies
 
         # Positive sample loss
-        onehot_actions = np.zeros((n_steps, self._n_actions))
-        onehot_actions[np.arange(n_steps), actions] = 1
-        onehot_actions = torch.as_tensor(onehot_actions, device=self._device).float()
-        next_obs = torch.tensor(np.array(next_obs), device=self._device)
-        obs = torch.tensor(np.array(obs), device=self._device)
-        next_z = self._network.encoder(next_obs)
-        z = self._network.encoder(obs)
-        z_and_action = torch.cat([z, onehot_actions], dim=1)
-        Tz = self._network.T(z_and_action)
-        T_target = next_z
-        loss_pos_sample = torch.nn.functional.mse_loss(
-            Tz, T_target, reduction='none')
-        loss_pos_sample = torch.mean(loss_pos_sample)
+        loss_pos_sample = torch.zeros((), device=self._device)
+        loss_neg_random = torch.zeros((), device=self._device)
+        loss_neg_neighbor = torch.zeros((), device=self._device)
+        if any(self._live_losses):
+            next_obs = torch.tensor(np.array(next_obs), device=self._device)
+            obs = torch.tensor(np.array(obs), device=self._device)
+            next_z = self._network.encoder(next_obs)
+            z = self._network.encoder(obs)
+        if self._live_losses[0]:
+            onehot_actions = np.zeros((n_steps, self._n_actions))
+            onehot_actions[np.arange(n_steps), actions] = 1
+            onehot_actions = torch.as_tensor(
+                onehot_actions, device=self._device).float()
+            z_and_action = torch.cat([z, onehot_actions], dim=1)
+            Tz = self._network.T(z_and_action)
+            T_target = next_z
+            loss_pos_sample = torch.nn.functional.mse_loss(
+                Tz, T_target, reduction='none')
+            loss_pos_sample = torch.mean(loss_pos_sample)
 
         # Negative Sample Loss
-        rolled = torch.roll(z, 1, dims=0)
-        loss_neg_random = torch.mean(torch.exp(-5*torch.norm(z - rolled, dim=1)))
-        loss_neg_neighbor = torch.mean(torch.exp(-5*torch.norm(z - next_z, dim=1)))
-
-        # Aggregate all losses and update parameters
-        all_losses = self._loss_weights[0] * loss_pos_sample \
-            + self._loss_weights[1] * loss_neg_neighbor \
-            + self._loss_weights[2] * loss_neg_random \
-            + self._loss_weights[3] * a2c_loss
+        if self._live_losses[2]:
+            rolled = torch.roll(z, 1, dims=0)
+            loss_neg_random = torch.mean(
+                torch.exp(-5*torch.norm(z - rolled, dim=1)))
+        if self._live_losses[1]:
+            loss_neg_neighbor = torch.mean(
+                torch.exp(-5*torch.norm(z - next_z, dim=1)))
+
+        # Aggregate all live losses and update parameters
+        aux_losses = [loss_pos_sample, loss_neg_neighbor, loss_neg_random]
+        all_losses = 0
+        for weight, loss, live in zip(
+            self._loss_weights, aux_losses, self._live_losses):
+            if live:
+                all_losses = all_losses + weight * loss
+        all_losses = all_losses + self._loss_weights[3] * a2c_loss
+        self._network.check_flat_grad()
         all_losses.backward()
         self._optimizer.step()
         self._n_updates += 1
 
+        loss_terms = torch.stack([
+            loss_pos_sample, loss_neg_neighbor, loss_neg_random, a2c_loss,
+            all_losses]).detach().tolist() # One device read
         return [
-            self._loss_weights[0]*loss_pos_sample.item(),
-            self._loss_weights[1]*loss_neg_neighbor.item(),
-            self._loss_weights[2]*loss_neg_random.item(),
-            self._loss_weights[3]*a2c_loss.item(), all_losses.item()]
+            weight*loss for weight, loss in
+            zip(self._loss_weights, loss_terms[:4])] + loss_terms[4:]
 
     def save_network(self, path, episode=None):
         network_params = self._network.get_params()
@@ -167,3 +184,8 @@ class Agent(acme.Actor):
         self, action: int, next_timestep: dm_env.TimeStep,
         latent: torch.tensor):
         return
+
+    def observe_fast(
+        self, action: int, obs: np.ndarray, reward: float, discount: float,
+        last: bool, latent: torch.tensor):
+        return
@@ -0,0 +1,214 @@
+import numpy as np
+import torch
+import torch.nn as nn
+
+class NumpyActingEngine(object):
+    """
+    Batch-1 forward of a network's encoder and Q in NumPy, for acting without
+    going through the torch dispatcher. Layer weights are views into a host
+    copy of the network's flat parameter arena, so refresh snapshots every
+    weight with one copy, and every intermediate result lives in a buffer
+    allocated once. The snapshot only changes on refresh; N_UPDATES records
+    the update count it was taken at, for callers that bound its staleness.
+
+    Covers the layers of the network YAMLs: Conv2d, MaxPool2d, Linear, ReLU
+    and Identity. Encoders with memory are not supported.
+    """
+
+    def __init__(self, network):
+        encoder = network.encoder
+        if encoder._mem_len > 0:
+            raise ValueError('NumPy acting does not support memory.')
+        self._network = network
+        self._plan = []
+        self._params = [] # Torch parameters bound to each weight slot
+        self._input = np.zeros(encoder._input_shape, dtype=np.float32)
+        x = self._input
+        if encoder._convs is not None:
+            for layer in self._layers(encoder._convs):
+                x = self._add_layer(layer, x)
+        x = x.reshape(-1)
+        for layer in self._layers(encoder._fc):
+            x = self._add_layer(layer, x)
+        self._z = x
+        for layer in self._layers(network.Q._fc):
+            x = self._add_layer(layer, x)
+        self._q = x
+        self._flat_ptr = None
+        self.n_updates = None
+
+    @staticmethod
+    def _layers(module):
+        if not isinstance(module, nn.Sequential):
+            raise ValueError(f'NumPy acting does not support {module}.')
+        return list(module)
+
+    def _add_layer(self, layer, x):
+        """ Appends LAYER to the plan; returns its output buffer. """
+
+        if isinstance(layer, nn.Identity):
+            return x
+        if isinstance(layer, nn.ReLU):
+            y = np.zeros_like(x)
+            self._plan.append(['relu', x, y])
+            return y
+        if isinstance(layer, nn.Linear):
+            if x.ndim != 1:
+                raise ValueError('Linear layers need flat inputs.')
+            y = np.zeros(layer.out_features, dtype=np.float32)
+            self._plan.append(['linear', x, y, None, None])
+            self._bind_later(layer, len(self._plan) - 1)
+            return y
+        if isinstance(layer, nn.Conv2d):
+            return self._add_conv(layer, x)
+        if isinstance(layer, nn.MaxPool2d):
+            return self._add_maxpool(layer, x)
+        raise ValueError(f'NumPy acting does not support {layer}.')
+
+    def _bind_later(self, layer, step):
+        self._params.append((layer.weight, step, 3))
+        if layer.bias is not None:
+            self._params.append((layer.bias, step, 4))
+
+    def _add_conv(self, conv, x):
+        if (conv.groups != 1) or (tuple(conv.dilation) != (1, 1)) \
+            or isinstance(conv.padding, str) or (conv.padding_mode != 'zeros'):
+            raise ValueError(f'NumPy acting does not support {conv}.')
+        (kh, kw), (sh, sw), (ph, pw) = conv.kernel_size, conv.stride, conv.padding
+        if ph or pw: # Zero borders stay, the interior is copied in each step
+            padded = np.zeros(
+                (x.shape[0], x.shape[1] + 2*ph, x.shape[2] + 2*pw),
+                dtype=np.float32)
+            self._plan.append([
+                'copy', x, padded[:, ph:ph + x.shape[1], pw:pw + x.shape[2]]])
+            x = padded
+        C, H, W = x.shape
+        Ho, Wo = (H - kh)//sh + 1, (W - kw)//sw + 1
+        # im2col: row (c, i, j) holds input (c, oh*sh + i, ow*sw + j)
+        c, i, j = np.meshgrid(
+            np.arange(C), np.arange(kh), np.arange(kw), indexing='ij')
+        oh, ow = np.meshgrid(np.arange(Ho), np.arange(Wo), indexing='ij')
+        idx = (c.reshape(-1, 1)*H*W
+            + (oh.reshape(1, -1)*sh + i.reshape(-1, 1))*W
+            + ow.reshape(1, -1)*sw + j.reshape(-1, 1))
+        cols = np.zeros(idx.shape, dtype=np.float32)
+        y = np.zeros((conv.out_channels, Ho, Wo), dtype=np.float32)
+        self._plan.append([
+            'conv', x.reshape(-1), y.reshape(conv.out_channels, -1), None,
+            None, idx, cols])
+        self._bind_later(conv, len(self._plan) - 1)
+        return y
+
+    def _add_maxpool(self, pool, x):
+        kh, kw = self._pair(pool.kernel_size)
+        sh, sw = self._pair(
+            pool.kernel_size if pool.stride is None else pool.stride)
+        if self._pair(pool.padding) != (0, 0) \
+            or self._pair(pool.dilation) != (1, 1) or pool.ceil_mode:
+            raise ValueError(f'NumPy acting does not support {pool}.')
+        C, H, W = x.shape
+        Ho, Wo = (H - kh)//sh + 1, (W - kw)//sw + 1
+        # Window offset k of every output, (k, C, Ho*Wo), so the max is taken
+        # with elementwise maxima rather than a reduction over a short axis
+        i, j = np.meshgrid(np.arange(kh), np.arange(kw), indexing='ij')
+        c = np.arange(C).reshape(1, -1, 1)
+        oh, ow = np.meshgrid(np.arange(Ho), np.arange(Wo), indexing='ij')
+        idx = (c*H*W
+            + (oh.reshape(1, 1, -1)*sh + i.reshape(-1, 1, 1))*W
+            + ow.reshape(1, 1, -1)*sw + j.reshape(-1, 1, 1))
+        windows = np.zeros(idx.shape, dtype=np.float32)
+        y = np.zeros((C, Ho, Wo), dtype=np.float32)
+        self._plan.append(
+            ['maxpool', x.reshape(-1), y.reshape(C, -1), idx, windows,
+            list(windows)])
+        return y
+
+    @staticmethod
+    def _pair(value):
+        return tuple(value) if isinstance(value, (tuple, list)) \
+            else (value, value)
+
+    def _bind(self, flat):
+        """ Points every weight slot at its place in the host arena copy. """
+
+        self._host = torch.empty(flat.numel(), dtype=torch.float32)
+        host = self._host.numpy()
+        for param, step, slot in self._params:
+            offset = (param.data_ptr() - flat.data_ptr()) // flat.element_size()
+            if not (0 <= offset <= flat.numel() - param.numel()):
+                raise ValueError('Parameters are not in the flat arena.')
+            values = host[offset:offset + param.numel()]
+            if slot == 3: # (out, in) weights, conv kernels flattened per filter
+                values = values.reshape(param.shape[0], -1)
+            elif self._plan[step][0] == 'conv': # Bias broadcast over positions
+                values = values.reshape(-1, 1)
+            self._plan[step][slot] = values
+        self._flat_ptr = flat.data_ptr()
+
+    def refresh(self, n_updates: int=None):
+        """ Snapshots the network's current weights. """
+
+        flat = self._network.get_flat_params()
+        if flat.data_ptr() != self._flat_ptr: # Arena was rebuilt
+            self._bind(flat)
+        with torch.no_grad():
+            self._host.copy_(flat)
+        self.n_updates = n_updates
+
+    def forward(self, obs):
+        """
+        Latent and Q-values of the single observation OBS. Both are views of
+        internal buffers, overwritten by the next call.
+        """
+
+        if self._flat_ptr is None:
+            raise ValueError('Refresh the engine before acting.')
+        np.copyto(self._input, obs, casting='unsafe')
+        for step in self._plan:
+            kind = step[0]
+            if kind == 'linear':
+                _, x, y, weight, bias = step
+                np.dot(weight, x, out=y)
+                if bias is not None:
+                    y += bias
+            elif kind == 'relu':
+                np.maximum(step[1], 0, out=step[2])
+            elif kind == 'conv':
+                _, x, y, weight, bias, idx, cols = step
+                np.take(x, idx, out=cols)
+                np.dot(weight, cols, out=y)
+                if bias is not None:
+                    y += bias
+            elif kind == 'maxpool':
+                _, x, y, idx, windows, window_views = step
+                np.take(x, idx, out=windows)
+                if len(window_views) == 1: # 1x1 windows only subsample
+                    np.copyto(y, window_views[0])
+                    continue
+                np.maximum(window_views[0], window_views[1], out=y)
+                for window in window_views[2:]:
+                    np.maximum(y, window, out=y)
+            else: # copy
+                np.copyto(step[2], step[1])
+        return self._z, self._q
+
+    def max_abs_error(self, observations) -> float:
+        """
+        Largest absolute difference between this engine's latents and
+        Q-values and those of the network's torch forward, over the batch of
+        OBSERVATIONS. Compares against the current weights, so refresh first.
+        """
+
+        observations = np.asarray(observations, dtype=np.float32)
+        device = self._network._device
+        with torch.no_grad():
+            z = self._network.encoder(torch.as_tensor(observations).to(device))
+            q = self._network.Q(z)
+        z, q = z.cpu().numpy(), q.cpu().numpy()
+        error = 0.
+        for obs, obs_z, obs_q in zip(observations, z, q):
+            engine_z, engine_q = self.forward(obs)
+            error = max(
+                error, np.abs(engine_z - obs_z).max(),
+                np.abs(engine_q - obs_q).max())
+        return float(error)
@@ -0,0 +1,267 @@
+import time
+import queue
+import torch
+import multiprocessing
+import multiprocessing.sharedctypes
+
+import numpy as np
+from acme import specs
+
+from auxrl.ReplayBuffer import SharedReplayMemory, make_replay_buffer
+from auxrl.ActingEngine import NumpyActingEngine
+from auxrl.environments.FastStepEnv import FastStepEnv
+
+class SharedWeights(object):
+    """
+    Flat copy of a network's parameters in shared memory.
+    The learner publishes into it and actors pull from it. A version counter
+    works as a seqlock: it is odd while the learner is writing, and readers
+    discard a copy if the version changed under them, so the learner never
+    waits on actors. The counter is a multiprocessing.Value, whose lock is
+    taken on every access; that orders the accesses against the copies on
+    any CPU, not only under x86's store ordering, and is held only around
+    the counter itself.
+    """
+
+    def __init__(self, network, ctx=multiprocessing):
+        """ CTX is the multiprocessing context the actors are started in. """
+
+        n_values = sum(t.numel() for t in self._tensors(network))
+        self._raw = multiprocessing.sharedctypes.RawArray('f', n_values)
+        self._version = ctx.Value('q', 0)
+        self._pulled_version = 0
+
+    @staticmethod
+    def _tensors(network):
+        return [network.get_flat_params()]
+
+    def publish(self, network):
+        flat = torch.from_numpy(np.frombuffer(self._raw, dtype=np.float32))
+        with torch.no_grad():
+            values = torch.cat(
+                [t.reshape(-1) for t in self._tensors(network)]).cpu()
+        self._version.value += 1
+        flat.copy_(values)
+        self._version.value += 1
+
+    def pull(self, network) -> bool:
+        """ Copies newly published weights into NETWORK, if there are any. """
+
+        start_version = self._version.value
+        if (start_version == self._pulled_version) or (start_version % 2):
+            return False
+        values = np.frombuffer(self._raw, dtype=np.float32).copy()
+        if self._version.value != start_version:
+            return False
+        values = torch.from_numpy(values)
+        offset = 0
+        with torch.no_grad():
+            for t in self._tensors(network):
+                t.copy_(values[offset:offset + t.numel()].view_as(t))
+                offset += t.numel()
+        self._pulled_version = start_version
+        return True
+
+class Actor(object):
+    """
+    The acting half of an Agent, for actor processes: epsilon-greedy actions
+    from the online network (mean quantile values with IQN) and writes into
+    a replay buffer, without the target network, optimizer and update state
+    of a learner. With NUMPY_ACTING (not for IQN), actions come from a NumPy
+    snapshot of the weights, taken again by refresh_acting_weights.
+    """
+
+    def __init__(
+        self, network, replay_buffer, n_actions: int, epsilon: float=1.,
+        iqn: bool=False, numpy_acting: bool=False,
+        device: torch.device=torch.device('cpu')):
+
+        self._network = network
+        self._replay_buffer = replay_buffer
+        self._n_actions = n_actions
+        self._epsilon = epsilon
+        self._iqn = iqn
+        self._device = device
+        self._acting_engine = None
+        if numpy_acting and not iqn:
+            self._acting_engine = NumpyActingEngine(network)
+            self._acting_engine.refresh()
+        self._acting_rng = np.random.default_rng(torch.initial_seed())
+
+    def reset(self):
+        self._network.encoder.reset()
+
+    def refresh_acting_weights(self):
+        if self._acting_engine is not None:
+            self._acting_engine.refresh()
+
+    def select_action(self, obs):
+        """ Epsilon-greedy action selection, as in Agent.select_action. """
+
+        if self._acting_engine is not None:
+            if self._epsilon < self._acting_rng.random():
+                return int(self._acting_engine.forward(obs)[1].argmax())
+            return int(self._acting_rng.integers(self._n_actions))
+        with torch.no_grad():
+            z = self._network.encoder(
+                torch.tensor(obs).unsqueeze(0).to(self._device))
+            if self._iqn:
+                q_values = self._network.Q(z)[0].squeeze(0).mean(0)
+            else:
+                q_values = self._network.Q(z).squeeze(0)
+        if self._epsilon < torch.rand(1):
+            return int(q_values.argmax(axis=-1))
+        return int(torch.randint(
+            low=0, high=self._n_actions, size=(1,), dtype=torch.int64))
+
+    def get_curr_latent(self):
+        return self._network.encoder.get_curr_latent()
+
+    def observe_first(self, timestep):
+        self._replay_buffer.add_first(timestep)
+
+    def observe(self, action, next_timestep, latent):
+        self._replay_buffer.add(action, next_timestep, latent)
+
+    def observe_fast(self, action, obs, reward, discount, last, latent):
+        self._replay_buffer.add_fast(
+            action, obs, reward, discount, last, latent)
+
+def _get_agent_class(iqn):
+    if iqn:
+        from auxrl.IQNAgent import Agent
+    else:
+        from auxrl.Agent import Agent
+    return Agent
+
+def _run_actor(
+    actor_id, make_env, make_network, agent_args, iqn, memory, weights,
+    stop_event, results, seed):
+    """ Actor process: acts with the latest published weights. """
+
+    torch.set_num_threads(1)
+    np.random.seed(seed) # Every process builds the same task
+    env = make_env()
+    np.random.seed(seed + 1 + actor_id)
+    torch.manual_seed(seed + 1 + actor_id)
+    env_spec = specs.make_environment_spec(env)
+    network = make_network(env_spec, device=torch.device('cpu'))
+    agent = Actor(
+        network, make_replay_buffer(
+            'shared', memory=memory, actor_id=actor_id),
+        env_spec.actions.num_values, epsilon=agent_args.get('epsilon', 1.),
+        iqn=iqn, numpy_acting=agent_args.get('numpy_acting', False))
+
+    fast = isinstance(env, FastStepEnv)
+    while not stop_event.is_set():
+        timestep = env.reset()
+        agent.reset()
+        agent.observe_first(timestep)
+        obs, last = timestep.observation, timestep.last()
+        episode_return = 0
+        episode_steps = 0
+        while (not last) and (not stop_event.is_set()):
+            if weights.pull(network):
+                agent.refresh_acting_weights()
+            action = agent.select_action(obs)
+            if fast:
+                obs, reward, discount, last = env.step_fast(action)
+                agent.observe_fast(
+                    action, obs, reward, discount, last,
+                    agent.get_curr_latent())
+            else:
+                timestep = env.step(action)
+                agent.observe(
+                    action, next_timestep=timestep,
+                    latent=agent.get_curr_latent())
+                obs, reward, last = (
+                    timestep.observation, timestep.reward, timestep.last())
+            episode_return += reward
+            episode_steps += 1
+        if last:
+            results.put((actor_id, episode_return, episode_steps))
+
+def run_actor_learner(
+    make_env, make_network, n_actors: int, n_updates: int,
+    agent_args: dict={}, iqn: bool=False, replay_capacity: int=100_000,
+    publish_every: int=10, clip_norm: float=-1., seed: int=0,
+    device: torch.device=torch.device('cpu'), mp_context: str='spawn'):
+    """
+    Trains with N_ACTORS actor processes and one learner (this process).
+    Each actor steps its own environment from MAKE_ENV() with an Actor and
+    writes into its sub-ring of a shared replay buffer; the learner runs
+    N_UPDATES calls of Agent.update (IQNAgent with IQN) on the whole buffer
+    and publishes its weights to the actors every PUBLISH_EVERY updates.
+
+    MAKE_ENV and MAKE_NETWORK(env_spec, device=...) must be picklable, e.g.
+    functools.partial of the Env and Network classes. NumPy is seeded with
+    SEED before every MAKE_ENV call, so all processes see the same task.
+    AGENT_ARGS are passed to the learner's Agent, without the replay
+    arguments; actors only take its epsilon and numpy_acting.
+
+    Returns the list of per-update losses, the list of (actor_id, return,
+    steps) of completed actor episodes, and the learner agent.
+    """
+
+    ctx = multiprocessing.get_context(mp_context)
+    np.random.seed(seed)
+    env = make_env()
+    torch.manual_seed(seed)
+    env_spec = specs.make_environment_spec(env)
+    network = make_network(env_spec, device=device)
+    Agent = _get_agent_class(iqn)
+
+    # Probe the shape of stored latents (None without memory)
+    obs = env.reset().observation
+    network.encoder.reset()
+    with torch.no_grad():
+        network.encoder(torch.tensor(obs).unsqueeze(0).to(device))
+    latent = network.encoder.get_curr_latent()
+    network.encoder.reset()
+
+    memory = SharedReplayMemory(n_actors, replay_capacity, obs, latent)
+    agent = Agent(
+        env_spec, network, device=device, replay_type='shared',
+        replay_args={'memory': memory}, **agent_args)
+    weights = SharedWeights(network, ctx)
+    weights.publish(network)
+    stop_event = ctx.Event()
+    results = ctx.Queue()
+    actors = [
+        ctx.Process(
+            target=_run_actor, daemon=True, args=(
+                actor_id, make_env, make_network, agent_args, iqn, memory,
+                weights, stop_event, results, seed))
+        for actor_id in range(n_actors)]
+    for actor in actors:
+        actor.start()
+
+    losses = []
+    episodes = []
+    def drain_results():
+        while True:
+            try:
+                episodes.append(results.get_nowait())
+            except queue.Empty:
+                return
+    try:
+        while len(losses) < n_updates:
+            n_updates_before = agent._n_updates
+            update_losses = agent.update(clip_norm=clip_norm)
+            if agent._n_updates == n_updates_before: # Buffer not ready yet
+                time.sleep(1e-3)
+                continue
+            losses.append(update_losses)
+            if agent._n_updates % publish_every == 0:
+                weights.publish(network)
+            drain_results()
+    finally:
+        stop_event.set()
+        for actor in actors:
+            while actor.is_alive():
+                drain_results()
+                actor.join(timeout=0.1)
+        drain_results()
+        if hasattr(agent, 'stop_prefetch'):
+            agent.stop_prefetch()
+    return losses, episodes, agent
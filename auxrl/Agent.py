@@ -5,6 +5,7 @@ import acme
 import torch
 import dm_env
 import random
+import threading
 import warnings
 import itertools
 import collections
@@ -21,12 +22,78 @@ from acme.utils import tree_utils
 import copy
 
 from auxrl.networks.Network import Network
-from auxrl.ReplayBuffer import ReplayBuffer
+from auxrl.ReplayBuffer import make_replay_buffer, PrioritizedReplayBuffer
+from auxrl.ReplayBuffer import TensorTransitions, BatchPrefetcher
+from auxrl.ActingEngine import NumpyActingEngine
 
 Transitions = collections.namedtuple(
     'Transitions', ['state', 'action', 'reward', 'discount', 'next_state'])
 
-class Agent(acme.Actor):
+def is_compile_error(error):
+    """
+    Whether ERROR is torch.compile failing to compile, as opposed to an error
+    in the compiled code itself (dynamo raises those, e.g. shape mismatches,
+    as TorchRuntimeError while tracing).
+    """
+
+    dynamo_exc = torch._dynamo.exc
+    return isinstance(error, (
+        dynamo_exc.TorchDynamoException, dynamo_exc.TritonUnavailableError)) \
+        and not isinstance(
+            error, (dynamo_exc.TorchRuntimeError, dynamo_exc.UserError))
+
+class LatentCache(object):
+    """
+    Mixin for agents with cache_latents: updates train on latents of the
+    frozen encoder that are computed once per interned observation and kept
+    in _latent_table.
+    """
+
+    def _with_latents(self, batch):
+        """
+        BATCH with its observation ids replaced by cached latents (prev_obs
+        fields only come with the pred_TD batches of Agent).
+        """
+
+        batch = dict(batch)
+        for name in ['obs', 'next_obs', 'prev_obs', 'prev_next_obs']:
+            if name in batch:
+                batch[name] = self._lookup_latents(batch[name])
+        return batch
+
+    def _lookup_latents(self, obs_ids):
+        """
+        Latents of interned observations under the frozen encoder, gathered
+        from a table that encodes every distinct observation once. New rows
+        are encoded in blocks of at least batch_size, the shape the encoder
+        sees in a regular update, so the cached latents match it exactly.
+        """
+
+        n_rows = 0 if self._latent_table is None else len(self._latent_table)
+        if obs_ids.max() >= n_rows:
+            with self._replay_lock:
+                new_obs = self._replay_buffer.get_interned_obs(n_rows)
+            new_obs = self._as_tensor(new_obs)
+            n_new = new_obs.shape[0]
+            if n_new < self._batch_size:
+                new_obs = torch.cat((new_obs, new_obs.new_zeros(
+                    (self._batch_size - n_new,) + new_obs.shape[1:])))
+            with torch.no_grad():
+                new_z = self._network.encoder(new_obs)[:n_new]
+            if self._latent_table is None:
+                self._latent_table = new_z
+            else:
+                self._latent_table = torch.cat((self._latent_table, new_z))
+        return self._latent_table[
+            torch.as_tensor(obs_ids, device=self._device).long()]
+
+class Agent(acme.Actor, LatentCache):
+    """
+    DQN agent with auxiliary losses on its latent space. LOSS_WEIGHTS are
+    fixed at construction; losses with zero weight are left out of updates,
+    and a zero weight for loss 0 also turns off pred_TD, so replay then
+    samples single transitions rather than pairs.
+    """
 
     def __init__(self,
         env_spec: specs.EnvironmentSpec, network: Network,
@@ -35,16 +102,25 @@ class Agent(acme.Actor):
         replay_capacity: int=1_000_000, epsilon: float=1.,
         batch_size: int=32, target_update_frequency: int=1000,
         device: torch.device=torch.device('cpu'), train_seq_len: int=0,
-        discount_factor: float=0.9,
+        discount_factor: float=0.9, replay_type: str='array',
+        replay_args: dict={}, prefetch_depth: int=0, dedup_obs: bool=False,
+        target_table: bool=False, compile_update: bool=False,
+        compile_args: dict={}, target_tau: float=None,
+        cache_latents: bool=False, numpy_acting: bool=False,
+        acting_staleness: int=None, target_table_rows: int=65_536,
+        rng: np.random.Generator=None,
         ):
 
         self._env_spec = env_spec
-        self._loss_weights = loss_weights
+        # Fixed for the agent's lifetime, as they decide the live losses
+        self._loss_weights = tuple(loss_weights)
+        # Auxiliary losses with zero weight are pruned from the update graph
+        self._live_losses = [weight != 0 for weight in loss_weights[:3]]
         self._n_actions = env_spec.actions.num_values
-        self._pred_TD = pred_TD
+        self._pred_TD = pred_TD and self._live_losses[0] # Else nothing to do
         self._pred_gamma = pred_gamma
         self._mem_len = network._mem_len
-        self._replay_seq_len = 2 if pred_TD else 1
+        self._replay_seq_len = 2 if self._pred_TD else 1
         if network._mem_len > 0:
             if pred_TD:
                 raise ValueError('POMDP + long horizon not implemented.')
@@ -55,15 +131,81 @@ class Agent(acme.Actor):
         # Initialize networks
         self._network = network
         self._target_network = network.copy()
-        self._replay_buffer = ReplayBuffer(replay_capacity)
+        if replay_type == 'torch':
+            replay_args = dict(
+                replay_args, device=device, n_actions=self._n_actions)
+        self._replay_buffer = make_replay_buffer(
+            replay_type, replay_capacity, **replay_args)
+        self._prioritized = isinstance(
+            self._replay_buffer, PrioritizedReplayBuffer)
+        # With RNG, exploration and replay sampling draw from it rather than
+        # the global streams, e.g. so an ensemble seed follows its lone run
+        self._rng = rng
+        if rng is not None:
+            if hasattr(self._replay_buffer, 'set_rng'):
+                self._replay_buffer.set_rng(rng)
+            else:
+                warnings.warn(f'{replay_type} replay samples from np.random.')
+        if hasattr(self._replay_buffer, 'set_latent_gamma'):
+            self._replay_buffer.set_latent_gamma(network._eligibility_gamma)
+        # Target Q-value tables need interned observations, no memory and hard
+        # target syncs; otherwise targets are evaluated on the fly
+        self._target_tau = target_tau # Polyak averaging instead of hard syncs
+        self._use_target_table = target_table and (self._mem_len == 0) \
+            and (target_tau is None) \
+            and getattr(self._replay_buffer, 'interns_obs', False)
+        if target_table and not self._use_target_table:
+            warnings.warn(
+                'Target table needs intern_obs, mem_len=0 and no target_tau.')
+        self._target_table = None
+        self._target_table_rows = target_table_rows # Then targets on the fly
+        # A frozen encoder is a fixed function of the observation, so with
+        # interned observations updates can train Q and T on latents that
+        # are computed once per distinct observation
+        self._cache_latents = cache_latents and network._freeze_encoder \
+            and (self._mem_len == 0) \
+            and getattr(self._replay_buffer, 'interns_obs', False)
+        if cache_latents and not self._cache_latents:
+            warnings.warn(
+                'Latent cache needs freeze_encoder, intern_obs and mem_len=0.')
+        if self._cache_latents:
+            self._replay_buffer.set_resolve_obs(False)
+        self._latent_table = None
+        self._replay_lock = threading.Lock()
+        if prefetch_depth > 0:
+            self._prefetcher = BatchPrefetcher(
+                self._prepare_batch, self._replay_lock, prefetch_depth)
+            if hasattr(self._replay_buffer, 'n_output_sets'):
+                self._replay_buffer.n_output_sets = prefetch_depth + 2
+        else:
+            self._prefetcher = None
         # Store training parameters
         self._epsilon = epsilon
         self._batch_size = batch_size
         self._lr = lr
         self._target_update_frequency = target_update_frequency
         self._device = device
+        self._loss_term_weights = torch.tensor(
+            list(loss_weights[:4]) + [1.], dtype=torch.float64, device=device)
         self._discount_factor = discount_factor
         self._train_seq_len = train_seq_len
+        self._dedup_obs = dedup_obs
+        # Losses can run through torch.compile, falling back to eager mode
+        self._compile_update = compile_update
+        self._compile_args = compile_args
+        self._compiled_losses = None
+        self._compiled_step = None
+        # Acting can run on a NumPy snapshot of the weights that lags at most
+        # acting_staleness updates (None: refreshed at each target sync)
+        self._acting_engine = None
+        if numpy_acting:
+            try:
+                self._acting_engine = NumpyActingEngine(network)
+            except ValueError as error:
+                warnings.warn(f'Acting in torch, no NumPy engine: {error}')
+        self._acting_staleness = acting_staleness
+        self._acting_rng = np.random.default_rng(torch.initial_seed()) \
+            if rng is None else rng
         # Initialize optimizer
         self._optimizer = torch.optim.Adam(
             self._network.get_trainable_params(), lr=lr)
@@ -76,87 +218,407 @@ class Agent(acme.Actor):
     def select_action(
         self, obs, force_greedy=False, verbose=False, return_latent=False
         ):
-        """ Epsilon-greedy action selection. """
+        """ Epsilon-greedy action selection; the action is a plain int. """
 
+        if self._acting_engine is not None:
+            return self._select_action_numpy(
+                obs, force_greedy, verbose, return_latent)
         with torch.no_grad():
             z = self._network.encoder(
                 torch.tensor(obs).unsqueeze(0).to(self._device))
             q_values = self._network.Q(z)
         q_values = q_values.squeeze(0).detach()
-        if force_greedy or (self._epsilon < torch.rand(1)):
+        if force_greedy or (self._epsilon < (
+            torch.rand(1) if self._rng is None else self._rng.random())):
             if verbose: print(q_values)
-            action = q_values.argmax(axis=-1)
+            action = int(q_values.argmax(axis=-1))
+        elif self._rng is not None:
+            action = int(self._rng.integers(self._n_actions))
         else:
-            action = torch.randint(
-                low=0, high=self._n_actions , size=(1,), dtype=torch.int64)
+            action = int(torch.randint(
+                low=0, high=self._n_actions , size=(1,), dtype=torch.int64))
         if return_latent:
             return action, z
         else:
             return action
 
+    def _select_action_numpy(self, obs, force_greedy, verbose, return_latent):
+        """
+        select_action on the NumPy acting engine. Exploration draws come from
+        the agent's NumPy generator, and exploratory actions skip the forward
+        pass unless the latent is requested.
+        """
+
+        greedy = force_greedy or (self._epsilon < self._acting_rng.random())
+        if greedy or return_latent:
+            if self._acting_weights_stale():
+                self.refresh_acting_weights()
+            z, q_values = self._acting_engine.forward(obs)
+        if greedy:
+            if verbose: print(q_values)
+            action = int(q_values.argmax())
+        else:
+            action = int(self._acting_rng.integers(self._n_actions))
+        if return_latent:
+            return action, torch.from_numpy(z.copy()).unsqueeze(0).to(
+                self._device)
+        return action
+
+    def _acting_weights_stale(self):
+        snapshot_updates = self._acting_engine.n_updates
+        if snapshot_updates is None:
+            return True
+        if self._acting_staleness is None: # Stale once the target syncs
+            period = self._target_update_frequency
+            return snapshot_updates // period != self._n_updates // period
+        return self._n_updates - snapshot_updates > self._acting_staleness
+
+    def refresh_acting_weights(self):
+        """
+        Snapshots the network into the NumPy acting engine, e.g. after its
+        weights were changed outside of update.
+        """
+
+        if self._acting_engine is not None:
+            self._acting_engine.refresh(self._n_updates)
+
     def get_curr_latent(self):
         return self._network.encoder.get_curr_latent()
 
-    def update(self, clip_norm=-1):
-        """ End-to-end training of encoder, Q, and auxiliary networks."""
+    def _as_tensor(self, x):
+        """ Float tensor on the agent's device from a sampled batch field. """
+        if isinstance(x, torch.Tensor):
+            return x.float()
+        return torch.as_tensor(
+            x.astype(np.float32, copy=False), device=self._device)
+
+    def _unpack_actions(self, transitions):
+        """ Returns (N,1) integer actions and (N, n_actions) one-hots. """
+        if isinstance(transitions, TensorTransitions):
+            return transitions.action, transitions.onehot_action
+        a = transitions.action.astype(int) # (N,1)
+        onehot_actions = np.zeros((a.shape[0], self._n_actions))
+        onehot_actions[np.arange(a.shape[0]), a.squeeze()] = 1
+        onehot_actions = torch.as_tensor(
+            onehot_actions, device=self._device).float()
+        return a, onehot_actions
+
+    def _prepare_batch(self):
+        """
+        Samples a batch and converts it to tensors on the device, including
+        the POMDP burn-in windows and the earlier step used by pred_TD.
+        Returns None if the replay buffer cannot fill a batch yet.
+        """
+
+        batches = self._prepare_batches(1)
+        return None if batches is None else batches[0]
+
+    def _prepare_batches(self, n_batches):
+        """
+        N_BATCHES batches as from _prepare_batch, gathered from the replay
+        buffer in one pass when it supports sample_many.
+        """
+
+        batch_size = self._batch_size
+        replay_seq_len = self._replay_seq_len
+        if not self._replay_buffer.is_ready(batch_size, replay_seq_len):
+            return None
+        with_slots = self._prioritized or self._use_target_table
+        if hasattr(self._replay_buffer, 'sample_many'):
+            if with_slots:
+                samples = self._replay_buffer.sample_many(
+                    n_batches, batch_size, replay_seq_len,
+                    return_indices=True)
+            else:
+                samples = [
+                    (transitions_seq, None) for transitions_seq in
+                    self._replay_buffer.sample_many(
+                        n_batches, batch_size, replay_seq_len)]
+        else:
+            samples = [
+                self._replay_buffer.sample(
+                    batch_size, replay_seq_len, return_indices=True)
+                if with_slots else
+                (self._replay_buffer.sample(batch_size, replay_seq_len), None)
+                for _ in range(n_batches)]
+        return [
+            self._to_batch(transitions_seq, sampled_slots)
+            for transitions_seq, sampled_slots in samples]
 
+    def _to_batch(self, transitions_seq, sampled_slots):
         batch_size = self._batch_size
         replay_seq_len = self._replay_seq_len
         mem_len = self._mem_len
-        if not self._replay_buffer.is_ready(batch_size, replay_seq_len):
-            return [0,0,0,0,0]
-        device = self._device
-        self._optimizer.zero_grad()
-        transitions_seq = self._replay_buffer.sample(batch_size, replay_seq_len)
+        batch = {}
+        if self._prioritized:
+            batch['slots'] = sampled_slots
+            batch['weights'] = torch.as_tensor(
+                self._replay_buffer.get_importance_weights(sampled_slots),
+                device=self._device)
+        if self._use_target_table:
+            last_slots = sampled_slots.reshape(batch_size, -1)[:, -1]
+            batch['next_obs_ids'] = self._replay_buffer.get_obs_ids(
+                last_slots)[1].astype(np.int64)
         if replay_seq_len > 1:
             transitions = transitions_seq[-1]
         else:
             transitions = transitions_seq
 
+        batch['obs'] = self._obs_field(transitions.obs) # (N,C,H,W)
+        batch['a'], batch['onehot_actions'] = self._unpack_actions(transitions)
+        batch['r'] = self._as_tensor(transitions.reward).view(-1,1) # (N,1)
+        batch['terminal'] = self._as_tensor(transitions.terminal).view(-1,1)
+        batch['next_obs'] = self._obs_field(transitions.next_obs)
+        if mem_len > 0:
+            # A copy: _as_tensor aliases the sampled array, and the encoder's
+            # forward scales a window it is given in place
+            batch['latents'] = self._as_tensor( # (N, mem_len, latent)
+                transitions_seq[mem_len].latent).squeeze(1).clone()
+            batch['obs_seq'] = torch.stack([ # (seq, N, C, H, W)
+                self._as_tensor(transitions_seq[t].obs)
+                for t in range(mem_len, replay_seq_len)])
+        if self._pred_TD:
+            batch['prev_obs'] = self._obs_field(transitions_seq[0].obs)
+            batch['prev_next_obs'] = self._obs_field(
+                transitions_seq[0].next_obs)
+            _, batch['prev_onehot_actions'] = self._unpack_actions(
+                transitions_seq[0])
+        return batch
+
+    def _obs_field(self, obs):
+        """ Batch entry for sampled observations (ids with cached latents). """
+
+        if self._cache_latents:
+            return obs
+        return self._as_tensor(obs)
+
+    def _encode(self, encoder, *obs):
+        """
+        Encodes each batch in OBS. With dedup_obs, ENCODER runs once on the
+        distinct observations across all batches and the latents are
+        scattered back. Losses and gradients are equal up to float rounding,
+        as gradients are summed in another order (relative tolerance 1e-6 in
+        scripts/check_dedup.py). With cached latents, OBS already holds the
+        latents.
+        """
+
+        if self._cache_latents: # Online and target encoders are both frozen
+            return list(obs)
+        if not self._dedup_obs:
+            return [encoder(o) for o in obs]
+        all_obs = torch.cat(obs)
+        unique_obs, inverse = torch.unique(
+            all_obs.flatten(1), dim=0, return_inverse=True)
+        z = encoder(unique_obs.view((-1,) + all_obs.shape[1:]))
+        return list(torch.split(z[inverse], [o.shape[0] for o in obs]))
+
+    def _lookup_target_q(self, next_obs_ids):
+        """
+        Target Q-values of interned next observations, gathered from a table
+        over every distinct observation. The table is dropped at each target
+        sync, then rebuilt and extended on demand as new observations are
+        interned. Once more than target_table_rows observations have been
+        interned (e.g. noisy ones), the table is turned off for good and
+        None is returned, so targets are evaluated on the fly.
+        """
+
+        n_rows = 0 if self._target_table is None else len(self._target_table)
+        if next_obs_ids.max() >= n_rows:
+            with self._replay_lock:
+                new_obs = self._replay_buffer.get_interned_obs(n_rows)
+            if n_rows + len(new_obs) > self._target_table_rows:
+                warnings.warn(
+                    f'Over {self._target_table_rows} distinct observations, '
+                    'evaluating targets on the fly.')
+                self._use_target_table = False
+                self._target_table = None
+                return None
+            with torch.no_grad():
+                new_q = self._target_network.Q(
+                    self._target_network.encoder(self._as_tensor(new_obs)))
+            if self._target_table is None:
+                self._target_table = new_q
+            else:
+                self._target_table = torch.cat((self._target_table, new_q))
+        return self._target_table[
+            torch.as_tensor(next_obs_ids, device=self._device)]
+
+    def _next_batch(self):
+        if self._prefetcher is None:
+            return self._prepare_batch()
+        with self._replay_lock:
+            if not self._replay_buffer.is_ready(
+                self._batch_size, self._replay_seq_len):
+                return None
+        return self._prefetcher.get()
+
+    def get_prefetch_stats(self):
+        """ Batches served and seconds the learner waited on the prefetcher. """
+
+        if self._prefetcher is None:
+            return None
+        return self._prefetcher.get_stats()
+
+    def stop_prefetch(self):
+        if self._prefetcher is not None:
+            self._prefetcher.stop()
+
+    def flush_replay_buffer(self):
+        with self._replay_lock:
+            self._replay_buffer.flush()
+            if self._prefetcher is not None:
+                self._prefetcher.clear()
+
+    def update_many(self, n_updates, clip_norm=-1, metrics=None):
+        """
+        Runs N_UPDATES updates and returns the list of their losses. Without
+        a prefetcher, all their batches are sampled in one replay pass first.
+        """
+
+        if (self._prefetcher is not None) or (n_updates <= 1):
+            return [
+                self.update(clip_norm, metrics=metrics)
+                for _ in range(n_updates)]
+        batches = self._prepare_batches(n_updates)
+        if batches is None:
+            return [[0,0,0,0,0] for _ in range(n_updates)]
+        return [self.update(clip_norm, batch, metrics) for batch in batches]
+
+    def update(self, clip_norm=-1, batch=None, metrics=None):
+        """
+        End-to-end training of encoder, Q, and auxiliary networks.
+        Returns the weighted losses as floats, or with METRICS (a LossMetrics),
+        adds them to it and returns them as a tensor without a device sync.
+        """
+
+        if batch is None:
+            batch = self._next_batch()
+        if batch is None:
+            return [0,0,0,0,0]
+        if self._cache_latents:
+            batch = self._with_latents(batch)
+        self._optimizer.zero_grad(set_to_none=False) # Flat grad buffer
+
+        # Update target network if needed
+        if (self._target_tau is not None) and (self._n_updates > 0):
+            self._target_network.sync_params(self._network, self._target_tau)
+        elif self._n_updates%self._target_update_frequency == 0:
+            self._target_network.sync_params(self._network)
+            self._target_table = None
+        if self._use_target_table:
+            target_next_q = self._lookup_target_q(batch['next_obs_ids'])
+        else:
+            target_next_q = None
+
+        # Only tensors go through the (possibly compiled) loss function
+        tensors = {k: v for k, v in batch.items() if torch.is_tensor(v)}
+        tensors['a'] = torch.as_tensor(
+            batch['a'], device=self._device).long().view(-1) # (N,)
+        try:
+            losses = self._backward_and_step(
+                self._get_loss_fn(), tensors, target_next_q, clip_norm)
+        except RuntimeError as error:
+            if not (self._compile_update and is_compile_error(error)):
+                raise
+            warnings.warn(f'Compiled update failed, running eagerly: {error}')
+            self._compile_update = False
+            self._optimizer.zero_grad(set_to_none=False)
+            losses = self._backward_and_step(
+                self._compute_losses, tensors, target_next_q, clip_norm)
+        loss_pos_sample, loss_neg_neighbor, loss_neg_random, loss_Q, \
+            all_losses, td_errors = losses
+        if self._prioritized:
+            with self._replay_lock:
+                self._replay_buffer.update_priorities(
+                    batch['slots'], td_errors.cpu().numpy())
+        self._n_updates += 1
+
+        # Update target network if needed
+        if self._n_updates % self._target_update_frequency == 0:
+            print(f'Q loss at step {self._n_updates}: {loss_Q.item()}')
+
+        # One device read for all losses, or none when accumulating METRICS
+        loss_terms = torch.stack([
+            loss_pos_sample, loss_neg_neighbor, loss_neg_random, loss_Q,
+            all_losses]).detach()
+        if metrics is not None:
+            loss_terms = loss_terms.double() * self._loss_term_weights
+            metrics.add(loss_terms)
+            return loss_terms
+        loss_terms = loss_terms.tolist()
+        return [
+            weight*loss for weight, loss in
+            zip(self._loss_weights, loss_terms[:4])] + loss_terms[4:]
+
+    def _backward_and_step(self, loss_fn, tensors, target_next_q, clip_norm):
+        self._network.check_flat_grad()
+        losses = loss_fn(tensors, target_next_q)
+        losses[4].backward()
+        if clip_norm != -1:
+            nn.utils.clip_grad_norm_(
+                self._network.get_encoder_params(), clip_norm)
+        if self._compile_update:
+            if self._compiled_step is None:
+                self._compiled_step = torch.compile(
+                    self._optimizer.step, **self._compile_args)
+            self._compiled_step()
+        else:
+            self._optimizer.step()
+        return losses
+
+    def _get_loss_fn(self):
+        """
+        The loss function for update: _compute_losses itself, or its compiled
+        version if compile_update is set. It is compiled once, as the loss
+        weights are fixed at construction.
+        """
+
+        if not self._compile_update:
+            return self._compute_losses
+        if self._compiled_losses is None:
+            self._compiled_losses = torch.compile(
+                self._compute_losses, **self._compile_args)
+        return self._compiled_losses
+
+    def _compute_losses(self, batch, target_next_q=None):
+        """
+        Forward pass of every loss from the tensors in BATCH, without side
+        effects. TARGET_NEXT_Q comes from the target table if it is used.
+        Returns the auxiliary losses, the Q loss, the weighted total, and the
+        TD errors used as priorities.
+        """
+
+        batch_size = self._batch_size
+        mem_len = self._mem_len
+
         # Unpack transition information
-        obs = torch.tensor(transitions.obs.astype(np.float32)).to(device) # (N,C,H,W)
-        a = transitions.action.astype(int) # (N,1)
-        r = torch.tensor(
-            transitions.reward.astype(np.float32)).view(-1,1).to(device) # (N,1)
-        terminal = torch.tensor(
-            transitions.terminal.astype(np.float32)).view(-1,1).to(device) # (N,1)
-        next_obs = torch.tensor(
-            transitions.next_obs.astype(np.float32)).to(device)
-        onehot_actions = np.zeros((batch_size, self._n_actions))
-        onehot_actions[np.arange(batch_size), a.squeeze()] = 1
-        onehot_actions = torch.as_tensor(onehot_actions, device=self._device).float()
-
-        # If in the POMDP setting (memory > 0), burn in latents
+        obs = batch['obs'] # (N,C,H,W)
+        a, onehot_actions = batch['a'], batch['onehot_actions'] # (N,), (N,A)
+        r = batch['r'] # (N,1)
+        terminal = batch['terminal'] # (N,1)
+        next_obs = batch['next_obs']
+
+        # If in the POMDP setting (memory > 0), burn in latents in one pass
+        # that serves both the auxiliary losses and the DDQN update
         if mem_len > 0:
-            _latents = np.array(transitions_seq[mem_len].latent.astype(np.float32))
-            _latents = torch.as_tensor(_latents).squeeze(1) # (N, mem_len, latent)
-            _latents = _latents.to(device)
-
-            for t in range(mem_len, replay_seq_len):
-                _obs_t = torch.tensor( # (N,C,H,W)
-                    transitions_seq[t].obs.astype(np.float32)).to(device)
-                z = self._network.encoder(_obs_t, prev_latents=_latents)
-                _latents = torch.hstack((
-                    _latents[:,1:],
-                    self._network.encoder._new_latent.unsqueeze(1)))
-            next_z = self._network.encoder(next_obs, prev_latents=_latents)
+            latents_seq = self._network.encoder.forward_sequence(
+                torch.cat((batch['obs_seq'], next_obs.unsqueeze(0))),
+                batch['latents']) # (seq+1, N, latent)
+            z, next_z = latents_seq[-2], latents_seq[-1]
         else:
-            next_z = self._network.encoder(next_obs)
-            z = self._network.encoder(obs)
-        z_and_action = torch.cat([z, onehot_actions], dim=1)
-        Tz = self._network.T(z_and_action)
+            obs_batches = [next_obs, obs]
+            if self._pred_TD:
+                obs_batches += [batch['prev_obs'], batch['prev_next_obs']]
+            latents = self._encode(self._network.encoder, *obs_batches)
+            next_z, z = latents[:2]
 
         # Positive Sample Loss (transition predictions)
-        if self._pred_TD:
-            _obs = torch.tensor(transitions_seq[0].obs.astype(np.float32))
-            _next_obs = torch.tensor(transitions_seq[0].next_obs.astype(np.float32))
-            _a = transitions_seq[0].action.astype(int)
-            _z = self._network.encoder(_obs.to(device))
-            _next_z = self._network.encoder(_next_obs.to(device))
-            _onehot_actions = np.zeros((self._batch_size, self._n_actions))
-            _onehot_actions[np.arange(self._batch_size), _a.squeeze()] = 1
-            _onehot_actions = torch.as_tensor(
-                _onehot_actions, device=self._device).float()
+        if not self._live_losses[0]:
+            loss_pos_sample = torch.zeros((), device=self._device)
+        elif self._pred_TD:
+            z_and_action = torch.cat([z, onehot_actions], dim=1)
+            _z, _next_z = latents[2:]
+            _onehot_actions = batch['prev_onehot_actions']
             _z_and_action = torch.cat([_z, _onehot_actions], dim=1)
             _Tz = self._network.T(_z_and_action)
             with torch.no_grad():
@@ -166,78 +628,69 @@ class Agent(acme.Actor):
                 _Tz, T_target, reduction='none')
             loss_pos_sample = torch.mean(loss_pos_sample)
         else:
+            z_and_action = torch.cat([z, onehot_actions], dim=1)
+            Tz = self._network.T(z_and_action)
             T_target = next_z
             loss_pos_sample = torch.nn.functional.mse_loss(
                 Tz, T_target, reduction='none')
             loss_pos_sample = torch.mean(loss_pos_sample)
 
         # Negative Sample Loss (entropy)
-        rolled = torch.roll(z, 1, dims=0)
         entropy_temp = 5
-        loss_neg_random = torch.mean(torch.exp(
-            -entropy_temp * torch.norm(z - rolled, dim=1)))
-        loss_neg_neighbor = torch.mean(torch.exp(
-            -entropy_temp * torch.norm(z - next_z, dim=1)))
-
-        # Update target network if needed
-        if self._n_updates%self._target_update_frequency == 0:
-            self._target_network.set_params(self._network.get_params())
+        if self._live_losses[2]:
+            rolled = torch.roll(z, 1, dims=0)
+            loss_neg_random = torch.mean(torch.exp(
+                -entropy_temp * torch.norm(z - rolled, dim=1)))
+        else:
+            loss_neg_random = torch.zeros((), device=self._device)
+        if self._live_losses[1]:
+            loss_neg_neighbor = torch.mean(torch.exp(
+                -entropy_temp * torch.norm(z - next_z, dim=1)))
+        else:
+            loss_neg_neighbor = torch.zeros((), device=self._device)
 
         # DDQN update
-        if mem_len > 0:
-            _latents = np.array(transitions_seq[mem_len].latent)
-            _latents = torch.as_tensor(_latents.astype(np.float32)).squeeze(1)
-            _latents = _latents.to(device) # (N, mem_len, latent_size)
-
-            for t in range(mem_len, replay_seq_len):
-                _obs_t = torch.tensor( # (N,C,H,W)
-                    transitions_seq[t].obs.astype(np.float32)).to(device)
-                z = self._network.encoder(_obs_t, prev_latents=_latents)
-                _latents = torch.hstack((
-                    _latents[:,1:],
-                    self._network.encoder._new_latent.unsqueeze(1)))
-            target_next_z = self._network.encoder(next_obs, _latents)
-        else:
-            target_next_z = self._target_network.encoder(next_obs) # (N, z)
+        if target_next_q is None:
+            if mem_len > 0:
+                target_next_z = next_z
+            else:
+                target_next_z = self._encode( # (N, z)
+                    self._target_network.encoder, next_obs)[0]
+            with torch.no_grad():
+                target_next_q = self._target_network.Q(target_next_z) # (N, a)
         with torch.no_grad():
-            target_next_q = self._target_network.Q(target_next_z)  # (N, a)
             next_q = self._network.Q(next_z)
             next_action = torch.argmax(next_q, axis=1)
             max_next_q = target_next_q[
-                np.arange(batch_size), next_action].reshape((-1,1))
+                torch.arange(batch_size, device=a.device),
+                next_action].reshape((-1,1))
             done = 1. - terminal
             target_q_vals = r + self._discount_factor*max_next_q*done
             target_q_vals = target_q_vals.squeeze()
         current_q_vals = self._network.Q(z)
-        current_q_vals = current_q_vals[np.arange(batch_size), a.squeeze()]
-        loss_Q = torch.mean(
-            torch.nn.functional.mse_loss(current_q_vals, target_q_vals,
-            reduction='none'))
-
-        # Aggregate all losses and update parameters
-        all_losses = self._loss_weights[0] * loss_pos_sample \
-            + self._loss_weights[1] * loss_neg_neighbor \
-            + self._loss_weights[2] * loss_neg_random \
-            + self._loss_weights[3] * loss_Q
-        all_losses.backward()
-        if clip_norm != -1:
-            nn.utils.clip_grad_norm_(
-                self._network.get_encoder_params(), clip_norm)
-        self._optimizer.step()
-        self._n_updates += 1
-
-        # Update target network if needed
-        if self._n_updates % self._target_update_frequency == 0:
-            print(f'Q loss at step {self._n_updates}: {loss_Q.item()}')
+        current_q_vals = current_q_vals[
+            torch.arange(batch_size, device=a.device), a]
+        q_errors = torch.nn.functional.mse_loss(
+            current_q_vals, target_q_vals, reduction='none')
+        td_errors = (target_q_vals - current_q_vals).detach()
+        if self._prioritized:
+            loss_Q = torch.mean(batch['weights'] * q_errors)
+        else:
+            loss_Q = torch.mean(q_errors)
 
-        return [
-            self._loss_weights[0]*loss_pos_sample.item(),
-            self._loss_weights[1]*loss_neg_neighbor.item(),
-            self._loss_weights[2]*loss_neg_random.item(),
-            self._loss_weights[3]*loss_Q.item(), all_losses.item()]
+        # Aggregate all live losses
+        aux_losses = [loss_pos_sample, loss_neg_neighbor, loss_neg_random]
+        all_losses = 0
+        for weight, loss, live in zip(
+            self._loss_weights, aux_losses, self._live_losses):
+            if live:
+                all_losses = all_losses + weight * loss
+        all_losses = all_losses + self._loss_weights[3] * loss_Q
+        return aux_losses + [loss_Q, all_losses, td_errors]
 
     def observe_first(self, timestep: dm_env.TimeStep):
-        self._replay_buffer.add_first(timestep)
+        with self._replay_lock:
+            self._replay_buffer.add_first(timestep)
 
     def observe(
         self, action: int, next_timestep: dm_env.TimeStep,
@@ -247,7 +700,92 @@ class Agent(acme.Actor):
         observation from time t.
         """
 
-        self._replay_buffer.add(action, next_timestep, latent)
+        with self._replay_lock:
+            self._replay_buffer.add(action, next_timestep, latent)
+
+    def observe_fast(
+        self, action: int, obs: np.ndarray, reward: float, discount: float,
+        last: bool, latent: torch.tensor):
+        """ observe, from the tuple returned by an environment's step_fast. """
+
+        with self._replay_lock:
+            self._replay_buffer.add_fast(
+                action, obs, reward, discount, last, latent)
+
+    def acts_randomly(self):
+        """ Whether actions are uniformly random, independent of the weights. """
+        return self._epsilon >= 1
+
+    def observe_random_episode(self, environment):
+        """
+        Runs one episode of ENVIRONMENT with uniformly random actions, drawn
+        in bulk and without forward passes, and writes it into the replay
+        buffer. Matches select_action only when acts_randomly. With memory,
+        the latents stored with each transition are computed afterwards in
+        one pass over the episode. Returns the episode return and length.
+        """
+
+        self.reset()
+        timestep = environment.reset()
+        timesteps, actions, draws = [timestep], [], []
+        episode_return = 0
+        while not timestep.last():
+            if len(draws) == 0:
+                draws = self._acting_rng.integers(
+                    self._n_actions, size=256).tolist()
+            actions.append(draws.pop())
+            timestep = environment.step(actions[-1])
+            timesteps.append(timestep)
+            episode_return += timestep.reward
+        latents = self._episode_latents(timesteps[:-1])
+        with self._replay_lock:
+            self._replay_buffer.add_first(timesteps[0])
+            for action, timestep, latent in zip(
+                actions, timesteps[1:], latents):
+                self._replay_buffer.add(action, timestep, latent)
+        return episode_return, len(actions)
+
+    def _episode_latents(self, timesteps):
+        """
+        The encoder's latent window after each of TIMESTEPS, as
+        get_curr_latent would return it while acting, from one
+        forward_sequence over the episode. None for each without memory.
+        """
+
+        if self._mem_len == 0:
+            return [None] * len(timesteps)
+        encoder = self._network.encoder
+        n_steps, mem_len = len(timesteps), self._mem_len
+        obs = torch.as_tensor(np.stack(
+            [timestep.observation for timestep in timesteps])).to(self._device)
+        with torch.no_grad():
+            start = torch.zeros(
+                1, mem_len, encoder._latent_dim, device=self._device)
+            history = torch.cat((
+                start.transpose(0, 1),
+                encoder.forward_sequence(obs.unsqueeze(1), start),
+                )) # (mem_len + S, 1, latent)
+        scales = encoder._get_window_scales(n_steps, history.device)
+        latents = []
+        for t in range(n_steps):
+            # Older entries went through forward's in-place scaling at step t
+            older = history[t+1:t+mem_len]
+            if scales is not None:
+                older = older * scales[t, 1:].view(-1, 1, 1)
+            latents.append(torch.cat(
+                (older, history[t+mem_len:t+mem_len+1])).transpose(0, 1))
+        return latents
+
+    def save_replay_buffer(self, path):
+        with self._replay_lock:
+            self._replay_buffer.save(path)
+
+    def load_replay_buffer(self, path):
+        with self._replay_lock:
+            self._replay_buffer.load(path)
+            if self._prefetcher is not None:
+                self._prefetcher.clear()
+        self._latent_table = None # Observation ids may have changed
 
     def save_network(self, path, episode=None):
         network_params = self._network.get_params()
@@ -264,4 +802,6 @@ class Agent(acme.Actor):
                 f'{path}network{file_suffix}.pth', map_location=torch.device('cpu')
                 )
         self._network.set_params(network_params, encoder_only, shuffle=shuffle)
+        self._latent_table = None
+        self.refresh_acting_weights()
 
@@ -0,0 +1,206 @@
+import torch
+import torch.nn as nn
+from torch.func import functional_call, vmap
+
+class _LossModule(nn.Module):
+    """
+    Registers an agent's online and target modules under one root, so that
+    functional_call can swap in any seed's parameters around the agent's own
+    _compute_losses.
+    """
+
+    def __init__(self, agent):
+        super().__init__()
+        self.online = nn.ModuleList(agent._network._arena_modules())
+        self.target = nn.ModuleList(agent._target_network._arena_modules())
+        self._agent = agent
+
+    def forward(self, batch, target_next_q):
+        return self._agent._compute_losses(batch, target_next_q)
+
+class EnsembleAgent(object):
+    """
+    Trains S agents of one configuration (e.g. the seeds of a sweep) in
+    lockstep. Their flat parameter arenas are stacked into one (S, P) tensor,
+    with every agent's modules left as views into its row, and each update
+    runs the losses of all seeds as a single vmapped forward and backward.
+    Adam is applied per row, masked to the seeds that actually updated, so
+    every seed follows the same optimization as a lone Agent.
+
+    Agents keep their own replay buffers, acting and checkpointing; only
+    update must go through the ensemble. Agents built with their own rng
+    sample the same batches as alone, so a seed's losses equal its lone run
+    up to float rounding; IQN quantile fractions still come from the shared
+    torch stream. Memory (mem_len > 0), dedup_obs and prefetching are not
+    supported.
+    """
+
+    def __init__(self, agents):
+        template = agents[0]
+        if getattr(template, '_mem_len', 0) > 0:
+            raise ValueError('Ensembles do not support memory.')
+        if template._dedup_obs or (template._prefetcher is not None):
+            raise ValueError('Ensembles do not support dedup or prefetching.')
+        self._agents = agents
+        self._n_seeds = len(agents)
+
+        # Stack the arenas; agents keep their parameters as views into rows
+        networks = [agent._network for agent in agents]
+        self._params = nn.Parameter(self._stack_arenas(networks))
+        self._target_params = self._stack_arenas(
+            [agent._target_network for agent in agents])
+        self._n_trainable = networks[0]._trainable_params.numel()
+        self._n_clipped = sum( # Encoder params form the end of the arena
+            p.numel() for p in networks[0].encoder.parameters())
+        for agent in agents:
+            agent._optimizer = torch.optim.Adam(
+                agent._network.get_trainable_params(), lr=agent._lr)
+
+        # Names and locations of every parameter within a row
+        self._loss_module = _LossModule(template)
+        self._param_slices = []
+        offset = 0
+        for name, p in self._loss_module.online.named_parameters():
+            self._param_slices.append(
+                (f'online.{name}', f'target.{name}', offset, p.shape))
+            offset += p.numel()
+
+        # Per-seed Adam state, matching the agents' optimizer settings
+        group = template._optimizer.param_groups[0]
+        self._lr = group['lr']
+        self._betas = group['betas']
+        self._eps = group['eps']
+        self._exp_avg = torch.zeros_like(self._params[:, :self._n_trainable])
+        self._exp_avg_sq = torch.zeros_like(self._exp_avg)
+        self._steps = [0] * self._n_seeds
+
+    @staticmethod
+    def _stack_arenas(networks):
+        values = torch.stack([n.get_flat_params() for n in networks])
+        for network, row in zip(networks, values):
+            network._build_arena(row)
+        return values
+
+    def _seed_losses(self, params, target_params, batch, target_next_q):
+        named_params = {}
+        for name, target_name, offset, shape in self._param_slices:
+            n_values = shape.numel()
+            named_params[name] = params[offset:offset + n_values].view(shape)
+            named_params[target_name] = target_params[
+                offset:offset + n_values].view(shape)
+        return functional_call(
+            self._loss_module, named_params, (batch, target_next_q))
+
+    def update(self, active=None, clip_norm=-1, batches=None):
+        """
+        One update of every seed in ACTIVE (all by default) whose replay
+        buffer can fill a batch, or with BATCHES, a list of prepared batches
+        (None to skip a seed). Returns each seed's losses as Agent.update
+        does, with zeros for seeds that did not update.
+        """
+
+        seeds = range(self._n_seeds) if active is None else active
+        if batches is None:
+            batches = [
+                self._agents[s]._next_batch() if s in seeds else None
+                for s in range(self._n_seeds)]
+        rows = [s for s in seeds if batches[s] is not None]
+        losses = [[0,0,0,0,0] for _ in range(self._n_seeds)]
+        if len(rows) == 0:
+            return losses
+        template = self._agents[0]
+
+        # Per-seed target syncs, then stack every seed's batch
+        tensors, target_next_q = [], []
+        for s in rows:
+            agent, batch = self._agents[s], batches[s]
+            if agent._cache_latents:
+                batch = agent._with_latents(batch)
+            if (agent._target_tau is not None) and (agent._n_updates > 0):
+                agent._target_network.sync_params(
+                    agent._network, agent._target_tau)
+            elif agent._n_updates%agent._target_update_frequency == 0:
+                agent._target_network.sync_params(agent._network)
+                agent._target_table = None
+            if agent._use_target_table:
+                with torch.no_grad():
+                    target_next_q.append(
+                        agent._lookup_target_q(batch['next_obs_ids']))
+            seed_tensors = {
+                k: v for k, v in batch.items() if torch.is_tensor(v)}
+            seed_tensors['a'] = torch.as_tensor(
+                batch['a'], device=agent._device).long().view(-1)
+            tensors.append(seed_tensors)
+        tensors = {k: torch.stack([t[k] for t in tensors]) for k in tensors[0]}
+        # A seed whose table outgrew target_table_rows now computes targets
+        # on the fly, and then all seeds do
+        if all(self._agents[s]._use_target_table for s in rows):
+            target_next_q, q_dim = torch.stack(target_next_q), 0
+        else:
+            target_next_q, q_dim = None, None
+
+        # One vmapped forward and backward for all seeds
+        row_idx = torch.as_tensor(rows, device=self._params.device)
+        if self._params.grad is not None:
+            self._params.grad.zero_()
+        seed_losses = vmap(
+            self._seed_losses, in_dims=(0, 0, 0, q_dim),
+            randomness='different')(
+            self._params[row_idx], self._target_params[row_idx], tensors,
+            target_next_q)
+        seed_losses[4].sum().backward()
+        grads = self._params.grad[row_idx, :self._n_trainable]
+        if (clip_norm != -1) and (self._n_trainable == self._params.shape[1]):
+            encoder_grads = grads[:, -self._n_clipped:]
+            clip_coef = clip_norm / (encoder_grads.norm(dim=1) + 1e-6)
+            encoder_grads *= clip_coef.clamp(max=1.).unsqueeze(1)
+        self._adam_step(rows, row_idx, grads)
+
+        # Per-seed bookkeeping, as in Agent.update
+        seed_losses_list = torch.stack(seed_losses[:5], dim=1).tolist()
+        for i, s in enumerate(rows):
+            agent = self._agents[s]
+            if agent._prioritized:
+                with agent._replay_lock:
+                    agent._replay_buffer.update_priorities(
+                        batches[s]['slots'], seed_losses[5][i].cpu().numpy())
+            agent._n_updates += 1
+            if agent._n_updates % agent._target_update_frequency == 0:
+                print(
+                    f'Q loss at step {agent._n_updates}: '
+                    f'{seed_losses_list[i][3]}')
+            losses[s] = [
+                weight*loss for weight, loss in
+                zip(agent._loss_weights, seed_losses_list[i][:4])]
+            losses[s].append(seed_losses_list[i][4])
+        return losses
+
+    def _adam_step(self, rows, row_idx, grads):
+        """
+        Adam on the rows of ROWS; other seeds keep params and moments. Rows
+        are stepped in groups of equal step count with torch.optim.Adam's own
+        single-tensor ops, so each matches a lone agent's optimizer.
+        """
+
+        beta1, beta2 = self._betas
+        for s in rows:
+            self._steps[s] += 1
+        steps = [self._steps[s] for s in rows]
+        with torch.no_grad():
+            exp_avg = self._exp_avg[row_idx].lerp_(grads, 1 - beta1)
+            exp_avg_sq = self._exp_avg_sq[row_idx].mul_(beta2).addcmul_(
+                grads, grads, value=1 - beta2)
+            self._exp_avg[row_idx] = exp_avg
+            self._exp_avg_sq[row_idx] = exp_avg_sq
+            params = self._params[row_idx, :self._n_trainable]
+            for step in set(steps):
+                group = torch.as_tensor(
+                    [i for i, n in enumerate(steps) if n == step],
+                    device=grads.device)
+                step_size = self._lr / (1 - beta1**step)
+                bias_correction2_sqrt = (1 - beta2**step)**0.5
+                denom = (exp_avg_sq[group].sqrt() / bias_correction2_sqrt
+                    ).add_(self._eps)
+                params[group] = params[group].addcdiv_(
+                    exp_avg[group], denom, value=-step_size)
+            self._params[row_idx, :self._n_trainable] = params
@@ -5,6 +5,7 @@ import acme
 import torch
 import dm_env
 import random
+import threading
 import warnings
 import itertools
 import collections
@@ -21,12 +22,14 @@ from acme.utils import tree_utils
 import copy
 
 from auxrl.networks.IQNNetwork import Network
-from auxrl.ReplayBuffer import ReplayBuffer
+from auxrl.Agent import is_compile_error, LatentCache
+from auxrl.ReplayBuffer import make_replay_buffer, PrioritizedReplayBuffer
+from auxrl.ReplayBuffer import TensorTransitions, BatchPrefetcher
 
 Transitions = collections.namedtuple(
     'Transitions', ['state', 'action', 'reward', 'discount', 'next_state'])
 
-class Agent(acme.Actor):
+class Agent(acme.Actor, LatentCache):
     """
     Agent where the model-free component is an implicit quantile network.
     This class does not have all the options of the Actor class (long horizon
@@ -39,22 +42,78 @@ class Agent(acme.Actor):
         loss_weights: list=[0,0,0,1], lr: float=1e-4, epsilon: float=1.,
         replay_capacity: int=1_000_000,
         batch_size: int=32, target_update_frequency: int=1000,
-        device: torch.device=torch.device('cpu'), discount_factor: float=0.9):
+        device: torch.device=torch.device('cpu'), discount_factor: float=0.9,
+        replay_type: str='array', replay_args: dict={},
+        prefetch_depth: int=0, dedup_obs: bool=False,
+        target_table: bool=False, compile_update: bool=False,
+        compile_args: dict={}, target_tau: float=None,
+        cache_latents: bool=False, rng: np.random.Generator=None):
 
         self._env_spec = env_spec
-        self._loss_weights = loss_weights
+        # Fixed for the agent's lifetime, as they decide the live losses
+        self._loss_weights = tuple(loss_weights)
+        # Auxiliary losses with zero weight are pruned from the update graph
+        self._live_losses = [weight != 0 for weight in loss_weights[:3]]
         self._n_actions = env_spec.actions.num_values
         # Initialize networks
         self._network = network
         self._target_network = network.copy()
-        self._replay_buffer = ReplayBuffer(replay_capacity)
+        if replay_type == 'torch':
+            replay_args = dict(
+                replay_args, device=device, n_actions=self._n_actions)
+        self._replay_buffer = make_replay_buffer(
+            replay_type, replay_capacity, **replay_args)
+        self._prioritized = isinstance(
+            self._replay_buffer, PrioritizedReplayBuffer)
+        # With RNG, exploration and replay sampling draw from it rather than
+        # the global streams, e.g. so an ensemble seed follows its lone run
+        self._rng = rng
+        if rng is not None:
+            if hasattr(self._replay_buffer, 'set_rng'):
+                self._replay_buffer.set_rng(rng)
+            else:
+                warnings.warn(f'{replay_type} replay samples from np.random.')
+        # Targets feed the online next latents to the target head with fresh
+        # quantile fractions at every update, so they cannot be tabulated
+        if target_table:
+            raise ValueError('IQN targets cannot be served from a table.')
+        self._target_tau = target_tau # Polyak averaging instead of hard syncs
+        self._use_target_table = False
+        # A frozen encoder is a fixed function of the observation, so with
+        # interned observations updates can train Q and T on latents that
+        # are computed once per distinct observation
+        self._cache_latents = cache_latents and network._freeze_encoder \
+            and getattr(self._replay_buffer, 'interns_obs', False)
+        if cache_latents and not self._cache_latents:
+            warnings.warn('Latent cache needs freeze_encoder and intern_obs.')
+        if self._cache_latents:
+            self._replay_buffer.set_resolve_obs(False)
+        self._latent_table = None
+        self._replay_lock = threading.Lock()
+        if prefetch_depth > 0:
+            self._prefetcher = BatchPrefetcher(
+                self._prepare_batch, self._replay_lock, prefetch_depth)
+            if hasattr(self._replay_buffer, 'n_output_sets'):
+                self._replay_buffer.n_output_sets = prefetch_depth + 2
+        else:
+            self._prefetcher = None
         # Store training parameters
         self._epsilon = epsilon
+        self._acting_rng = np.random.default_rng(torch.initial_seed()) \
+            if rng is None else rng
         self._batch_size = batch_size
         self._lr = lr
         self._target_update_frequency = target_update_frequency
         self._device = device
+        self._loss_term_weights = torch.tensor(
+            list(loss_weights[:4]) + [1.], dtype=torch.float64, device=device)
         self._discount_factor = discount_factor
+        self._dedup_obs = dedup_obs
+        # Losses can run through torch.compile, falling back to eager mode
+        self._compile_update = compile_update
+        self._compile_args = compile_args
+        self._compiled_losses = None
+        self._compiled_step = None
         # Initialize optimizer
         self._optimizer = torch.optim.Adam(
             self._network.get_trainable_params(), lr=lr)
@@ -67,7 +126,7 @@ class Agent(acme.Actor):
     def select_action(
         self, obs, force_greedy=False, verbose=False, return_latent=False
         ):
-        """ Epsilon-greedy action selection. """
+        """ Epsilon-greedy action selection; the action is a plain int. """
 
         with torch.no_grad():
             z = self._network.encoder(
@@ -75,12 +134,15 @@ class Agent(acme.Actor):
             quantile_vals, _ = self._network.Q(z)
         quantile_vals = quantile_vals.squeeze(0).detach()
         mean_quantile_vals = quantile_vals.mean(0)
-        if force_greedy or (self._epsilon < torch.rand(1)):
+        if force_greedy or (self._epsilon < (
+            torch.rand(1) if self._rng is None else self._rng.random())):
             if verbose: print(quantile_vals)
-            action = mean_quantile_vals.argmax(axis=-1)
+            action = int(mean_quantile_vals.argmax(axis=-1))
+        elif self._rng is not None:
+            action = int(self._rng.integers(self._n_actions))
         else:
-            action = torch.randint(
-                low=0, high=self._n_actions , size=(1,), dtype=torch.int64)
+            action = int(torch.randint(
+                low=0, high=self._n_actions , size=(1,), dtype=torch.int64))
         if return_latent:
             return action, z
         else:
@@ -89,6 +151,127 @@ class Agent(acme.Actor):
     def get_curr_latent(self):
         return self._network.encoder.get_curr_latent()
 
+    def _as_tensor(self, x):
+        """ Float tensor on the agent's device from a sampled batch field. """
+        if isinstance(x, torch.Tensor):
+            return x.float()
+        return torch.as_tensor(
+            x.astype(np.float32, copy=False), device=self._device)
+
+    def _unpack_actions(self, transitions):
+        """ Returns (N,1) integer actions and (N, n_actions) one-hots. """
+        if isinstance(transitions, TensorTransitions):
+            return transitions.action, transitions.onehot_action
+        a = transitions.action.astype(int) # (N,1)
+        onehot_actions = np.zeros((a.shape[0], self._n_actions))
+        onehot_actions[np.arange(a.shape[0]), a.squeeze()] = 1
+        onehot_actions = torch.as_tensor(
+            onehot_actions, device=self._device).float()
+        return a, onehot_actions
+
+    def _prepare_batch(self):
+        """
+        Samples a batch and converts it to tensors on the device. Returns
+        None if the replay buffer cannot fill a batch yet.
+        """
+
+        batches = self._prepare_batches(1)
+        return None if batches is None else batches[0]
+
+    def _prepare_batches(self, n_batches):
+        """
+        N_BATCHES batches as from _prepare_batch, gathered from the replay
+        buffer in one pass when it supports sample_many.
+        """
+
+        batch_size = self._batch_size
+        if not self._replay_buffer.is_ready(batch_size, 1):
+            return None
+        with_slots = self._prioritized
+        if hasattr(self._replay_buffer, 'sample_many'):
+            if with_slots:
+                samples = self._replay_buffer.sample_many(
+                    n_batches, batch_size, return_indices=True)
+            else:
+                samples = [
+                    (transitions, None) for transitions in
+                    self._replay_buffer.sample_many(n_batches, batch_size)]
+        else:
+            samples = [
+                self._replay_buffer.sample(batch_size, return_indices=True)
+                if with_slots else
+                (self._replay_buffer.sample(batch_size), None)
+                for _ in range(n_batches)]
+        return [
+            self._to_batch(transitions, sampled_slots)
+            for transitions, sampled_slots in samples]
+
+    def _to_batch(self, transitions, sampled_slots):
+        batch = {}
+        if self._prioritized:
+            batch['slots'] = sampled_slots
+            batch['weights'] = torch.as_tensor(
+                self._replay_buffer.get_importance_weights(sampled_slots),
+                device=self._device)
+        batch['obs'] = self._obs_field(transitions.obs) # (N,C,H,W)
+        batch['a'], batch['onehot_actions'] = self._unpack_actions(transitions)
+        batch['r'] = self._as_tensor(transitions.reward).view(-1,1) # (N,1)
+        batch['terminal'] = self._as_tensor(transitions.terminal).view(-1,1)
+        batch['next_obs'] = self._obs_field(transitions.next_obs)
+        return batch
+
+    def _obs_field(self, obs):
+        """ Batch entry for sampled observations (ids with cached latents). """
+
+        if self._cache_latents:
+            return obs
+        return self._as_tensor(obs)
+
+    def _encode(self, encoder, *obs):
+        """
+        Encodes each batch in OBS. With dedup_obs, ENCODER runs once on the
+        distinct observations across all batches and the latents are
+        scattered back. Losses and gradients are equal up to float rounding,
+        as gradients are summed in another order (relative tolerance 1e-6 in
+        scripts/check_dedup.py). With cached latents, OBS already holds the
+        latents.
+        """
+
+        if self._cache_latents: # Online and target encoders are both frozen
+            return list(obs)
+        if not self._dedup_obs:
+            return [encoder(o) for o in obs]
+        all_obs = torch.cat(obs)
+        unique_obs, inverse = torch.unique(
+            all_obs.flatten(1), dim=0, return_inverse=True)
+        z = encoder(unique_obs.view((-1,) + all_obs.shape[1:]))
+        return list(torch.split(z[inverse], [o.shape[0] for o in obs]))
+
+    def _next_batch(self):
+        if self._prefetcher is None:
+            return self._prepare_batch()
+        with self._replay_lock:
+            if not self._replay_buffer.is_ready(self._batch_size, 1):
+                return None
+        return self._prefetcher.get()
+
+    def get_prefetch_stats(self):
+        """ Batches served and seconds the learner waited on the prefetcher. """
+
+        if self._prefetcher is None:
+            return None
+        return self._prefetcher.get_stats()
+
+    def stop_prefetch(self):
+        if self._prefetcher is not None:
+            self._prefetcher.stop()
+
+    def flush_replay_buffer(self):
+        with self._replay_lock:
+            self._replay_buffer.flush()
+            if self._prefetcher is not None:
+                self._prefetcher.clear()
+
     def get_huber_loss(self, td_errors, k):
         """
         Calculate huber loss element-wisely depending on kappa k.
@@ -97,94 +280,188 @@ class Agent(acme.Actor):
             td_errors.abs() <= k, 0.5 * td_errors.pow(2), k * (td_errors.abs() - 0.5 * k))
         return loss
 
-    def update(self, clip_norm=-1):
-        batch_size = self._batch_size
-        if not self._replay_buffer.is_ready(batch_size, 1):
+    def update_many(self, n_updates, clip_norm=-1, metrics=None):
+        """
+        Runs N_UPDATES updates and returns the list of their losses. Without
+        a prefetcher, all their batches are sampled in one replay pass first.
+        """
+
+        if (self._prefetcher is not None) or (n_updates <= 1):
+            return [
+                self.update(clip_norm, metrics=metrics)
+                for _ in range(n_updates)]
+        batches = self._prepare_batches(n_updates)
+        if batches is None:
+            return [[0,0,0,0,0] for _ in range(n_updates)]
+        return [self.update(clip_norm, batch, metrics) for batch in batches]
+
+    def update(self, clip_norm=-1, batch=None, metrics=None):
+        if batch is None:
+            batch = self._next_batch()
+        if batch is None:
             return [0,0,0,0,0]
-        device = self._device
-        self._optimizer.zero_grad()
-        transitions_seq = self._replay_buffer.sample(batch_size)
-        transitions = transitions_seq
+        if self._cache_latents:
+            batch = self._with_latents(batch)
+        self._optimizer.zero_grad(set_to_none=False) # Flat grad buffer
+
+        # Update target network if needed
+        if (self._target_tau is not None) and (self._n_updates > 0):
+            self._target_network.sync_params(self._network, self._target_tau)
+        elif self._n_updates%self._target_update_frequency == 0:
+            self._target_network.sync_params(self._network)
+        target_next_q = None
+
+        # Only tensors go through the (possibly compiled) loss function
+        tensors = {k: v for k, v in batch.items() if torch.is_tensor(v)}
+        tensors['a'] = torch.as_tensor(
+            batch['a'], device=self._device).long().view(-1) # (N,)
+        try:
+            losses = self._backward_and_step(
+                self._get_loss_fn(), tensors, target_next_q, clip_norm)
+        except RuntimeError as error:
+            if not (self._compile_update and is_compile_error(error)):
+                raise
+            warnings.warn(f'Compiled update failed, running eagerly: {error}')
+            self._compile_update = False
+            self._optimizer.zero_grad(set_to_none=False)
+            losses = self._backward_and_step(
+                self._compute_losses, tensors, target_next_q, clip_norm)
+        loss_pos_sample, loss_neg_neighbor, loss_neg_random, loss_Q, \
+            all_losses, quantile_loss = losses
+        if self._prioritized:
+            with self._replay_lock:
+                self._replay_buffer.update_priorities(
+                    batch['slots'], quantile_loss.cpu().numpy())
+        self._n_updates += 1
+
+        # Update target network if needed
+        if self._n_updates % self._target_update_frequency == 0:
+            print(f'Q loss at step {self._n_updates}: {loss_Q.item()}')
+
+        # One device read for all losses, or none when accumulating METRICS
+        loss_terms = torch.stack([
+            loss_pos_sample, loss_neg_neighbor, loss_neg_random, loss_Q,
+            all_losses]).detach()
+        if metrics is not None:
+            loss_terms = loss_terms.double() * self._loss_term_weights
+            metrics.add(loss_terms)
+            return loss_terms
+        loss_terms = loss_terms.tolist()
+        return [
+            weight*loss for weight, loss in
+            zip(self._loss_weights, loss_terms[:4])] + loss_terms[4:]
+
+    def _backward_and_step(self, loss_fn, tensors, target_next_q, clip_norm):
+        self._network.check_flat_grad()
+        losses = loss_fn(tensors, target_next_q)
+        losses[4].backward()
+        if clip_norm != -1:
+            nn.utils.clip_grad_norm_(self._network.get_encoder_params(), clip_norm)
+        if self._compile_update:
+            if self._compiled_step is None:
+                self._compiled_step = torch.compile(
+                    self._optimizer.step, **self._compile_args)
+            self._compiled_step()
+        else:
+            self._optimizer.step()
+        return losses
+
+    def _get_loss_fn(self):
+        """
+        _compute_losses, or its compiled version if compile_update is set,
+        which is compiled once as the loss weights are fixed.
+        """
+
+        if not self._compile_update:
+            return self._compute_losses
+        if self._compiled_losses is None:
+            self._compiled_losses = torch.compile(
+                self._compute_losses, **self._compile_args)
+        return self._compiled_losses
+
+    def _compute_losses(self, batch, target_next_q=None):
+        """
+        Forward pass of every loss from the tensors in BATCH, without side
+        effects. Returns the auxiliary losses, the Q loss, the weighted total,
+        and the detached per-sample quantile losses used as priorities.
+        """
+
+        batch_size = self._batch_size
 
         # Unpack transition information
-        obs = torch.tensor(transitions.obs.astype(np.float32)).to(device) # (N,C,H,W)
-        a = transitions.action.astype(int) # (N,1)
-        r = torch.tensor(
-            transitions.reward.astype(np.float32)).view(-1,1).to(device) # (N,1)
-        terminal = torch.tensor(
-            transitions.terminal.astype(np.float32)).view(-1,1).to(device) # (N,1)
-        next_obs = torch.tensor(
-            transitions.next_obs.astype(np.float32)).to(device)
-        onehot_actions = np.zeros((batch_size, self._n_actions))
-        onehot_actions[np.arange(batch_size), a.squeeze()] = 1
-        onehot_actions = torch.as_tensor(onehot_actions, device=self._device).float()
+        obs = batch['obs'] # (N,C,H,W)
+        a, onehot_actions = batch['a'], batch['onehot_actions'] # (N,), (N,A)
+        r = batch['r'] # (N,1)
+        terminal = batch['terminal'] # (N,1)
+        next_obs = batch['next_obs']
 
         # Run through encoder
-        next_z = self._network.encoder(next_obs)
-        z = self._network.encoder(obs)
-        z_and_action = torch.cat([z, onehot_actions], dim=1)
-        Tz = self._network.T(z_and_action)
+        next_z, z = self._encode(self._network.encoder, next_obs, obs)
 
         # Positive Sample Loss (transition predictions)
-        T_target = next_z
-        loss_pos_sample = torch.nn.functional.mse_loss(
-            Tz, T_target, reduction='none')
-        loss_pos_sample = torch.mean(loss_pos_sample)
+        if self._live_losses[0]:
+            z_and_action = torch.cat([z, onehot_actions], dim=1)
+            Tz = self._network.T(z_and_action)
+            T_target = next_z
+            loss_pos_sample = torch.nn.functional.mse_loss(
+                Tz, T_target, reduction='none')
+            loss_pos_sample = torch.mean(loss_pos_sample)
+        else:
+            loss_pos_sample = torch.zeros((), device=self._device)
 
         # Negative Sample Loss (entropy)
-        rolled = torch.roll(z, 1, dims=0)
         entropy_temp = 5
-        loss_neg_random = torch.mean(torch.exp(
-            -entropy_temp * torch.norm(z - rolled, dim=1)))
-        loss_neg_neighbor = torch.mean(torch.exp(
-            -entropy_temp * torch.norm(z - next_z, dim=1)))
-
-        # Update target network if needed
-        if self._n_updates%self._target_update_frequency == 0:
-            self._target_network.set_params(self._network.get_params())
+        if self._live_losses[2]:
+            rolled = torch.roll(z, 1, dims=0)
+            loss_neg_random = torch.mean(torch.exp(
+                -entropy_temp * torch.norm(z - rolled, dim=1)))
+        else:
+            loss_neg_random = torch.zeros((), device=self._device)
+        if self._live_losses[1]:
+            loss_neg_neighbor = torch.mean(torch.exp(
+                -entropy_temp * torch.norm(z - next_z, dim=1)))
+        else:
+            loss_neg_neighbor = torch.zeros((), device=self._device)
 
         # IQN update
         with torch.no_grad():
-            target_next_q, quantiles = self._target_network.Q(next_z) # (N, Q, a)
+            if target_next_q is None:
+                target_next_q, _ = self._target_network.Q(next_z) # (N, Q, a)
+            n_quantiles = target_next_q.shape[1]
             next_action = torch.argmax(target_next_q.mean(1), axis=1) # (N)
             max_next_q = target_next_q[
-                np.arange(batch_size), :, next_action] # (N, Q)
-            rewards = r.repeat(1, quantiles.shape[1])
-            done = (1. - terminal).repeat(1, quantiles.shape[1])
+                torch.arange(batch_size, device=a.device), :,
+                next_action] # (N, Q)
+            rewards = r.repeat(1, n_quantiles)
+            done = (1. - terminal).repeat(1, n_quantiles)
             target_q_vals = rewards + self._discount_factor*max_next_q*done
         current_q_vals, quantiles = self._network.Q(z)
-        current_q_vals = current_q_vals[np.arange(batch_size), :, a.squeeze()]
+        current_q_vals = current_q_vals[
+            torch.arange(batch_size, device=a.device), :, a]
         td_error = target_q_vals.unsqueeze(1) - current_q_vals.unsqueeze(2)
         assert td_error.shape == (td_error.shape[0], 8, 8), "Wrong shape"
         kappa = 1.0
         huber_loss = self.get_huber_loss(td_error, kappa)
         quantile_loss = abs(quantiles - (td_error.detach()<0).float()) * huber_loss / kappa
         quantile_loss = quantile_loss.sum(dim=1).mean(dim=1)
-        loss_Q = torch.mean(quantile_loss)
-
-        # Aggregate all losses and update parameters
-        all_losses = self._loss_weights[0] * loss_pos_sample \
-            + self._loss_weights[1] * loss_neg_neighbor \
-            + self._loss_weights[2] * loss_neg_random \
-            + self._loss_weights[3] * loss_Q
-        all_losses.backward()
-        if clip_norm != -1:
-            nn.utils.clip_grad_norm_(self._network.get_encoder_params(), clip_norm)
-        self._optimizer.step()
-        self._n_updates += 1
-
-        # Update target network if needed
-        if self._n_updates % self._target_update_frequency == 0:
-            print(f'Q loss at step {self._n_updates}: {loss_Q.item()}')
+        if self._prioritized:
+            loss_Q = torch.mean(batch['weights'] * quantile_loss)
+        else:
+            loss_Q = torch.mean(quantile_loss)
 
-        return [
-            self._loss_weights[0]*loss_pos_sample.item(),
-            self._loss_weights[1]*loss_neg_neighbor.item(),
-            self._loss_weights[2]*loss_neg_random.item(),
-            self._loss_weights[3]*loss_Q.item(), all_losses.item()]
+        # Aggregate all live losses
+        aux_losses = [loss_pos_sample, loss_neg_neighbor, loss_neg_random]
+        all_losses = 0
+        for weight, loss, live in zip(
+            self._loss_weights, aux_losses, self._live_losses):
+            if live:
+                all_losses = all_losses + weight * loss
+        all_losses = all_losses + self._loss_weights[3] * loss_Q
+        return aux_losses + [loss_Q, all_losses, quantile_loss.detach()]
 
     def observe_first(self, timestep: dm_env.TimeStep):
-        self._replay_buffer.add_first(timestep)
+        with self._replay_lock:
+            self._replay_buffer.add_first(timestep)
 
     def observe(
         self, action: int, next_timestep: dm_env.TimeStep,
@@ -194,7 +471,58 @@ class Agent(acme.Actor):
         observation from time t.
         """
 
-        self._replay_buffer.add(action, next_timestep, latent)
+        with self._replay_lock:
+            self._replay_buffer.add(action, next_timestep, latent)
+
+    def observe_fast(
+        self, action: int, obs: np.ndarray, reward: float, discount: float,
+        last: bool, latent: torch.tensor):
+        """ observe, from the tuple returned by an environment's step_fast. """
+
+        with self._replay_lock:
+            self._replay_buffer.add_fast(
+                action, obs, reward, discount, last, latent)
+
+    def acts_randomly(self):
+        """ Whether actions are uniformly random, independent of the weights. """
+        return self._epsilon >= 1
+
+    def observe_random_episode(self, environment):
+        """
+        Runs one episode of ENVIRONMENT with uniformly random actions, drawn
+        in bulk and without forward passes, and writes it into the replay
+        buffer. Matches select_action only when acts_randomly. Returns the
+        episode return and length.
+        """
+
+        self.reset()
+        timestep = environment.reset()
+        timesteps, actions, draws = [timestep], [], []
+        episode_return = 0
+        while not timestep.last():
+            if len(draws) == 0:
+                draws = self._acting_rng.integers(
+                    self._n_actions, size=256).tolist()
+            actions.append(draws.pop())
+            timestep = environment.step(actions[-1])
+            timesteps.append(timestep)
+            episode_return += timestep.reward
+        with self._replay_lock:
+            self._replay_buffer.add_first(timesteps[0])
+            for action, timestep in zip(actions, timesteps[1:]):
+                self._replay_buffer.add(action, timestep, None)
+        return episode_return, len(actions)
+
+    def save_replay_buffer(self, path):
+        with self._replay_lock:
+            self._replay_buffer.save(path)
+
+    def load_replay_buffer(self, path):
+        with self._replay_lock:
+            self._replay_buffer.load(path)
+            if self._prefetcher is not None:
+                self._prefetcher.clear()
+        self._latent_table = None # Observation ids may have changed
 
     def save_network(self, path, episode=None):
         network_params = self._network.get_params()
@@ -211,4 +539,5 @@ class Agent(acme.Actor):
                 f'{path}network{file_suffix}.pth', map_location=torch.device('cpu')
                 )
         self._network.set_params(network_params, encoder_only, shuffle=shuffle)
+        self._latent_table = None
 
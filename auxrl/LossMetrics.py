@@ -0,0 +1,105 @@
+import torch
+
+LOSS_NAMES = [
+    'pos_sample_loss', 'neg_neighbor_loss', 'neg_random_loss', 'mf_loss',
+    'train_loss']
+
+class LossMetrics(object):
+    """
+    Running statistics of the weighted loss terms returned by agent updates,
+    kept as tensors on the training device. Adding an update's losses only
+    queues device ops, so the training loop never waits on the device; the
+    host reads the statistics once, e.g. per episode or logging interval.
+
+    Sums are kept in float64, so means match summing the per-update floats on
+    the host. Optionally tracks per-term minima and maxima (TRACK_EXTREMA) and
+    histograms over the bin edges HIST_EDGES, with out-of-range values counted
+    in the first and last bins.
+    """
+
+    def __init__(
+        self, device: torch.device=torch.device('cpu'), names: list=LOSS_NAMES,
+        track_extrema: bool=False, hist_edges: list=None):
+
+        self._device = device
+        self._names = list(names)
+        self._track_extrema = track_extrema
+        if hist_edges is None:
+            self._hist_edges = None
+        else:
+            self._hist_edges = torch.as_tensor(
+                hist_edges, dtype=torch.float64, device=device)
+            if (self._hist_edges.dim() != 1) or (len(self._hist_edges) < 2):
+                raise ValueError('Histogram needs at least two bin edges.')
+        self.reset()
+
+    def reset(self):
+        n_terms = len(self._names)
+        self._count = 0
+        self._sums = torch.zeros(
+            n_terms, dtype=torch.float64, device=self._device)
+        if self._track_extrema:
+            self._mins = torch.full_like(self._sums, float('inf'))
+            self._maxs = torch.full_like(self._sums, -float('inf'))
+        if self._hist_edges is not None:
+            self._hist = torch.zeros(
+                n_terms, len(self._hist_edges) - 1, dtype=torch.int64,
+                device=self._device)
+            self._term_idx = torch.arange(n_terms, device=self._device)
+
+    def add(self, losses: torch.Tensor):
+        """ Accumulates one update's (n_terms,) loss tensor. """
+
+        losses = losses.detach().to(self._sums)
+        self._sums += losses
+        self._count += 1
+        if self._track_extrema:
+            torch.minimum(self._mins, losses, out=self._mins)
+            torch.maximum(self._maxs, losses, out=self._maxs)
+        if self._hist_edges is not None:
+            bins = torch.bucketize(losses, self._hist_edges, right=True) - 1
+            bins = bins.clamp(0, self._hist.shape[1] - 1)
+            self._hist.index_put_(
+                (self._term_idx, bins), torch.ones_like(bins), accumulate=True)
+
+    def get_count(self) -> int:
+        """ Number of updates added since the last reset. """
+        return self._count
+
+    def get_sums(self) -> list:
+        return self._sums.tolist()
+
+    def get_means(self) -> list:
+        """ Per-term means over the added updates, zeros if there are none. """
+
+        if self._count == 0:
+            return [0.] * len(self._names)
+        return [s/self._count for s in self.get_sums()]
+
+    def get_summary(self, reset: bool=False) -> dict:
+        """
+        Dict of count, and per-term mean (and min, max, histogram counts when
+        tracked) keyed by loss name, read from the device in a single copy.
+        """
+
+        stats = [self._sums]
+        if self._track_extrema:
+            stats.extend([self._mins, self._maxs])
+        if self._hist_edges is not None:
+            stats.append(self._hist.to(torch.float64).flatten())
+        values = torch.cat(stats).cpu().numpy()
+        n_terms = len(self._names)
+        summary = {'count': self._count}
+        count = max(self._count, 1)
+        for i, name in enumerate(self._names):
+            summary[f'{name}_mean'] = values[i] / count
+            if self._track_extrema:
+                summary[f'{name}_min'] = values[n_terms + i]
+                summary[f'{name}_max'] = values[2*n_terms + i]
+        if self._hist_edges is not None:
+            hist = values[-self._hist.numel():].reshape(self._hist.shape)
+            for i, name in enumerate(self._names):
+                summary[f'{name}_hist'] = hist[i].astype(int)
+        if reset:
+            self.reset()
+        return summary
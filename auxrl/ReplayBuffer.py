@@ -1,6 +1,15 @@
+import os
 import enum
+import json
+import time
+import queue
+import shutil
 import dm_env
 import random
+import weakref
+import tempfile
+import threading
+import multiprocessing.sharedctypes
 import collections
 import numpy as np
 from itertools import islice
@@ -15,6 +24,11 @@ Transitions = collections.namedtuple(
     'Transitions',
     ['obs', 'latent', 'action', 'reward', 'discount', 'next_obs', 'terminal'])
 
+# Transitions as torch tensors on the learner's device, with the actions
+# additionally given as float (N, n_actions) one-hot vectors.
+TensorTransitions = collections.namedtuple(
+    'TensorTransitions', Transitions._fields + ('onehot_action',))
+
 class ReplayBuffer(object):
     """A simple Python replay buffer."""
 
@@ -27,18 +41,28 @@ class ReplayBuffer(object):
 
     def add(
         self, action: int, timestep: dm_env.TimeStep, latent: torch.tensor):
+        self.add_fast(
+            action, timestep.observation, timestep.reward, timestep.discount,
+            timestep.last(), latent)
+
+    def add_fast(
+        self, action: int, obs: np.ndarray, reward: float, discount: float,
+        last: bool, latent: torch.tensor):
+        """ add, from the fields of an environment's step_fast. """
 
         if latent != None:
             latent = latent.cpu().numpy()
+        if isinstance(action, torch.Tensor):
+            action = action.cpu().numpy()
 
         transition = Transitions(
-            obs=self._prev_obs, action=action.cpu().numpy(),
-            reward=timestep.reward,
-            discount=timestep.discount, next_obs=timestep.observation,
-            terminal=timestep.last(),
+            obs=self._prev_obs, action=action,
+            reward=reward,
+            discount=discount, next_obs=obs,
+            terminal=last,
             latent=latent)
         self.buffer.append(transition)
-        self._prev_obs = timestep.observation
+        self._prev_obs = obs
 
     def add_artificial_transition(
         self, timestep: dm_env.TimeStep, next_timestep: dm_env.TimeStep,
@@ -96,3 +120,1416 @@ class ReplayBuffer(object):
     def is_ready(self, batch_size: int, seq_len: int) -> bool:
         return max(batch_size, seq_len) <= len(self.buffer)
 
+
+class Float32Codec(object):
+    """ Stores observations as float32. """
+
+    def encode(self, obs):
+        return np.asarray(obs, dtype=np.float32)
+
+    def decode(self, stored_obs):
+        return stored_obs
+
+class Float16Codec(object):
+    """ Stores observations as float16. Lossy; meant for noisy inputs. """
+
+    def encode(self, obs):
+        return np.asarray(obs, dtype=np.float16)
+
+    def decode(self, stored_obs):
+        return stored_obs.astype(np.float32)
+
+class Int8Codec(object):
+    """ Stores integer-valued observations in [-128, 127] as int8. """
+
+    def encode(self, obs):
+        encoded = np.asarray(obs).astype(np.int8)
+        if not np.array_equal(encoded, obs):
+            raise ValueError('Observation is not representable as int8.')
+        return encoded
+
+    def decode(self, stored_obs):
+        return stored_obs.astype(np.float32)
+
+class BitPackedCodec(object):
+    """ Stores binary observations with one bit per entry. """
+
+    def __init__(self):
+        self._shape = None
+
+    def encode(self, obs):
+        obs = np.asarray(obs)
+        if self._shape is None:
+            self._shape = obs.shape
+        encoded = obs.astype(bool)
+        if not np.array_equal(encoded, obs):
+            raise ValueError('Observation is not binary.')
+        return np.packbits(encoded.reshape(-1))
+
+    def decode(self, stored_obs):
+        decoded = np.unpackbits(
+            stored_obs, axis=-1, count=int(np.prod(self._shape)))
+        decoded = decoded.reshape(stored_obs.shape[:-1] + self._shape)
+        return decoded.astype(np.float32)
+
+    def get_state(self):
+        """ The observation shape, as saved with buffer snapshots. """
+        return None if self._shape is None else list(self._shape)
+
+    def set_state(self, state):
+        self._shape = None if state is None else tuple(state)
+
+OBS_CODECS = {
+    'float32': Float32Codec, 'float16': Float16Codec, 'int8': Int8Codec,
+    'bitpack': BitPackedCodec}
+
+class ObservationTable(object):
+    """
+    Deduplicated table of observations. Each distinct observation is stored
+    once and addressed by an int32 id; ids are keyed by the raw bytes of the
+    observation. Only useful for environments with a small set of distinct
+    observations, as the table is never pruned.
+    """
+
+    def __init__(self, initial_size: int=64):
+        self._initial_size = initial_size
+        self._ids = {}
+        self._table = None
+        self._n_obs = 0
+
+    def __len__(self):
+        return self._n_obs
+
+    @property
+    def table(self):
+        return self._table[:self._n_obs]
+
+    def intern(self, obs) -> np.int32:
+        obs = np.asarray(obs)
+        key = obs.tobytes()
+        obs_id = self._ids.get(key)
+        if obs_id is None:
+            if self._table is None:
+                self._table = np.zeros(
+                    (self._initial_size,) + obs.shape, dtype=obs.dtype)
+            elif self._n_obs == self._table.shape[0]:
+                self._table = np.concatenate(
+                    (self._table, np.zeros_like(self._table)))
+            obs_id = np.int32(self._n_obs)
+            self._table[obs_id] = obs
+            self._ids[key] = obs_id
+            self._n_obs += 1
+        return obs_id
+
+    def lookup(self, obs_ids):
+        return self._table[obs_ids]
+
+def _randint(rng, high, size):
+    """ Draws from RNG, a np.random.Generator, or the global np.random. """
+    if rng is None:
+        return np.random.randint(high, size=size)
+    return rng.integers(high, size=size)
+
+def _rand(rng, size):
+    if rng is None:
+        return np.random.rand(size)
+    return rng.random(size)
+
+class StartIndex(object):
+    """
+    Dense set of physical buffer slots that start a sequence window lying
+    within a single episode. Supports O(1) insertion and removal (removal
+    swaps the last entry into the freed position) and uniform sampling.
+    """
+
+    def __init__(self, allocated: int):
+        self.starts = np.zeros(allocated, dtype=np.int64)
+        self.positions = np.full(allocated, -1, dtype=np.int64)
+        self.n = 0
+
+    def resize(self, allocated: int):
+        old_allocated = self.starts.size
+        self.starts = np.concatenate(
+            (self.starts, np.zeros(allocated-old_allocated, dtype=np.int64)))
+        self.positions = np.concatenate(
+            (self.positions, np.full(allocated-old_allocated, -1, np.int64)))
+
+    def add(self, slot: int):
+        self.starts[self.n] = slot
+        self.positions[slot] = self.n
+        self.n += 1
+
+    def remove(self, slot: int):
+        position = self.positions[slot]
+        if position == -1:
+            return
+        last_slot = self.starts[self.n-1]
+        self.starts[position] = last_slot
+        self.positions[last_slot] = position
+        self.positions[slot] = -1
+        self.n -= 1
+
+    def sample(self, size: int, rng: np.random.Generator=None):
+        return self.starts[_randint(rng, self.n, size)]
+
+class ArrayReplayBuffer(object):
+    """
+    Replay buffer backed by one contiguous NumPy array per Transitions field,
+    used as a ring. Arrays are allocated on the first add (shapes are taken
+    from the first transition) and doubled until CAPACITY is reached, after
+    which the oldest slot is overwritten. Samples are gathered by fancy
+    indexing and returned in the same layout as ReplayBuffer.sample.
+
+    Each slot also records the episode it belongs to. For every sequence
+    length requested with no_terminals_in_sequence=True, a StartIndex of the
+    windows contained in one episode is built once and then kept up to date
+    as transitions are added and evicted.
+
+    With INTERN_OBS, every incoming observation is hashed once into an
+    ObservationTable and the obs/next_obs fields only hold int32 ids, which
+    are resolved with a single table gather at sample time, or left as ids
+    after set_resolve_obs(False).
+
+    OBS_CODEC names an entry of OBS_CODECS used to encode observations at
+    add time and decode whole batches at sample time. Environments suggest
+    the most compact lossless codec through their observation_codec method.
+
+    Latents passed to add are the encoder's (1, mem_len, latent) window of
+    recent latents. Only its newest entry is stored per slot, and the window
+    ending at each sampled slot is rebuilt at sample time from the slots
+    before it in the same episode (zeros before the episode start), scaled
+    as the encoder scales older entries (see set_latent_gamma). This assumes
+    the window advances by one step per added transition. The last mem_len-1
+    latents to leave the buffer (by eviction or flush) are kept aside, so the
+    windows of the oldest slots still hold their full history, as the deque
+    buffer's stored windows do; they are part of snapshots too.
+
+    The contents can be snapshotted with save and restored with load; see
+    save for the on-disk format.
+    """
+
+    def __init__(
+        self, capacity: int=None, initial_size: int=1024,
+        intern_obs: bool=False, obs_codec: str=None):
+
+        self._capacity = capacity
+        self._initial_size = initial_size
+        self._obs_table = ObservationTable() if intern_obs else None
+        self._resolve_obs = True
+        self._obs_codec_name = obs_codec
+        if obs_codec is None:
+            self._obs_codec = None
+        elif obs_codec in OBS_CODECS:
+            self._obs_codec = OBS_CODECS[obs_codec]()
+        else:
+            raise ValueError(f'Unknown observation codec {obs_codec}.')
+        self._arrays = None
+        self._allocated = 0
+        self._size = 0
+        self._next_idx = 0 # Physical slot that is written next
+        self._prev_obs = None
+        self._episode_ids = None
+        self._episode = 0
+        self._start_indices = {} # seq_len -> StartIndex
+        self._n_added = 0 # Transitions ever added, numbers them for snapshots
+        self._snapshot = None # What has already been written by save
+        self._latent_history = True # Store the newest latent of each window
+        self._latent_window = None
+        self._latent_gamma = None
+        self._evicted_latents = None # Newest mem_len-1 latents that left
+        self._evicted_episode_ids = None
+        self._rng = None # Global np.random unless set_rng is called
+
+    def __len__(self):
+        return self._size
+
+    def add_first(self, initial_timestep: dm_env.TimeStep):
+        self._prev_obs = self._store_obs(initial_timestep.observation)
+        self._episode += 1
+
+    def add(
+        self, action: int, timestep: dm_env.TimeStep, latent: torch.tensor):
+        self.add_fast(
+            action, timestep.observation, timestep.reward, timestep.discount,
+            timestep.last(), latent)
+
+    def add_fast(
+        self, action: int, obs: np.ndarray, reward: float, discount: float,
+        last: bool, latent: torch.tensor):
+        """ add, from the fields of an environment's step_fast. """
+
+        if latent != None:
+            latent = self._store_latent(latent)
+        if isinstance(action, torch.Tensor):
+            action = action.cpu().numpy()
+        next_obs = self._store_obs(obs)
+        self._append(
+            obs=self._prev_obs, action=action, reward=reward,
+            discount=discount, next_obs=next_obs, terminal=last,
+            latent=latent)
+        self._prev_obs = next_obs
+
+    def add_artificial_transition(
+        self, timestep: dm_env.TimeStep, next_timestep: dm_env.TimeStep,
+        action: int):
+        self._episode += 1 # Artificial transitions are not part of a sequence
+        self._append(
+            obs=self._store_obs(timestep.observation), action=action,
+            reward=next_timestep.reward, discount=next_timestep.discount,
+            next_obs=self._store_obs(next_timestep.observation),
+            terminal=next_timestep.last(), latent=None)
+        self._episode += 1
+
+    def set_latent_gamma(self, eligibility_gamma: float):
+        """
+        Sets the eligibility_gamma of the encoder producing the latents. At
+        every step the encoder scales the entry at window position t by
+        gamma**(t+1), so older entries of rebuilt windows get the product of
+        the scalings they went through.
+        """
+
+        self._latent_gamma = eligibility_gamma
+
+    def set_resolve_obs(self, resolve_obs: bool):
+        """
+        With RESOLVE_OBS False, sampled (and flushed) obs/next_obs fields are
+        the interned ids rather than the observations, e.g. for callers that
+        keep their own per-id data such as cached latents.
+        """
+
+        if (not resolve_obs) and (self._obs_table is None):
+            raise ValueError('Observation ids need intern_obs.')
+        self._resolve_obs = resolve_obs
+
+    def set_rng(self, rng: np.random.Generator):
+        """
+        Samples with RNG rather than the global np.random, e.g. so that the
+        seeds of an ensemble draw the same batches as when run alone.
+        """
+
+        self._rng = rng
+
+    def _store_latent(self, latent):
+        if not self._latent_history:
+            return latent.cpu().numpy()
+        self._latent_window = latent.shape[1]
+        return latent[0, -1].cpu().numpy() # (latent,)
+
+    def _latent_window_slots(self, slots):
+        """
+        Slots of the latent windows ending at SLOTS, (..., mem_len) from
+        oldest to newest, whether each lies in the same episode, and for
+        entries older than the oldest slot their row of _evicted_latents
+        (-1 for entries inside the buffer).
+        """
+
+        n_history = self._latent_window - 1
+        ages = np.arange(n_history, -1, -1)
+        oldest = (self._next_idx - self._size) % self._allocated
+        logical = (slots - oldest) % self._allocated
+        window_logical = logical[..., None] - ages
+        window_slots = self._physical(window_logical)
+        history = np.where(window_logical < 0, window_logical + n_history, -1)
+        episode_ids = self._episode_ids[window_slots]
+        if self._evicted_episode_ids is None:
+            episode_ids[history >= 0] = -1
+        else:
+            episode_ids = np.where(
+                history >= 0, self._evicted_episode_ids[history], episode_ids)
+        valid = episode_ids == self._episode_ids[slots][..., None]
+        return window_slots, valid, history
+
+    def _push_evicted_latents(self, slots):
+        """
+        Keeps the latents at SLOTS (oldest first), which are leaving the
+        buffer, among the newest mem_len-1 evicted ones.
+        """
+
+        n_history = self._latent_window - 1
+        if n_history == 0:
+            return
+        if self._evicted_latents is None:
+            self._evicted_latents = np.zeros(
+                (n_history,) + tuple(self._arrays['latent'].shape[1:]),
+                dtype=np.float32)
+            self._evicted_episode_ids = np.full(n_history, -1, dtype=np.int64)
+        slots = slots[-n_history:]
+        self._evicted_latents = np.concatenate((
+            self._evicted_latents[len(slots):],
+            self._read(self._arrays['latent'], slots)))
+        self._evicted_episode_ids = np.concatenate((
+            self._evicted_episode_ids[len(slots):], self._episode_ids[slots]))
+
+    def _scale_latent_windows(self, windows):
+        """ Applies the encoder's per-step scalings in place, oldest last. """
+
+        if self._latent_gamma is None:
+            return windows
+        window = self._latent_window
+        for age in range(1, window):
+            for step in range(age):
+                windows[..., window-1-age, :] *= np.float32(
+                    self._latent_gamma**(window-step))
+        return windows
+
+    def _store_obs(self, obs):
+        """ Converts an observation into the form kept in the obs arrays. """
+
+        if self._obs_codec is not None:
+            obs = self._obs_codec.encode(obs)
+        if self._obs_table is not None:
+            return self._obs_table.intern(obs)
+        return obs
+
+    def _load_obs(self, stored_obs, stored_next_obs):
+        """ Inverse of _store_obs over gathered obs and next_obs entries. """
+
+        if not self._resolve_obs:
+            return stored_obs, stored_next_obs
+        if self._obs_table is not None:
+            obs = self._obs_table.lookup(
+                np.stack((stored_obs, stored_next_obs)))
+            stored_obs, stored_next_obs = obs[0], obs[1]
+        if self._obs_codec is not None:
+            stored_obs = self._obs_codec.decode(stored_obs)
+            stored_next_obs = self._obs_codec.decode(stored_next_obs)
+        return stored_obs, stored_next_obs
+
+    def _append(self, **fields):
+        fields['action'] = np.reshape(fields['action'], (1,)) # (1,)
+        if self._arrays is None:
+            self._init_arrays(fields)
+        elif (fields['latent'] is None) != (self._arrays['latent'] is None):
+            raise ValueError('Latents must be given for all or no transitions.')
+        if self._size == self._allocated:
+            if self._capacity is None or self._allocated < self._capacity:
+                self._grow()
+        slot = self._next_idx
+        if self._size == self._allocated: # Evict the oldest transition
+            for start_index in self._start_indices.values():
+                start_index.remove(slot)
+            if self._latent_history and self._arrays['latent'] is not None:
+                self._push_evicted_latents(np.array([slot]))
+        for name, array in self._arrays.items():
+            if array is not None:
+                self._write(array, slot, fields[name])
+        self._episode_ids[slot] = self._episode
+        self._next_idx = (slot + 1) % self._allocated
+        self._size = min(self._size + 1, self._allocated)
+        self._n_added += 1
+        if fields['terminal']:
+            self._episode += 1
+
+        # The window ending at the new transition is now complete
+        for seq_len, start_index in self._start_indices.items():
+            if self._size < seq_len:
+                continue
+            start_slot = self._physical(self._size - seq_len)
+            if self._episode_ids[start_slot] == self._episode_ids[slot]:
+                start_index.add(start_slot)
+
+    def _init_arrays(self, fields):
+        if self._capacity is None:
+            self._allocated = self._initial_size
+        else:
+            self._allocated = min(self._initial_size, self._capacity)
+        dtypes = {
+            'obs': np.asarray(fields['obs']).dtype, 'action': np.int64,
+            'reward': np.float32, 'discount': np.float32,
+            'next_obs': np.asarray(fields['next_obs']).dtype,
+            'terminal': bool, 'latent': np.float32}
+        self._arrays = {}
+        for name in Transitions._fields:
+            if fields[name] is None:
+                self._arrays[name] = None
+            else:
+                shape = np.shape(fields[name])
+                self._arrays[name] = self._allocate(name, shape, dtypes[name])
+        self._episode_ids = self._allocate('episode_id', (), np.int64)
+
+    def _allocate(self, name, shape, dtype):
+        return np.zeros((self._allocated,) + shape, dtype=dtype)
+
+    def _write(self, array, slot, value):
+        array[slot] = value
+
+    def _read(self, array, slots):
+        """ Host copy of ARRAY at SLOTS. """
+
+        return np.asarray(array[slots])
+
+    def _grow(self):
+        """ Doubles the allocated slots. Only called before the ring wraps. """
+
+        old_allocated = self._allocated
+        self._allocated = old_allocated * 2
+        if self._capacity is not None:
+            self._allocated = min(self._allocated, self._capacity)
+        for name, array in self._arrays.items():
+            if array is None:
+                continue
+            new_array = self._allocate(name, array.shape[1:], array.dtype)
+            new_array[:old_allocated] = array
+            self._arrays[name] = new_array
+        new_episode_ids = self._allocate('episode_id', (), np.int64)
+        new_episode_ids[:old_allocated] = self._episode_ids
+        self._episode_ids = new_episode_ids
+        for start_index in self._start_indices.values():
+            start_index.resize(self._allocated)
+        self._next_idx = old_allocated
+
+    def _physical(self, logical_indices):
+        """ Maps indices ordered from oldest (0) to newest to array slots. """
+
+        oldest = (self._next_idx - self._size) % self._allocated
+        return (oldest + logical_indices) % self._allocated
+
+    def _gather(self, slots) -> Transitions:
+        batch = {
+            name: None if array is None else array[slots]
+            for name, array in self._arrays.items()}
+        if self._latent_history and batch['latent'] is not None:
+            window_slots, valid, history = self._latent_window_slots(slots)
+            windows = np.where(
+                valid[..., None], self._arrays['latent'][window_slots], 0)
+            windows = windows.astype(np.float32)
+            evicted = valid & (history >= 0)
+            if evicted.any():
+                windows[evicted] = self._evicted_latents[history[evicted]]
+            windows = self._scale_latent_windows(windows)
+            batch['latent'] = windows[..., None, :, :] # (..., 1, mem_len, z)
+        batch['obs'], batch['next_obs'] = self._load_obs(
+            batch['obs'], batch['next_obs'])
+        return Transitions(**batch)
+
+    def _get_start_index(self, seq_len: int) -> StartIndex:
+        """ Returns the StartIndex for SEQ_LEN, building it on first use. """
+
+        if seq_len not in self._start_indices:
+            start_index = StartIndex(self._allocated)
+            n_starts = self._size - seq_len + 1
+            if n_starts > 0:
+                episode_ids = self._episode_ids[
+                    self._physical(np.arange(self._size))]
+                valid = episode_ids[:n_starts] == episode_ids[seq_len-1:]
+                valid_slots = self._physical(np.flatnonzero(valid))
+                start_index.starts[:valid_slots.size] = valid_slots
+                start_index.positions[valid_slots] = np.arange(valid_slots.size)
+                start_index.n = valid_slots.size
+            self._start_indices[seq_len] = start_index
+        return self._start_indices[seq_len]
+
+    def sample(
+        self, batch_size: int, seq_len: int=1,
+        no_terminals_in_sequence: bool=False,
+        return_indices: bool=False) -> Transitions:
+        """
+        Sample a random batch of Transitions. If SEQ_LEN > 1, a list of SEQ_LEN
+        Transitions is returned, where the ith entry holds the ith step of
+        every sampled window. With NO_TERMINALS_IN_SEQUENCE, windows are only
+        drawn from within a single episode. With RETURN_INDICES, the sampled
+        buffer slots, (N,) or (N, seq_len), are returned as well.
+        """
+
+        slots = self._sample_slots(
+            batch_size, seq_len, no_terminals_in_sequence)
+        batch = self._split_sequence(self._gather(slots), seq_len)
+        if return_indices:
+            return batch, slots
+        return batch
+
+    def sample_many(
+        self, n_batches: int, batch_size: int, seq_len: int=1,
+        no_terminals_in_sequence: bool=False, return_indices: bool=False):
+        """
+        N_BATCHES independent batches, each drawn as by sample but gathered
+        from the buffer in a single pass. Returns a list with what sample
+        would have returned for each.
+        """
+
+        if n_batches == 1:
+            return [self.sample(
+                batch_size, seq_len, no_terminals_in_sequence, return_indices)]
+        slots = np.concatenate([
+            self._sample_slots(batch_size, seq_len, no_terminals_in_sequence)
+            for _ in range(n_batches)])
+        gathered = self._gather(slots)
+        batches = []
+        for i in range(n_batches):
+            rows = slice(i*batch_size, (i+1)*batch_size)
+            batch = type(gathered)(
+                *[None if f is None else f[rows] for f in gathered])
+            batch = self._split_sequence(batch, seq_len)
+            batches.append((batch, slots[rows]) if return_indices else batch)
+        return batches
+
+    def _split_sequence(self, batch, seq_len):
+        """ Turns (N, seq_len, ...) fields into a list of per-step batches. """
+
+        if seq_len == 1:
+            return batch
+        return [
+            type(batch)(*[None if f is None else f[:, t] for f in batch])
+            for t in range(seq_len)]
+
+    def _sample_slots(self, batch_size, seq_len, no_terminals_in_sequence):
+        n_items = self._size
+        if seq_len > 1:
+            if no_terminals_in_sequence:
+                start_index = self._get_start_index(seq_len)
+                if start_index.n == 0:
+                    raise ValueError('No valid sequences in the buffer.')
+                start_slots = start_index.sample(batch_size, self._rng)
+            else: # Same draws as ReplayBuffer, whose newest start is n-seq_len-1
+                start_slots = self._physical(
+                    _randint(self._rng, n_items-seq_len, batch_size))
+            return (start_slots[:, None] + np.arange(seq_len)) \
+                % self._allocated # (N, seq_len)
+        else:
+            random = np.random if self._rng is None else self._rng
+            start_indices = random.choice(n_items, size=batch_size)
+            return self._physical(start_indices)
+
+    def flush(self) -> Transitions:
+        slots = self._physical(np.arange(self._size))
+        entire_buffer = self._gather(slots)
+        if self._latent_history and self._size > 0 \
+            and self._arrays['latent'] is not None:
+            self._push_evicted_latents(slots)
+        self._size = 0
+        self._next_idx = 0
+        self._start_indices = {}
+        return entire_buffer
+
+    def is_ready(self, batch_size: int, seq_len: int) -> bool:
+        return max(batch_size, seq_len) <= self._size
+
+    @property
+    def interns_obs(self):
+        return self._obs_table is not None
+
+    def get_obs_ids(self, slots):
+        """ Interned ids of the (obs, next_obs) stored at SLOTS. """
+
+        if self._obs_table is None:
+            raise ValueError('Observation ids need intern_obs.')
+        return (
+            self._read(self._arrays['obs'], slots),
+            self._read(self._arrays['next_obs'], slots))
+
+    def get_interned_obs(self, start: int=0):
+        """ Decoded observations of the ObservationTable from id START on. """
+
+        if self._obs_table is None:
+            raise ValueError('Observation ids need intern_obs.')
+        rows = self._obs_table.table[start:]
+        if self._obs_codec is not None:
+            rows = self._obs_codec.decode(rows)
+        return rows
+
+    def save(self, path: str):
+        """
+        Snapshots the buffer into the directory PATH. Transitions are
+        numbered in the order they were added, and every field (plus the
+        episode ids) is stored as .npy chunks named {field}_{first number}.
+        Repeated saves to the same PATH only write a chunk for the
+        transitions added since the previous save, and delete chunks that
+        have left the ring. Rows added to the ObservationTable are written
+        the same way. meta.json is replaced last, so an interrupted save
+        leaves the previous snapshot readable. PATH should be reserved for
+        the snapshot, as unreferenced .npy files in it are removed.
+        """
+
+        path = os.path.abspath(path)
+        os.makedirs(path, exist_ok=True)
+        if self._snapshot is None or self._snapshot['path'] != path:
+            self._snapshot = {
+                'path': path, 'saved': 0, 'chunks': [], 'table_chunks': []}
+        snapshot = self._snapshot
+        arrays = {} if self._arrays is None else dict(
+            self._arrays, episode_id=self._episode_ids)
+        arrays = {name: a for name, a in arrays.items() if a is not None}
+        first = self._n_added - self._size
+        start = max(snapshot['saved'], first)
+        if self._n_added > start:
+            slots = self._physical(np.arange(start - first, self._size))
+            for name, array in arrays.items():
+                np.save(
+                    os.path.join(path, f'{name}_{start}.npy'),
+                    self._read(array, slots))
+            snapshot['chunks'].append([start, self._n_added])
+        snapshot['chunks'] = [c for c in snapshot['chunks'] if c[1] > first]
+        snapshot['saved'] = self._n_added
+        table_rows = sum(r1 - r0 for r0, r1 in snapshot['table_chunks'])
+        if self._obs_table is not None and len(self._obs_table) > table_rows:
+            np.save(
+                os.path.join(path, f'obs_table_{table_rows}.npy'),
+                self._obs_table.table[table_rows:])
+            snapshot['table_chunks'].append([table_rows, len(self._obs_table)])
+
+        meta = {
+            'n_added': self._n_added, 'size': self._size,
+            'episode': self._episode, 'obs_codec': self._obs_codec_name,
+            'obs_codec_state': self._obs_codec.get_state()
+                if hasattr(self._obs_codec, 'get_state') else None,
+            'latent_window': self._latent_window,
+            'evicted_latents': None if self._evicted_latents is None
+                else self._evicted_latents.tolist(),
+            'evicted_episode_ids': None if self._evicted_episode_ids is None
+                else self._evicted_episode_ids.tolist(),
+            'intern_obs': self._obs_table is not None,
+            'fields': {
+                name: [str(a.dtype).replace('torch.', ''), list(a.shape[1:])]
+                for name, a in arrays.items()},
+            'chunks': snapshot['chunks'],
+            'table_chunks': snapshot['table_chunks']}
+        with open(os.path.join(path, 'meta.json.tmp'), 'w') as f:
+            json.dump(meta, f)
+        os.replace(
+            os.path.join(path, 'meta.json.tmp'),
+            os.path.join(path, 'meta.json'))
+        referenced = {f'obs_table_{r0}.npy' for r0, _ in meta['table_chunks']}
+        for name in meta['fields']:
+            referenced.update(f'{name}_{c0}.npy' for c0, _ in meta['chunks'])
+        for filename in os.listdir(path):
+            if filename.endswith('.npy') and filename not in referenced:
+                os.remove(os.path.join(path, filename))
+
+    def load(self, path: str):
+        """
+        Replaces the contents of the buffer with the snapshot in PATH (see
+        save). Chunks are memory-mapped and copied into freshly allocated
+        arrays; if the snapshot holds more transitions than CAPACITY, only
+        the newest are kept (and the last mem_len-1 dropped latents join the
+        evicted ones). Later saves to PATH continue incrementally.
+        """
+
+        path = os.path.abspath(path)
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['obs_codec'] != self._obs_codec_name:
+            raise ValueError(
+                f'Snapshot uses obs codec {meta["obs_codec"]}, '
+                f'buffer uses {self._obs_codec_name}.')
+        if meta['intern_obs'] != (self._obs_table is not None):
+            raise ValueError('Snapshot and buffer disagree on intern_obs.')
+        if hasattr(self._obs_codec, 'set_state'):
+            self._obs_codec.set_state(meta.get('obs_codec_state'))
+
+        n_added = meta['n_added']
+        size = meta['size']
+        if self._capacity is not None:
+            size = min(size, self._capacity)
+        first = n_added - size
+        n_history = (meta['latent_window'] or 1) - 1
+        evicted = {
+            'latent': meta.get('evicted_latents'),
+            'episode_id': meta.get('evicted_episode_ids')}
+        self._arrays = None
+        self._episode_ids = None
+        self._allocated = 0
+        if meta['fields']:
+            self._allocated = max(self._initial_size, size)
+            if self._capacity is not None:
+                self._allocated = min(self._allocated, self._capacity)
+            self._arrays = {name: None for name in Transitions._fields}
+        for name, (dtype, shape) in meta['fields'].items():
+            array = self._allocate(name, tuple(shape), np.dtype(dtype))
+            offset = 0
+            dropped = []
+            for c0, c1 in meta['chunks']:
+                if c1 <= first - n_history:
+                    continue
+                chunk = np.load(
+                    os.path.join(path, f'{name}_{c0}.npy'), mmap_mode='c')
+                dropped.append(chunk[
+                    max(first - n_history, meta['n_added'] - meta['size'], c0)
+                    - c0:max(first - c0, 0)])
+                if c1 <= first:
+                    continue
+                chunk = chunk[max(first - c0, 0):]
+                self._write(array, slice(offset, offset + len(chunk)), chunk)
+                offset += len(chunk)
+            if name == 'episode_id':
+                self._episode_ids = array
+            else:
+                self._arrays[name] = array
+            if (name in evicted) and (n_history > 0):
+                if evicted[name] is None:
+                    evicted[name] = np.full(
+                        (n_history,) + tuple(shape),
+                        -1 if name == 'episode_id' else 0, dtype=dtype)
+                evicted[name] = np.concatenate(
+                    [np.asarray(evicted[name], dtype=np.dtype(dtype))]
+                    + dropped)[-n_history:]
+        if self._obs_table is not None:
+            self._obs_table = ObservationTable()
+            for r0, _ in meta['table_chunks']:
+                rows = np.load(
+                    os.path.join(path, f'obs_table_{r0}.npy'), mmap_mode='c')
+                for row in rows:
+                    self._obs_table.intern(row)
+
+        self._size = size
+        self._next_idx = size % max(self._allocated, 1)
+        self._episode = meta['episode']
+        self._latent_window = meta['latent_window']
+        self._evicted_latents = None
+        self._evicted_episode_ids = None
+        if self._latent_history and ('latent' in meta['fields']) \
+            and (n_history > 0):
+            self._evicted_latents = evicted['latent']
+            self._evicted_episode_ids = evicted['episode_id']
+        self._n_added = n_added
+        self._prev_obs = None
+        self._start_indices = {}
+        self._snapshot = {
+            'path': path, 'saved': n_added,
+            'chunks': [c for c in meta['chunks'] if c[1] > first],
+            'table_chunks': meta['table_chunks']}
+
+class MemmapReplayBuffer(ArrayReplayBuffer):
+    """
+    ArrayReplayBuffer whose field arrays are np.memmap files in a private
+    directory under SCRATCH_DIR (default: $TMPDIR), so capacity is bounded by
+    local disk rather than RAM. All CAPACITY slots are mapped up front; the
+    files are sparse and pages are only read in for the sampled slots. The
+    directory is removed when the buffer is garbage collected or closed.
+    """
+
+    def __init__(
+        self, capacity: int, scratch_dir: str=None, **kwargs):
+
+        if capacity is None:
+            raise ValueError('Memory-mapped replay needs a finite capacity.')
+        super().__init__(capacity, initial_size=capacity, **kwargs)
+        if scratch_dir is None:
+            scratch_dir = os.environ.get('TMPDIR', tempfile.gettempdir())
+        os.makedirs(scratch_dir, exist_ok=True)
+        self._scratch_dir = tempfile.mkdtemp(prefix='replay_', dir=scratch_dir)
+        self._finalizer = weakref.finalize(
+            self, shutil.rmtree, self._scratch_dir, ignore_errors=True)
+
+    def _allocate(self, name, shape, dtype):
+        return np.memmap(
+            os.path.join(self._scratch_dir, f'{name}.dat'), mode='w+',
+            dtype=dtype, shape=(self._allocated,) + shape)
+
+    def close(self):
+        self._arrays = None
+        self._episode_ids = None
+        self._finalizer()
+
+class TorchReplayBuffer(ArrayReplayBuffer):
+    """
+    ArrayReplayBuffer whose field arrays are preallocated torch tensors on
+    DEVICE. Batches are gathered with index_select into output tensors that
+    are allocated once per batch shape and reused, and come back as
+    TensorTransitions with rewards/terminals as float tensors and the one-hot
+    actions already built. Returned tensors are overwritten by the next call
+    to sample, unless N_OUTPUT_SETS is raised so that that many consecutive
+    batches stay alive (as the BatchPrefetcher does). Interned observations
+    are resolved through a copy of the ObservationTable kept on DEVICE.
+    Observation codecs are not supported.
+    """
+
+    def __init__(
+        self, capacity: int=None, device: torch.device=torch.device('cpu'),
+        n_actions: int=None, **kwargs):
+
+        if kwargs.get('obs_codec') is not None:
+            raise ValueError('Torch replay does not support obs codecs.')
+        if n_actions is None:
+            raise ValueError('Torch replay needs n_actions for one-hots.')
+        super().__init__(capacity, **kwargs)
+        self._device = torch.device(device)
+        self._n_actions = n_actions
+        self._outputs = {}
+        self._device_table = None
+        self.n_output_sets = 1
+        self._output_set = 0
+
+    def _allocate(self, name, shape, dtype):
+        if name == 'episode_id': # Bookkeeping stays on the host
+            return super()._allocate(name, shape, dtype)
+        if name == 'terminal':
+            dtype = torch.float32
+        elif not isinstance(dtype, torch.dtype):
+            dtype = torch.from_numpy(np.zeros(0, dtype=dtype)).dtype
+        return torch.zeros(
+            (self._allocated,) + tuple(shape), dtype=dtype, device=self._device)
+
+    def _write(self, array, slot, value):
+        array[slot] = torch.as_tensor(np.asarray(value))
+
+    def _read(self, array, slots):
+        if not isinstance(array, torch.Tensor):
+            return super()._read(array, slots)
+        return array[torch.as_tensor(slots, device=self._device)].cpu().numpy()
+
+    def load(self, path: str):
+        super().load(path)
+        self._device_table = None
+
+    def _get_output(self, name, shape, dtype):
+        key = (self._output_set, name, shape)
+        if key not in self._outputs:
+            self._outputs[key] = torch.empty(
+                shape, dtype=dtype, device=self._device)
+        return self._outputs[key]
+
+    def _index_select(self, name, source, index):
+        out = self._get_output(
+            name, (index.numel(),) + tuple(source.shape[1:]), source.dtype)
+        return torch.index_select(source, 0, index, out=out)
+
+    def _gather(self, slots) -> TensorTransitions:
+        slots = np.asarray(slots)
+        self._output_set = (self._output_set + 1) % self.n_output_sets
+        index = torch.as_tensor(slots.reshape(-1), device=self._device)
+        batch = {}
+        for name, array in self._arrays.items():
+            if array is None:
+                batch[name] = None
+                continue
+            batch[name] = self._index_select(name, array, index)
+        if (self._obs_table is not None) and self._resolve_obs:
+            if (self._device_table is None) \
+                or (self._device_table.shape[0] != len(self._obs_table)):
+                self._device_table = torch.as_tensor(
+                    self._obs_table.table, device=self._device)
+            for name in ['obs', 'next_obs']:
+                batch[name] = self._index_select(
+                    f'{name}_table', self._device_table, batch[name])
+        if batch['latent'] is not None:
+            window_slots, valid, history = self._latent_window_slots(
+                slots.reshape(-1))
+            windows = self._index_select(
+                'latent_window', self._arrays['latent'],
+                torch.as_tensor(window_slots.reshape(-1), device=self._device))
+            windows = windows.view(window_slots.shape + windows.shape[1:])
+            windows.masked_fill_(
+                torch.as_tensor(~valid, device=self._device)[..., None], 0.)
+            evicted = valid & (history >= 0)
+            if evicted.any():
+                windows[torch.as_tensor(evicted, device=self._device)] = \
+                    torch.as_tensor(
+                        self._evicted_latents[history[evicted]],
+                        device=self._device)
+            batch['latent'] = self._scale_latent_windows(windows).unsqueeze(1)
+        onehot_action = self._get_output(
+            'onehot_action', (index.numel(), self._n_actions), torch.float32)
+        onehot_action.zero_()
+        onehot_action.scatter_(1, batch['action'].view(-1, 1), 1.)
+        batch['onehot_action'] = onehot_action
+        for name, value in batch.items():
+            if value is not None:
+                batch[name] = value.view(slots.shape + value.shape[1:])
+        return TensorTransitions(**batch)
+
+class SumTree(object):
+    """
+    Array-based binary sum-tree over CAPACITY leaves (rounded up to a power
+    of two). Node i has children 2i and 2i+1, the root is node 1 and leaf j
+    is node CAPACITY+j. Updates and proportional lookups are vectorized over
+    a batch and walk the tree one level at a time, so both cost O(log n)
+    NumPy operations per batch.
+    """
+
+    def __init__(self, capacity: int):
+        self._depth = max(int(np.ceil(np.log2(max(capacity, 1)))), 0)
+        self._capacity = 2**self._depth
+        self._tree = np.zeros(2*self._capacity, dtype=np.float64)
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def total(self):
+        return self._tree[1]
+
+    def get(self, leaves):
+        return self._tree[self._capacity + leaves]
+
+    def update(self, leaves, priorities):
+        nodes = self._capacity + np.asarray(leaves)
+        self._tree[nodes] = priorities
+        for _ in range(self._depth):
+            nodes = np.unique(nodes // 2)
+            self._tree[nodes] = self._tree[2*nodes] + self._tree[2*nodes+1]
+
+    def find(self, values):
+        """
+        Leaves whose cumulative priority interval contains VALUES, which are
+        bounded below the total. The descent never enters a subtree without
+        priority, so round-off in the running differences cannot reach an
+        empty leaf.
+        """
+
+        values = np.minimum(
+            np.array(values, dtype=np.float64), np.nextafter(self.total, 0))
+        nodes = np.ones(values.size, dtype=np.int64)
+        for _ in range(self._depth):
+            left = self._tree[2*nodes]
+            go_right = (values >= left) & (self._tree[2*nodes+1] > 0)
+            values -= left * go_right
+            nodes = 2*nodes + go_right
+        return nodes - self._capacity
+
+    def resize(self, capacity: int):
+        leaves = self._tree[self._capacity:].copy()
+        self.__init__(capacity)
+        self.update(np.arange(leaves.size), leaves)
+
+class PrioritizedReplayBuffer(ArrayReplayBuffer):
+    """
+    ArrayReplayBuffer with proportional prioritized sampling (Schaul et al.
+    2016). Each slot has priority (|error| + EPSILON)**ALPHA, stored in a
+    SumTree; new transitions get the largest priority seen so far. Sampling
+    is stratified over BATCH_SIZE equal segments of the total priority.
+    Learners read importance weights with get_importance_weights and feed
+    back per-sample errors with update_priorities, both keyed by the slots
+    returned by sample(..., return_indices=True). Only single-step sampling
+    is supported.
+    """
+
+    def __init__(
+        self, capacity: int=None, alpha: float=0.6, beta: float=0.4,
+        epsilon: float=1e-6, **kwargs):
+
+        super().__init__(capacity, **kwargs)
+        self._alpha = alpha
+        self._beta = beta
+        self._epsilon = epsilon
+        self._sum_tree = SumTree(1)
+        self._max_priority = 1.
+
+    def _append(self, **fields):
+        super()._append(**fields)
+        if self._sum_tree.capacity < self._allocated:
+            self._sum_tree.resize(self._allocated)
+        slot = (self._next_idx - 1) % self._allocated
+        self._sum_tree.update([slot], self._max_priority**self._alpha)
+
+    def _sample_slots(self, batch_size, seq_len, no_terminals_in_sequence):
+        if seq_len > 1:
+            raise ValueError('Prioritized replay only supports seq_len=1.')
+        segment = self._sum_tree.total / batch_size
+        values = (np.arange(batch_size) + _rand(self._rng, batch_size)) \
+            * segment
+        return self._sum_tree.find(values)
+
+    def get_importance_weights(self, slots):
+        """ Importance weights of SLOTS, normalized by their maximum. """
+
+        probs = self._sum_tree.get(slots) / self._sum_tree.total
+        weights = (self._size * probs) ** (-self._beta)
+        return (weights / weights.max()).astype(np.float32)
+
+    def update_priorities(self, slots, errors):
+        priorities = np.abs(errors) + self._epsilon
+        self._max_priority = max(self._max_priority, priorities.max())
+        self._sum_tree.update(slots, priorities**self._alpha)
+
+    def flush(self) -> Transitions:
+        entire_buffer = super().flush()
+        self._sum_tree = SumTree(self._allocated)
+        return entire_buffer
+
+    def load(self, path: str):
+        """ As ArrayReplayBuffer.load; restored slots get the max priority. """
+
+        super().load(path)
+        self._sum_tree = SumTree(self._allocated)
+        self._sum_tree.update(
+            np.arange(self._size), self._max_priority**self._alpha)
+
+class CountedReplayBuffer(object):
+    """
+    Replay buffer for small deterministic tasks that stores each distinct
+    (obs, action, reward, discount, next_obs, terminal) transition once,
+    together with the number of times it occurs among the last CAPACITY
+    added transitions. A ring of int32 transition ids tracks that recency
+    window, so counts are decremented exactly when a FIFO buffer would evict.
+    Sampling proportionally to the counts matches uniform sampling from a
+    FIFO buffer, at a cost that scales with the number of distinct
+    transitions. Only single-step sampling without latents is supported.
+    """
+
+    def __init__(self, capacity: int=None, initial_size: int=256):
+        self._capacity = capacity
+        self._initial_size = initial_size
+        self._obs_table = ObservationTable()
+        self._transition_ids = {}
+        self._unique = None
+        self._counts = np.zeros(initial_size, dtype=np.int64)
+        self._n_unique = 0
+        self._recent = np.zeros(
+            initial_size if capacity is None else capacity, dtype=np.int32)
+        self._size = 0
+        self._next_idx = 0
+        self._prev_obs = None
+        self._rng = None # Global np.random unless set_rng is called
+
+    def __len__(self):
+        return self._size
+
+    def set_rng(self, rng: np.random.Generator):
+        """ Samples with RNG rather than the global np.random. """
+        self._rng = rng
+
+    @property
+    def n_unique(self):
+        return int(np.count_nonzero(self._counts[:self._n_unique]))
+
+    def add_first(self, initial_timestep: dm_env.TimeStep):
+        self._prev_obs = self._obs_table.intern(initial_timestep.observation)
+
+    def add(
+        self, action: int, timestep: dm_env.TimeStep, latent: torch.tensor):
+        self.add_fast(
+            action, timestep.observation, timestep.reward, timestep.discount,
+            timestep.last(), latent)
+
+    def add_fast(
+        self, action: int, obs: np.ndarray, reward: float, discount: float,
+        last: bool, latent: torch.tensor):
+        """ add, from the fields of an environment's step_fast. """
+
+        if latent != None:
+            raise ValueError('Counted replay does not store latents.')
+        if isinstance(action, torch.Tensor):
+            action = action.cpu().numpy()
+        next_obs = self._obs_table.intern(obs)
+        self._append(self._prev_obs, action, reward, discount, next_obs, last)
+        self._prev_obs = next_obs
+
+    def add_artificial_transition(
+        self, timestep: dm_env.TimeStep, next_timestep: dm_env.TimeStep,
+        action: int):
+        self._append(
+            self._obs_table.intern(timestep.observation), action,
+            next_timestep.reward, next_timestep.discount,
+            self._obs_table.intern(next_timestep.observation),
+            next_timestep.last())
+
+    def _append(self, obs, action, reward, discount, next_obs, terminal):
+        action = int(np.reshape(action, (1,))[0])
+        # Rewards are keyed at their stored float32 precision, so step and
+        # step_fast rewards of the same transition share one entry
+        key = (
+            int(obs), action, float(np.float32(reward)), float(discount),
+            int(next_obs), bool(terminal))
+        transition_id = self._transition_ids.get(key)
+        if transition_id is None:
+            transition_id = self._add_unique(key)
+
+        # Evict the oldest transition of the recency window if needed
+        if self._size == self._recent.size:
+            if self._capacity is None: # Unroll oldest-first, then double
+                self._recent = np.concatenate((
+                    self._recent[self._next_idx:],
+                    self._recent[:self._next_idx],
+                    np.zeros_like(self._recent)))
+                self._next_idx = self._size
+            else:
+                self._counts[self._recent[self._next_idx]] -= 1
+        self._recent[self._next_idx] = transition_id
+        self._counts[transition_id] += 1
+        self._next_idx = (self._next_idx + 1) % self._recent.size
+        self._size = min(self._size + 1, self._recent.size)
+
+    def _add_unique(self, key) -> int:
+        if self._unique is None:
+            self._unique = {
+                'obs': np.zeros(self._initial_size, dtype=np.int32),
+                'action': np.zeros((self._initial_size, 1), dtype=np.int64),
+                'reward': np.zeros(self._initial_size, dtype=np.float32),
+                'discount': np.zeros(self._initial_size, dtype=np.float32),
+                'next_obs': np.zeros(self._initial_size, dtype=np.int32),
+                'terminal': np.zeros(self._initial_size, dtype=bool)}
+        elif self._n_unique == self._counts.size:
+            for name, array in self._unique.items():
+                self._unique[name] = np.concatenate(
+                    (array, np.zeros_like(array)))
+            self._counts = np.concatenate(
+                (self._counts, np.zeros_like(self._counts)))
+        transition_id = self._n_unique
+        for name, value in zip(self._unique.keys(), key):
+            self._unique[name][transition_id] = value
+        self._transition_ids[key] = transition_id
+        self._n_unique += 1
+        return transition_id
+
+    def _gather(self, transition_ids) -> Transitions:
+        batch = {
+            name: array[transition_ids] for name, array in self._unique.items()}
+        obs = self._obs_table.lookup(
+            np.stack((batch['obs'], batch['next_obs'])))
+        batch['obs'], batch['next_obs'] = obs[0], obs[1]
+        return Transitions(latent=None, **batch)
+
+    def sample(
+        self, batch_size: int, seq_len: int=1,
+        no_terminals_in_sequence: bool=False) -> Transitions:
+        ''' Sample transitions in proportion to their counts. '''
+
+        if seq_len > 1:
+            raise ValueError('Counted replay only supports seq_len=1.')
+        cumulative_counts = np.cumsum(self._counts[:self._n_unique])
+        draws = _randint(self._rng, self._size, batch_size)
+        transition_ids = np.searchsorted(cumulative_counts, draws, side='right')
+        return self._gather(transition_ids)
+
+    def sample_many(
+        self, n_batches: int, batch_size: int, seq_len: int=1,
+        no_terminals_in_sequence: bool=False):
+        ''' N_BATCHES batches as from sample, gathered in a single pass. '''
+
+        batch = self.sample(n_batches*batch_size, seq_len)
+        return [
+            Transitions(*[
+                None if f is None else f[i*batch_size:(i+1)*batch_size]
+                for f in batch])
+            for i in range(n_batches)]
+
+    def flush(self) -> Transitions:
+        oldest = (self._next_idx - self._size) % self._recent.size
+        recent = self._recent[
+            (oldest + np.arange(self._size)) % self._recent.size]
+        entire_buffer = self._gather(recent)
+        self._counts[:] = 0
+        self._size = 0
+        self._next_idx = 0
+        return entire_buffer
+
+    def is_ready(self, batch_size: int, seq_len: int) -> bool:
+        return max(batch_size, seq_len) <= self._size
+
+class SharedReplayMemory(object):
+    """
+    Storage for SharedReplayBuffer: one multiprocessing RawArray per
+    Transitions field, split into N_ACTORS sub-rings of CAPACITY // N_ACTORS
+    slots, plus one write counter per sub-ring. Field shapes and dtypes are
+    taken from an example OBS and LATENT (None if latents are not stored).
+    Must be created before the actor processes and handed to them as a
+    Process argument.
+    """
+
+    def __init__(self, n_actors: int, capacity: int, obs, latent=None):
+        self.n_actors = n_actors
+        self.ring_size = capacity // n_actors
+        if self.ring_size < 1:
+            raise ValueError('Capacity must be at least one slot per actor.')
+        obs = np.asarray(obs)
+        self.field_specs = {
+            'obs': (obs.shape, obs.dtype), 'next_obs': (obs.shape, obs.dtype),
+            'action': ((1,), np.dtype(np.int64)),
+            'reward': ((), np.dtype(np.float32)),
+            'discount': ((), np.dtype(np.float32)),
+            'terminal': ((), np.dtype(bool)),
+            'latent': None if latent is None \
+                else (tuple(np.shape(latent)), np.dtype(np.float32))}
+        n_slots = n_actors * self.ring_size
+        self._raw = {}
+        for name, spec in self.field_specs.items():
+            if spec is not None:
+                shape, dtype = spec
+                n_bytes = n_slots * int(np.prod(shape)) * dtype.itemsize
+                self._raw[name] = multiprocessing.sharedctypes.RawArray(
+                    'b', n_bytes)
+        self._raw_counts = multiprocessing.sharedctypes.RawArray('q', n_actors)
+
+    def arrays(self):
+        """ NumPy views of every field, (n_actors * ring_size, ...). """
+
+        arrays = {}
+        for name, spec in self.field_specs.items():
+            if spec is None:
+                arrays[name] = None
+                continue
+            shape, dtype = spec
+            arrays[name] = np.frombuffer(self._raw[name], dtype=dtype).reshape(
+                (self.n_actors * self.ring_size,) + shape)
+        return arrays
+
+    def counts(self):
+        """ Transitions ever written by each actor. """
+
+        return np.frombuffer(self._raw_counts, dtype=np.int64)
+
+class SharedReplayBuffer(ArrayReplayBuffer):
+    """
+    ArrayReplayBuffer over a SharedReplayMemory, for an actor/learner split
+    across processes. With ACTOR_ID, the buffer is a writer that only
+    appends to that actor's sub-ring; each sub-ring has a single writer, so
+    no locks are taken. A writer fills the slot first and then bumps its
+    counter, so readers only see complete transitions. Without ACTOR_ID,
+    the buffer is the learner's reader and samples windows within one
+    sub-ring, skipping the GUARD oldest slots of each full sub-ring, which
+    the actor is about to overwrite. CAPACITY is fixed by the memory and
+    ignored here. Observations are stored as given; interning, codecs,
+    flushing and snapshots are not supported.
+    """
+
+    def __init__(
+        self, capacity: int=None, memory: SharedReplayMemory=None,
+        actor_id: int=None, guard: int=16):
+
+        if memory is None:
+            raise ValueError('Shared replay needs a SharedReplayMemory.')
+        super().__init__(memory.n_actors * memory.ring_size)
+        self._memory = memory
+        self._actor_id = actor_id
+        self._ring_size = memory.ring_size
+        self._guard = min(guard, self._ring_size // 2)
+        self._latent_history = False # Whole windows, as episodes are untracked
+        self._arrays = memory.arrays()
+        self._counts = memory.counts()
+        self._allocated = memory.n_actors * memory.ring_size
+
+    def __len__(self):
+        return int(np.minimum(self._counts, self._ring_size).sum())
+
+    def _append(self, **fields):
+        if self._actor_id is None:
+            raise ValueError('Only actors can add to shared replay.')
+        if (fields['latent'] is None) != (self._arrays['latent'] is None):
+            raise ValueError('Latents must match the shared replay memory.')
+        fields['action'] = np.reshape(fields['action'], (1,)) # (1,)
+        count = self._counts[self._actor_id]
+        slot = self._actor_id*self._ring_size + count % self._ring_size
+        for name, array in self._arrays.items():
+            if array is not None:
+                array[slot] = fields[name]
+        self._counts[self._actor_id] = count + 1 # Publishes the slot
+        if fields['terminal']:
+            self._episode += 1
+
+    def _readable(self):
+        """ First logical index and number of readable slots per actor. """
+
+        counts = self._counts.copy()
+        n_readable = np.minimum(counts, self._ring_size - self._guard)
+        return counts - n_readable, n_readable
+
+    def is_ready(self, batch_size: int, seq_len: int) -> bool:
+        _, n_readable = self._readable()
+        n_starts = np.maximum(n_readable - seq_len + 1, 0)
+        return (n_starts.sum() > 0) and (n_readable.sum() >= batch_size)
+
+    def _sample_slots(self, batch_size, seq_len, no_terminals_in_sequence):
+        if no_terminals_in_sequence:
+            raise ValueError('Shared replay does not track episodes.')
+        first, n_readable = self._readable()
+        n_starts = np.maximum(n_readable - seq_len + 1, 0)
+        random = np.random if self._rng is None else self._rng
+        actors = random.choice(
+            n_starts.size, size=batch_size, p=n_starts/n_starts.sum())
+        starts = first[actors] + np.floor(
+            _rand(self._rng, batch_size) * n_starts[actors]).astype(np.int64)
+        slots = actors[:, None]*self._ring_size \
+            + (starts[:, None] + np.arange(seq_len)) % self._ring_size
+        return slots if seq_len > 1 else slots[:, 0]
+
+    def flush(self):
+        raise ValueError('Shared replay cannot be flushed.')
+
+    def save(self, path: str):
+        raise ValueError('Shared replay does not support snapshots.')
+
+    def load(self, path: str):
+        raise ValueError('Shared replay does not support snapshots.')
+
+class BatchPrefetcher(object):
+    """
+    Runs PREPARE_FN on a background thread and hands its results to the
+    learner through a queue of at most DEPTH batches. PREPARE_FN should
+    sample from the replay buffer and return None while the buffer is not
+    ready yet. It is always called while holding LOCK, which everything else
+    touching the buffer (inserts, priority updates, flushes) must also hold.
+    The time the learner spends blocked in get() is accumulated in
+    wait_time.
+    """
+
+    def __init__(self, prepare_fn, lock, depth: int=2):
+        if depth < 1:
+            raise ValueError('Prefetch depth must be at least 1.')
+        self._prepare_fn = prepare_fn
+        self._lock = lock
+        self._queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._thread = None
+        self.n_batches = 0
+        self.wait_time = 0.
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                with self._lock:
+                    batch = self._prepare_fn()
+            except Exception as e: # Re-raised in the learner thread
+                batch = e
+            if batch is None:
+                time.sleep(1e-3)
+                continue
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if isinstance(batch, Exception):
+                return
+
+    def get(self):
+        self.start()
+        start_time = time.perf_counter()
+        batch = self._queue.get()
+        self.wait_time += time.perf_counter() - start_time
+        self.n_batches += 1
+        if isinstance(batch, Exception):
+            self._thread = None
+            raise batch
+        return batch
+
+    def clear(self):
+        """ Drops batches already prepared, e.g. after the buffer is flushed. """
+
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                return
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.clear()
+
+    def get_stats(self):
+        mean_wait = self.wait_time / max(self.n_batches, 1)
+        return {
+            'n_batches': self.n_batches, 'wait_time': self.wait_time,
+            'mean_wait_time': mean_wait}
+
+REPLAY_BUFFERS = {
+    'deque': ReplayBuffer, 'array': ArrayReplayBuffer,
+    'memmap': MemmapReplayBuffer, 'torch': TorchReplayBuffer,
+    'prioritized': PrioritizedReplayBuffer, 'counted': CountedReplayBuffer,
+    'shared': SharedReplayBuffer}
+
+def make_replay_buffer(
+    replay_type: str='array', capacity: int=None, **kwargs):
+    if replay_type not in REPLAY_BUFFERS:
+        raise ValueError(f'Unknown replay buffer type {replay_type}.')
+    return REPLAY_BUFFERS[replay_type](capacity, **kwargs)
@@ -8,12 +8,14 @@ import enum
 
 from acme import specs
 
+from auxrl.environments.FastStepEnv import FastStepEnv
+
 class RewardLoc(enum.IntEnum):
     RIGHT = enum.auto()
     LEFT = enum.auto()
     RESET = enum.auto()
 
-class Env(dm_env.Environment):
+class Env(FastStepEnv):
     """
     Alternating-T Maze. Note that due to the borders of the maze, the effective
     maze size is actually (width-2, height-2).
@@ -93,6 +95,14 @@ class Env(dm_env.Environment):
     def action_spec(self):
         return specs.DiscreteArray(4, dtype=int, name='action')
 
+    def observation_codec(self):
+        """ Name of the most compact replay buffer codec. """
+        if self._obs_noise > 0.:
+            return 'float16' # Rounding is far below the noise scale
+        elif self._tcm_len > 0:
+            return 'float32'
+        return 'int8' # Entries are in {-1, 0, 1, 5}
+
     def get_obs(self):
         left_reward = (1, self._height-2)
         right_reward = (self._width-2, self._height-2)
@@ -135,7 +145,7 @@ class Env(dm_env.Environment):
             step_type=dm_env.StepType.FIRST, reward=None, discount=None,
             observation=self.get_obs())
 
-    def step(self, action):
+    def step_fast(self, action):
         x, y = self._state
         left_reward = (1, self._height-2)
         right_reward = (self._width-2, self._height-2)
@@ -151,7 +161,7 @@ class Env(dm_env.Environment):
         else:
             raise ValueError('Invalid action')
         new_x, new_y = new_state
-        step_type = dm_env.StepType.MID
+        last = False
 
         # If move hits a wall or is blocked, then it is invalid
         invalid_move = False
@@ -206,11 +216,9 @@ class Env(dm_env.Environment):
         self._num_episode_steps += 1
         if (self._max_episode_length is not None and
             self._num_episode_steps >= self._max_episode_length):
-            step_type = dm_env.StepType.LAST
+            last = True
         obs = self.get_obs()
-        return dm_env.TimeStep(
-            step_type=step_type, reward=np.float32(reward),
-            discount=discount, observation=obs)
+        return obs, reward, discount, last
 
     def plot_grid(self, add_start=True):
         plt.figure(figsize=(4, 4))
@@ -0,0 +1,25 @@
+import abc
+import numpy as np
+import dm_env
+
+class FastStepEnv(dm_env.Environment):
+    """
+    Environment whose dynamics live in step_fast, which takes a plain int
+    action and returns the tuple (observation, reward, discount, last) with no
+    TimeStep or reward array allocated. step is the dm_env adapter on top of
+    it, for acme wrappers and loops, and returns the same values as before.
+    """
+
+    @abc.abstractmethod
+    def step_fast(self, action: int):
+        """ Advances the environment by ACTION; see the class docstring. """
+
+    def step(self, action):
+        obs, reward, discount, last = self.step_fast(int(action))
+        if last:
+            step_type = dm_env.StepType.LAST
+        else:
+            step_type = dm_env.StepType.MID
+        return dm_env.TimeStep(
+            step_type=step_type, reward=np.float32(reward),
+            discount=discount, observation=obs)
@@ -14,6 +14,8 @@ from acme import specs
 from acme import wrappers
 from acme.utils import tree_utils
 
+from auxrl.environments.FastStepEnv import FastStepEnv
+
 class ObservationType(enum.IntEnum):
     """
     * GRID: NxNx3 float32 grid of feature channels.
@@ -27,7 +29,7 @@ class ObservationType(enum.IntEnum):
     GRID = enum.auto()
     CIFAR = enum.auto()
 
-class Env(dm_env.Environment):
+class Env(FastStepEnv):
 
     def __init__(
         self, layout, start_state=None, goal_state=None,
@@ -225,6 +227,12 @@ class Env(dm_env.Environment):
     def action_spec(self):
         return specs.DiscreteArray(4, dtype=int, name='action')
 
+    def observation_codec(self):
+        """ Name of the most compact lossless replay buffer codec. """
+        if self._observation_type is ObservationType.GRID:
+            return 'int8' # Entries are in {-1, 0, 1, 5}
+        return 'float32'
+
     def get_obs(self, state=None):
         if state == None:
             state = self._state
@@ -263,7 +271,7 @@ class Env(dm_env.Environment):
             step_type=dm_env.StepType.FIRST, reward=None, discount=None,
             observation=self.get_obs())
 
-    def step(self, action):
+    def step_fast(self, action):
         x, y = self._state
         if action == 0:  # left
             new_state = (x-1, y)
@@ -297,7 +305,7 @@ class Env(dm_env.Environment):
                     blocked_by_barrier = True
                 else:
                     blocked_by_barrier = False
-        step_type = dm_env.StepType.MID
+        last = False
         if self._add_barrier and blocked_by_barrier:
             reward = self._penalty_for_walls
             discount = self._discount
@@ -313,16 +321,14 @@ class Env(dm_env.Environment):
             reward = self._layout[new_x, new_y]
             discount = self._discount #0.
             new_state = self._start_state
-            step_type = dm_env.StepType.LAST
+            last = True
     
         self._state = new_state
         self._num_episode_steps += 1
         if (self._max_episode_length is not None and
             self._num_episode_steps >= self._max_episode_length):
-            step_type = dm_env.StepType.LAST
-        return dm_env.TimeStep(
-            step_type=step_type, reward=np.float32(reward),
-            discount=discount, observation=self.get_obs())
+            last = True
+        return self.get_obs(), reward, discount, last
 
     def plot_grid(self, add_start=True):
         plt.figure(figsize=(4, 4))
@@ -10,7 +10,9 @@ from acme import specs
 from acme import wrappers
 from acme.utils import tree_utils
 
-class Env(dm_env.Environment):
+from auxrl.environments.FastStepEnv import FastStepEnv
+
+class Env(FastStepEnv):
 
     def __init__(
         self, layout, start_state=None, goal_state=None,
@@ -131,6 +133,10 @@ class Env(dm_env.Environment):
     def action_spec(self):
         return specs.DiscreteArray(4, dtype=int, name='action')
 
+    def observation_codec(self):
+        """ Name of the most compact lossless replay buffer codec. """
+        return 'int8' # Entries are in {-1, 0, 1, 5}
+
 
     def linearize_layout(self, layout):
         if (layout.shape[0] < 5) or (layout.shape[1] < 5):
@@ -172,7 +178,7 @@ class Env(dm_env.Environment):
             step_type=dm_env.StepType.FIRST, reward=None, discount=None,
             observation=self.get_obs())
 
-    def step(self, action):
+    def step_fast(self, action):
         w, h = self._layout.shape
         x, y = self._state
         valid_action = False
@@ -207,13 +213,9 @@ class Env(dm_env.Environment):
         discount = self._discount
         self._state = new_state
         self._num_episode_steps += 1
-        step_type = dm_env.StepType.MID
-        if (self._max_episode_length is not None and
-            self._num_episode_steps >= self._max_episode_length):
-            step_type = dm_env.StepType.LAST
-        return dm_env.TimeStep(
-            step_type=step_type, reward=np.float32(reward),
-            discount=discount, observation=self.get_obs())
+        last = (self._max_episode_length is not None and
+            self._num_episode_steps >= self._max_episode_length)
+        return self.get_obs(), reward, discount, last
 
     def plot_grid(self, add_start=True):
         plt.figure(figsize=(4, 4))
@@ -10,6 +10,8 @@ from acme import specs
 from acme import wrappers
 from acme.utils import tree_utils
 
+from auxrl.environments.FastStepEnv import FastStepEnv
+
 class TrialType(enum.IntEnum):
     VERTICAL = enum.auto() # Rewarded
     ANGLED = enum.auto() # Not rewarded
@@ -19,7 +21,7 @@ class Action(enum.IntEnum):
     BACKWARD = enum.auto()
     LICK = enum.auto()
 
-class Env(dm_env.Environment):
+class Env(FastStepEnv):
     """
     From "Learning Enhances Sensory and Multiple Non-sensory Representations
     in Primary Visual Cortex", Poort & Khan 2022
@@ -75,6 +77,10 @@ class Env(dm_env.Environment):
     def action_spec(self):
         return specs.DiscreteArray(3, dtype=int, name='action')
 
+    def observation_codec(self):
+        """ Name of the most compact lossless replay buffer codec. """
+        return 'bitpack' # Stimuli are binary images
+
     def get_obs(self):
         obs = np.zeros(self.layout_dims, dtype=np.float32)
         if self.curr_state < self.n_approach_states:
@@ -87,23 +93,23 @@ class Env(dm_env.Environment):
             obs[0] = np.roll(self.base_angled_state, -shift)
         return obs
 
-    def step(self, action):
+    def step_fast(self, action):
         if self.curr_state == self.n_total_states - 1:
             if (action+1) == Action.FORWARD:
                 new_state = self.curr_state + 1
                 reward = self.time_cost
-                step_type = dm_env.StepType.LAST
+                last = True
             elif (action+1) == Action.BACKWARD:
                 new_state = max(0, self.curr_state - 1)
                 reward = self.time_cost
-                step_type = dm_env.StepType.MID
+                last = False
             else:
                 new_state = self.curr_state + 1
                 if self.trial_type == TrialType.VERTICAL:
                     reward = 1
                 else:
                     reward = -1
-                step_type = dm_env.StepType.LAST
+                last = True
         else:
             if (action+1) == Action.FORWARD:
                 new_state = self.curr_state + 1
@@ -112,12 +118,10 @@ class Env(dm_env.Environment):
             else:
                 new_state = self.curr_state
             reward = self.time_cost
-            step_type = dm_env.StepType.MID
+            last = False
         self.curr_state = new_state
         discount =  1.
-        return dm_env.TimeStep(
-            step_type=step_type, reward=np.float32(reward),
-            discount=discount, observation=self.get_obs())
+        return self.get_obs(), reward, discount, last
 
 def setup_environment(environment):
   """Returns the environment and its spec."""
@@ -32,16 +32,13 @@ class Env(GridworldEnv):
             shuffle_obs=shuffle_obs)
         self.p_reward = p_reward
 
-    def step(self, action): 
-        timestep = super().step(action)
+    def step_fast(self, action): 
+        obs, reward, discount, last = super().step_fast(action)
         if self._eval:
-            return timestep
+            return obs, reward, discount, last
         else:
-            if timestep.step_type == dm_env.StepType.LAST:
+            if last:
                 if (np.random.random() > self.p_reward):
-                    timestep = dm_env.TimeStep(
-                        step_type=timestep.step_type, reward=0.,
-                        discount=timestep.discount,
-                        observation=timestep.observation)
-            return timestep
+                    reward = 0.
+            return obs, reward, discount, last
 
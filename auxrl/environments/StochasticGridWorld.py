@@ -25,7 +25,7 @@ class Env(GridWorld.Env):
         self._local = local
         self._random_p = random_p
 
-    def step(self, action):
+    def step_fast(self, action):
         x, y = self._state
         if np.random.uniform() < self._random_p:
             swap_action_pool = [i for i in range(4) if i != action]
@@ -42,7 +42,7 @@ class Env(GridWorld.Env):
             raise ValueError('Invalid action')
        
         new_x, new_y = new_state
-        step_type = dm_env.StepType.MID
+        last = False
         if self._layout[new_x, new_y] == -1:  # wall
             reward = self._penalty_for_walls
             discount = self._discount
@@ -54,13 +54,11 @@ class Env(GridWorld.Env):
             reward = self._layout[new_x, new_y]
             discount = self._discount #0.
             new_state = self._start_state
-            step_type = dm_env.StepType.LAST
+            last = True
     
         self._state = new_state
         self._num_episode_steps += 1
         if (self._max_episode_length is not None and
             self._num_episode_steps >= self._max_episode_length):
-            step_type = dm_env.StepType.LAST
-        return dm_env.TimeStep(
-            step_type=step_type, reward=np.float32(reward),
-            discount=discount, observation=self.get_obs())
+            last = True
+        return self.get_obs(), reward, discount, last
@@ -1,3 +1,4 @@
+import abc
 import numpy as np
 import torch
 import torch.nn as nn
@@ -51,6 +52,89 @@ def make_fc(input_dim, out_dim, fc_config):
             fc.append(NN_MAP[layer]())
     return nn.Sequential(*fc)
 
+def make_param_arena(modules, values=None):
+    """
+    Moves the parameters of MODULES, in order, into one contiguous buffer and
+    leaves each parameter as a view into it. Gradients of trainable parameters
+    are views into a matching buffer, so they must be zeroed rather than set
+    to None. VALUES is the buffer to use, if given (e.g. a row of a larger
+    one). Returns the (values, grads) buffers.
+    """
+
+    params = [p for module in modules for p in module.parameters()]
+    if values is None:
+        values = torch.empty(
+            sum(p.numel() for p in params), dtype=params[0].dtype,
+            device=params[0].device)
+    grads = torch.zeros_like(values)
+    offset = 0
+    with torch.no_grad():
+        for p in params:
+            n_values = p.numel()
+            values[offset:offset + n_values].copy_(p.view(-1))
+            p.data = values[offset:offset + n_values].view_as(p)
+            if p.requires_grad:
+                p.grad = grads[offset:offset + n_values].view_as(p)
+            offset += n_values
+    return values, grads
+
+class ParamArena(abc.ABC):
+    """
+    Mixin for the network containers: the parameters of the modules listed
+    by _arena_modules share one flat buffer (see make_param_arena), trainable
+    ones first, which the optimizer sees as a single flat parameter. Its grad
+    is the arena's grad buffer, so optimizers must zero it with
+    zero_grad(set_to_none=False); see check_flat_grad.
+    """
+
+    @abc.abstractmethod
+    def _arena_modules(self):
+        """ The modules whose parameters live in the arena, in order. """
+
+    def _build_arena(self, values=None):
+        """ VALUES is the flat buffer to move the parameters into, if given. """
+
+        modules = self._arena_modules()
+        self._param_values, self._param_grads = make_param_arena(
+            modules, values)
+        n_trainable = sum(
+            p.numel() for module in modules for p in module.parameters()
+            if p.requires_grad)
+        self._trainable_params = nn.Parameter(self._param_values[:n_trainable])
+        self._trainable_params.grad = self._param_grads[:n_trainable]
+
+    def check_flat_grad(self):
+        """
+        Raises if the flat parameter's grad is no longer the arena's grad
+        buffer, e.g. after zero_grad(set_to_none=True): backward would then
+        fill the module grads while the optimizer steps on nothing.
+        """
+
+        grad = self._trainable_params.grad
+        if (grad is None) or (grad.data_ptr() != self._param_grads.data_ptr()):
+            raise ValueError(
+                'Flat grad was detached; use zero_grad(set_to_none=False).')
+
+    def get_flat_params(self):
+        """ Live flat view of every parameter, e.g. for checkpoints. """
+        return self._param_values
+
+    def set_flat_params(self, values):
+        with torch.no_grad():
+            self._param_values.copy_(torch.as_tensor(values))
+
+    def sync_params(self, network, tau=None):
+        """
+        Copies the parameters of NETWORK into this one, or with TAU moves
+        them a fraction TAU of the way there (Polyak averaging).
+        """
+
+        with torch.no_grad():
+            if tau is None:
+                self._param_values.copy_(network._param_values)
+            else:
+                self._param_values.lerp_(network._param_values, tau)
+
 class Encoder(nn.Module):
     def __init__(
         self, env_spec, latent_dim, config, mem_len,
@@ -153,6 +237,7 @@ class RecurrentConcatenationEncoder(nn.Module):
         if self._mem_len > 0:
             self._feature_size += self._mem_len*self._latent_dim
         self._prev_latent = None
+        self._window_scales = {} # (n_steps, device) -> scales
         self._fc = make_fc(self._feature_size, self._latent_dim, config['fc'])
         
     def forward(self, x, prev_latents=None, save_conv_activity=False):
@@ -191,6 +276,70 @@ class RecurrentConcatenationEncoder(nn.Module):
         self._new_latent = x
         return x
 
+    def forward_sequence(self, x, prev_latents):
+        """
+        Runs the encoder over a (S, N, C, H, W) sequence, starting from the
+        (N, mem_len, latent_dim) window PREV_LATENTS and feeding each output
+        back into the window. The convolutions run once over all S steps.
+        The window is scaled at every step as forward scales it, but out of
+        place, so PREV_LATENTS is left untouched and the outputs match a loop
+        of forward calls exactly. Returns the (S, N, latent_dim) outputs.
+        """
+
+        S, N = x.shape[:2]
+        x = x.reshape((S*N,) + x.shape[2:])
+        if self._convs is not None:
+            x = self._convs(x)
+        features = x.reshape(S, N, -1).float()
+        step_scales = self._get_step_scales(features.device)
+        window = prev_latents
+        outs = []
+        for s in range(S):
+            if step_scales is not None:
+                window = window * step_scales
+            out = self._fc(torch.hstack((features[s], window.reshape(N, -1))))
+            outs.append(out)
+            window = torch.cat((window[:, 1:], out.unsqueeze(1)), dim=1)
+        self._new_latent = out
+        return torch.stack(outs)
+
+    def _get_step_scales(self, device):
+        """ (1, mem_len, 1) scales forward applies to the window each step. """
+
+        if self._eligibility_gamma is None:
+            return None
+        key = (0, device)
+        if key not in self._window_scales:
+            self._window_scales[key] = torch.tensor(
+                [self._eligibility_gamma**(t+1) for t in range(self._mem_len)],
+                dtype=torch.float32, device=device).view(1, -1, 1)
+        return self._window_scales[key]
+
+    def _get_window_scales(self, n_steps, device):
+        """
+        (n_steps, mem_len) cumulative eligibility scales of each window
+        position. At every step forward scales position t by gamma**(t+1),
+        so an entry has the product of the scalings of each position it
+        passed through: the initial entries since step 0, the others since
+        the step after they were produced.
+        """
+
+        if self._eligibility_gamma is None:
+            return None
+        key = (n_steps, device)
+        if key in self._window_scales:
+            return self._window_scales[key]
+        mem_len = self._mem_len
+        exponents = np.zeros((n_steps, mem_len))
+        for s in range(n_steps):
+            for p in range(mem_len):
+                last = p + s + 1 if p + s < mem_len else mem_len
+                exponents[s, p] = np.arange(p + 1, last + 1).sum()
+        self._window_scales[key] = torch.as_tensor(
+            self._eligibility_gamma**exponents, dtype=torch.float32,
+            device=device)
+        return self._window_scales[key]
+
     def get_curr_latent(self):
         return self._prev_latent
 
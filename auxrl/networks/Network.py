@@ -3,11 +3,12 @@ import numpy as np
 import inspect
 import yaml
 import warnings
+import collections.abc
 from pathlib import Path
 import torch
 import torch.nn as nn
-from copy import deepcopy
 from auxrl.networks.Modules import Encoder, Q, T, RecurrentConcatenationEncoder
+from auxrl.networks.Modules import ParamArena
 
 NETWORK_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -19,7 +20,7 @@ def update(d, u):
             d[k] = v
     return d
 
-class Network(object):
+class Network(ParamArena):
     """
     Container over the various computational modules
     """
@@ -62,13 +63,20 @@ class Network(object):
                 p.requires_grad = False
         self.Q = Q(env_spec, latent_dim, config['q']).to(device)
         self.T = T(env_spec, latent_dim, config['t']).to(device)
+        self._build_arena()
+
+    def _arena_modules(self):
+        return [self.Q, self.T, self.encoder]
 
     def get_params(self):
         params = {
             'encoder': self.encoder.state_dict(),
             'Q': self.Q.state_dict(), 'T': self.T.state_dict()
             }
-        return params
+        # Copies, since the state dicts are views into the flat buffer
+        return {
+            module: {k: v.clone() for k, v in state.items()}
+            for module, state in params.items()}
 
     def set_params(self, params, encoder_only=False, shuffle=False):
         if shuffle:
@@ -85,20 +93,21 @@ class Network(object):
             self.T.load_state_dict(params['T'])
 
     def get_trainable_params(self):
-        trainable_params = []
-        trainable_params.extend(self.Q.parameters())
-        trainable_params.extend(self.T.parameters())
-        if not self._freeze_encoder:
-            trainable_params.extend(self.encoder.parameters())
-        return trainable_params
+        return [self._trainable_params]
 
     def get_encoder_params(self):
         return self.encoder.parameters()
 
     def copy(self):
+        """
+        Duplicate with the same parameters, in its own flat buffer. It is
+        built (and randomly initialized) anew, so seeded runs draw the same
+        random numbers as when copies were fresh networks.
+        """
+
         duplicate = Network(
-            self._env_spec, self._latent_dim, self._network_yaml, self._yaml_mods,
-            self._mem_len, self._eligibility_gamma, self._mem_location,
-            self._device, self._freeze_encoder)
+            self._env_spec, self._latent_dim, self._network_yaml,
+            self._yaml_mods, self._mem_len, self._eligibility_gamma,
+            self._mem_location, self._device, self._freeze_encoder)
+        duplicate.sync_params(self)
         return duplicate
-
@@ -4,6 +4,7 @@ import time
 import acme
 import torch
 import base64
+import contextlib
 import dm_env
 import random
 import warnings
@@ -21,8 +22,48 @@ from acme import wrappers
 from acme.utils import tree_utils
 from acme.utils import loggers
 
+from auxrl.LossMetrics import LossMetrics
+from auxrl.environments.FastStepEnv import FastStepEnv
+
+class UpdateScheduler(object):
+    """
+    Decides how many updates to run after each environment step. Nothing is
+    trained for the first LEARNING_STARTS steps; after that, every
+    TRAIN_EVERY-th step runs UPDATES_PER_STEP * TRAIN_EVERY updates. A
+    fractional ratio carries over, so e.g. 0.25 runs one update every four
+    steps. Steps are counted across episodes.
+    """
+
+    def __init__(
+        self, train_every: int=1, updates_per_step: float=1.,
+        learning_starts: int=0):
+        if train_every < 1:
+            raise ValueError('train_every must be at least 1.')
+        if updates_per_step < 0:
+            raise ValueError('updates_per_step must be non-negative.')
+        self.train_every = train_every
+        self.updates_per_step = updates_per_step
+        self.learning_starts = learning_starts
+        self._n_steps = 0
+        self._credit = 0.
+
+    def step(self) -> int:
+        """ Counts one environment step; returns the updates to run now. """
+
+        self._n_steps += 1
+        if self._n_steps <= self.learning_starts:
+            return 0
+        if (self._n_steps - self.learning_starts) % self.train_every != 0:
+            return 0
+        self._credit += self.updates_per_step * self.train_every
+        n_updates = int(self._credit + 1e-9) # Tolerate float drift
+        self._credit -= n_updates
+        return n_updates
+
 def run_train_episode(
-    environment: dm_env.Environment, agent: acme.Actor, clip_norm: float=-1.):
+    environment: dm_env.Environment, agent: acme.Actor, clip_norm: float=-1.,
+    scheduler: UpdateScheduler=None, metrics: LossMetrics=None,
+    bulk: bool=False):
     """
     Each episode is itself a loop which interacts first with the environment to
     get an observation and then give that observation to the agent in order to
@@ -31,33 +72,212 @@ def run_train_episode(
     Args:
       environment: dm_env.Environment used to generate trajectories.
       agent: acme.Actor for selecting actions in the run loop.
+      scheduler: UpdateScheduler deciding how many updates follow each step.
+        Without one, the agent updates once per step. With one, the returned
+        losses are averaged over the updates actually run.
+      metrics: LossMetrics the update losses are accumulated into, left for
+        the caller to read (e.g. every few episodes); the returned losses are
+        then None. Without one, losses stay on the device and are read once,
+        at the end of the episode.
+      bulk: if the agent acts uniformly at random (epsilon=1), generate the
+        whole episode first, without forward passes, and then run its
+        updates back to back. Updates can then sample any of the episode's
+        transitions, not only those before their step.
+
+    Unwrapped FastStepEnv environments are stepped through step_fast, so no
+    TimeStep is built per step; anything else goes through dm_env's step.
     """
 
     episode_steps = 0
     episode_return = 0
-    summed_episode_losses = []
+    if metrics is None:
+        episode_metrics = LossMetrics(device=agent._device)
+    else:
+        episode_metrics = metrics
 
-    timestep = environment.reset()
-    agent.reset()
-    agent.observe_first(timestep)
-
-    while not timestep.last(): # Until terminal state reached
-        action = agent.select_action(timestep.observation)
-        timestep = environment.step(action)
-        agent.observe(
-            action, next_timestep=timestep, latent=agent.get_curr_latent())
-        episode_losses = agent.update(clip_norm=clip_norm)
-        if summed_episode_losses == []:
-            summed_episode_losses = episode_losses
+    bulk_episode = bulk and agent.acts_randomly()
+    if bulk_episode:
+        episode_return, episode_steps = agent.observe_random_episode(
+            environment)
+        if scheduler is None:
+            n_updates = episode_steps
         else:
-            for i in range(len(summed_episode_losses)):
-                summed_episode_losses[i] += episode_losses[i]
+            n_updates = sum(scheduler.step() for _ in range(episode_steps))
+        for start in range(0, n_updates, 256): # Bounds the batches sampled
+            agent.update_many(
+                min(256, n_updates - start), clip_norm=clip_norm,
+                metrics=episode_metrics)
+    else:
+        timestep = environment.reset()
+        agent.reset()
+        agent.observe_first(timestep)
+        obs, last = timestep.observation, timestep.last()
+
+    fast = isinstance(environment, FastStepEnv)
+    while (not bulk_episode) and (not last): # Until terminal state
+        action = agent.select_action(obs)
+        if fast:
+            obs, reward, discount, last = environment.step_fast(action)
+            agent.observe_fast(
+                action, obs, reward, discount, last, agent.get_curr_latent())
+        else:
+            timestep = environment.step(action)
+            agent.observe(
+                action, next_timestep=timestep, latent=agent.get_curr_latent())
+            obs, reward, last = (
+                timestep.observation, timestep.reward, timestep.last())
+        if scheduler is None:
+            agent.update(clip_norm=clip_norm, metrics=episode_metrics)
+        else:
+            agent.update_many(
+                scheduler.step(), clip_norm=clip_norm, metrics=episode_metrics)
         episode_steps += 1
-        episode_return += timestep.reward
+        episode_return += reward
 
-    avg_episode_losses = [l/episode_steps for l in summed_episode_losses]
+    if metrics is not None:
+        avg_episode_losses = None
+    elif scheduler is None: # Steps before the buffer filled count as zeros
+        avg_episode_losses = [
+            l/episode_steps for l in episode_metrics.get_sums()]
+    else:
+        avg_episode_losses = episode_metrics.get_means()
     return avg_episode_losses, episode_return, episode_steps
 
+class EnsembleEpisodeRunner(object):
+    """
+    Runs the training episodes of an EnsembleAgent's seeds in lockstep: each
+    step moves every active seed one step through its own environment, then
+    updates all of them at once. Episodes of different seeds start and end
+    independently, and each is summarized as run_train_episode would, with
+    SCHEDULERS (one UpdateScheduler per seed) deciding the updates per step
+    and FastStepEnv environments stepped through step_fast. Bulk episodes
+    are not supported.
+
+    With RANDOM_STATES (one np.random.get_state() per seed), each seed's
+    environment draws from its own copy of the global np.random stream, as
+    it would in a lone run; see seed_random_state. A seed's episode time is
+    its own stepping and sampling plus an even share of the updates it
+    took part in.
+    """
+
+    def __init__(
+        self, environments: list, ensemble, clip_norm: float=-1.,
+        schedulers: list=None, random_states: list=None):
+        self._environments = environments
+        self._ensemble = ensemble
+        self._agents = ensemble._agents
+        self._clip_norm = clip_norm
+        self._schedulers = schedulers
+        self._random_states = \
+            None if random_states is None else list(random_states)
+        self._fast = [isinstance(e, FastStepEnv) for e in environments]
+        self._obs = [None] * len(environments)
+        self._episodes = [None] * len(environments)
+
+    @contextlib.contextmanager
+    def seed_random_state(self, seed: int):
+        """
+        Swaps SEED's np.random state in for the duration of the block, e.g.
+        around its evaluation episodes.
+        """
+
+        if self._random_states is None:
+            yield
+            return
+        outer_state = np.random.get_state()
+        np.random.set_state(self._random_states[seed])
+        try:
+            yield
+        finally:
+            self._random_states[seed] = np.random.get_state()
+            np.random.set_state(outer_state)
+
+    def step(self, active: list) -> dict:
+        """
+        Advances the seeds in ACTIVE by one step and their scheduled updates.
+        Returns {seed: (avg_episode_losses, episode_return, episode_steps,
+        episode_seconds)} for the seeds whose episode just ended.
+        """
+
+        n_updates, batches = {}, {}
+        for seed in active:
+            start = time.time()
+            with self.seed_random_state(seed):
+                self._step_seed(seed)
+            if self._schedulers is None:
+                n_updates[seed] = 1
+            else:
+                n_updates[seed] = self._schedulers[seed].step()
+            if n_updates[seed] > 1: # One replay pass, as in update_many
+                batches[seed] = self._agents[seed]._prepare_batches(
+                    n_updates[seed])
+            self._episodes[seed]['seconds'] += time.time() - start
+
+        for r in range(max(n_updates.values(), default=0)):
+            rows = [s for s in active if n_updates[s] > r]
+            round_batches = [None] * len(self._agents)
+            start = time.time()
+            for s in rows:
+                if s not in batches:
+                    round_batches[s] = self._agents[s]._next_batch()
+                elif batches[s] is not None:
+                    round_batches[s] = batches[s][r]
+            n_before = [self._agents[s]._n_updates for s in rows]
+            all_losses = self._ensemble.update(
+                rows, clip_norm=self._clip_norm, batches=round_batches)
+            share = (time.time() - start) / len(rows)
+            for s, n in zip(rows, n_before):
+                episode = self._episodes[s]
+                episode['seconds'] += share
+                if self._agents[s]._n_updates == n:
+                    continue
+                episode['n_updates'] += 1
+                episode['losses'] = [
+                    l + new for l, new in zip(episode['losses'], all_losses[s])]
+
+        finished = {}
+        for seed in active:
+            episode = self._episodes[seed]
+            if not episode['last']:
+                continue
+            if self._schedulers is None: # Steps before the buffer filled count
+                n_terms = episode['steps']
+            else:
+                n_terms = max(episode['n_updates'], 1)
+            avg_episode_losses = [l/n_terms for l in episode['losses']]
+            finished[seed] = (
+                avg_episode_losses, episode['return'], episode['steps'],
+                episode['seconds'])
+            self._episodes[seed] = None
+        return finished
+
+    def _step_seed(self, seed):
+        environment, agent = self._environments[seed], self._agents[seed]
+        if self._episodes[seed] is None: # Start a new episode
+            timestep = environment.reset()
+            agent.reset()
+            agent.observe_first(timestep)
+            self._obs[seed] = timestep.observation
+            self._episodes[seed] = {
+                'losses': [0.] * 5, 'n_updates': 0, 'return': 0, 'steps': 0,
+                'seconds': 0., 'last': timestep.last()}
+        episode = self._episodes[seed]
+        action = agent.select_action(self._obs[seed])
+        if self._fast[seed]:
+            obs, reward, discount, last = environment.step_fast(action)
+            agent.observe_fast(
+                action, obs, reward, discount, last, agent.get_curr_latent())
+        else:
+            timestep = environment.step(action)
+            agent.observe(
+                action, next_timestep=timestep, latent=agent.get_curr_latent())
+            obs, reward, last = (
+                timestep.observation, timestep.reward, timestep.last())
+        self._obs[seed] = obs
+        episode['return'] += reward
+        episode['steps'] += 1
+        episode['last'] = last
+
 def run_A2C_train_episode(
     environment: dm_env.Environment, agent: acme.Actor, clip_norm: float=-1.):
     """
@@ -79,25 +299,32 @@ def run_A2C_train_episode(
     episode_return = 0
     timestep = environment.reset()
     agent.reset()
+    next_obs, last = timestep.observation, timestep.last()
+    fast = isinstance(environment, FastStepEnv)
 
-    while not timestep.last(): # Until terminal state reached
-        observation = timestep.observation
+    while not last: # Until terminal state reached
+        observation = next_obs
         policy_dist, value = agent.actor_critic(observation)
         value = value.item()
         action = policy_dist.multinomial(num_samples=1).item()
         log_prob = torch.log(policy_dist.squeeze(0)[action])
         entropy = -torch.sum(policy_dist * torch.log(policy_dist), dim=1)
-        timestep = environment.step(action)
+        if fast:
+            next_obs, reward, _, last = environment.step_fast(action)
+        else:
+            timestep = environment.step(action)
+            next_obs, reward, last = (
+                timestep.observation, timestep.reward, timestep.last())
         episode_steps += 1
-        episode_return += timestep.reward
+        episode_return += reward
         trajectory_info['log_probs'].append(log_prob)
         trajectory_info['values'].append(value)
-        trajectory_info['rewards'].append(timestep.reward)
-        trajectory_info['masks'].append(not timestep.last())
+        trajectory_info['rewards'].append(reward)
+        trajectory_info['masks'].append(not last)
         trajectory_info['entropies'].append(entropy)
         trajectory_info['obs'].append(observation)
         trajectory_info['actions'].append(action)
-        trajectory_info['next_obs'].append(timestep.observation)
+        trajectory_info['next_obs'].append(next_obs)
 
     episode_loss = agent.update(trajectory_info) # should be n_loss- length?
     return episode_loss, episode_return, episode_steps
@@ -111,17 +338,23 @@ def run_eval_episode(
         episode_steps = 0
         episode_return = 0
         timestep = env.reset()
-        while not timestep.last():
+        obs, last = timestep.observation, timestep.last()
+        while not last:
             action = agent.select_action(
-                timestep.observation, force_greedy=True, verbose=verbose)
+                obs, force_greedy=True, verbose=verbose)
             if verbose:
                 #env.plot_state()
                 plt.figure()
-                plt.imshow(timestep.observation.squeeze(), vmin=-1, vmax=4.5)
+                plt.imshow(obs.squeeze(), vmin=-1, vmax=4.5)
                 plt.show()
-            timestep = env.step(action)
+            if isinstance(env, FastStepEnv):
+                obs, reward, _, last = env.step_fast(action)
+            else:
+                timestep = env.step(action)
+                obs, reward, last = (
+                    timestep.observation, timestep.reward, timestep.last())
             episode_steps += 1
-            episode_return += timestep.reward
+            episode_return += reward
             if (max_episode_steps != None) and (episode_steps >= max_episode_steps):
                 break
 
@@ -153,8 +386,9 @@ def run_modified_transition(
     n_iters = (agent._batch_size // len(timestep_pairs)) + 1
     for _ in range(n_iters):
         for timestep, next_timestep, action in timestep_pairs:
-            agent._replay_buffer.add_artificial_transition(
-                timestep, next_timestep, action)
+            with agent._replay_lock:
+                agent._replay_buffer.add_artificial_transition(
+                    timestep, next_timestep, action)
     
     while (not timestep.last()) and (episode_steps < max_timestep):
         episode_losses = agent.update()
@@ -16,6 +16,8 @@ from acme import wrappers
 
 from auxrl.environments.GridWorld import Env as Env, ObservationType
 from auxrl.utils import run_train_episode, run_eval_episode
+from auxrl.utils import EnsembleEpisodeRunner
+from auxrl.EnsembleAgent import EnsembleAgent
 from model_parameters.gridworld import parameter_map
 
 # Parse required command-line arguments
@@ -32,11 +34,17 @@ parser.add_argument('-d', '--discount_factor', type=float, default=0.9)
 parser.add_argument('-s', '--shuffle', action='store_true')
 parser.add_argument('-q', '--iqn', action='store_true')
 parser.add_argument('-c', '--cifar', action='store_true')
+parser.add_argument('-E', '--ensemble', action='store_true',
+    help='Train the seeds of each configuration together in one process.')
+parser.add_argument('-B', '--bulk', action='store_true',
+    help='With epsilon=1, generate each episode before running its updates.')
 args = parser.parse_args()
 if (args.n_jobs != 1) and (args.job_idx is None):
     str_msg = 'Either specify job idx or set to CPU parallel (idx=-1) '
     str_msg += 'if you are running multiple jobs.'
     parser.error(str_msg)
+if args.ensemble and args.bulk:
+    parser.error('Bulk episodes are not supported with --ensemble.')
 job_idx = 0 if args.job_idx is None else args.job_idx
 n_jobs = args.n_jobs
 nn_yaml = args.nn_yaml
@@ -46,6 +54,8 @@ discount_factor = args.discount_factor
 shuffle = args.shuffle
 use_iqn = args.iqn
 use_cifar = args.cifar
+use_ensemble = args.ensemble
+use_bulk = args.bulk
 
 # Set key experiment parameters
 exp_dir = f'gridworld' if not use_cifar else 'gridworld_cifar'
@@ -112,13 +122,17 @@ else:
     from auxrl.environments.GridWorld import Env as Env
 
 def gpu_parallel(job_idx):
+    run_fn = run_ensemble if use_ensemble else run
     for _arg in split_args[job_idx]:
-        run(_arg)
+        run_fn(_arg)
 
 def cpu_parallel():
-    job_results = Parallel(n_jobs=n_cpu_jobs)(delayed(run)(arg) for arg in args)
+    run_fn = run_ensemble if use_ensemble else run
+    job_results = Parallel(n_jobs=n_cpu_jobs)(delayed(run_fn)(arg) for arg in args)
+
+def setup_run(arg):
+    """ Builds one seed's environment, agent and result log. """
 
-def run(arg):
     _fname, loss_weights, param_update, i = arg
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     print(device)
@@ -148,11 +162,15 @@ def run(arg):
     parameters = unflatten(parameters)
     with open(f'{param_dir}{_fname}.yaml', 'w') as outfile:
         yaml.dump(parameters, outfile, default_flow_style=False)
-    if random_seed: np.random.seed(i)
+    if random_seed:
+        np.random.seed(i)
+        torch.manual_seed(i)
+    rng = np.random.default_rng(i) if random_seed else None
     env = Env(**parameters['dset_args'])
     env_spec = specs.make_environment_spec(env)
     network = Network(env_spec, device=device, **parameters['network_args'])
-    agent = Agent(env_spec, network, device=device, **parameters['agent_args'])
+    agent = Agent(
+        env_spec, network, device=device, rng=rng, **parameters['agent_args'])
 
     with open(f'{fname_nnet_dir}goal.txt', 'w') as goalfile:
         goalfile.write(str(env._goal_state))
@@ -178,75 +196,121 @@ def run(arg):
     result['model'] = []
     result['model_iter'] = []
 
-    sec_per_step_SUM = 0.
-    sec_per_step_NUM = 0.
-    goal_reset_episode = n_episodes//2 + 1
+    return {
+        'fname': fname, '_fname': _fname, 'i': i, 'parameters': parameters,
+        'env': env, 'agent': agent, 'result': result,
+        'fname_nnet_dir': fname_nnet_dir, 'fname_fig_dir': fname_fig_dir,
+        'sec_per_step_SUM': 0., 'sec_per_step_NUM': 0.,
+        'random_state': np.random.get_state()}
+
+def record_episode(run_state, episode, losses, score, steps_per_episode, sec):
+    """ Logs one training episode, evaluates, plots and checkpoints. """
 
+    result = run_state['result']
+    env, agent = run_state['env'], run_state['agent']
+    parameters = run_state['parameters']
+    _fname, i = run_state['_fname'], run_state['i']
+    fname_nnet_dir = run_state['fname_nnet_dir']
+    fname_fig_dir = run_state['fname_fig_dir']
+    run_state['sec_per_step_SUM'] += sec
+    run_state['sec_per_step_NUM'] += steps_per_episode
+    sec_per_step_SUM = run_state['sec_per_step_SUM']
+    sec_per_step_NUM = run_state['sec_per_step_NUM']
+    result['episode'].append(episode)
+    result['step'].append(sec_per_step_NUM)
+    result['train_loss'].append(losses[4])
+    result['mf_loss'].append(losses[3])
+    result['neg_random_loss'].append(losses[2])
+    result['neg_neighbor_loss'].append(losses[1])
+    result['pos_sample_loss'].append(losses[0])
+    result['train_score'].append(score)
+    result['train_steps_per_ep'].append(steps_per_episode)
+    result['model'].append(_fname)
+    result['model_iter'].append(i)
+    if episode % eval_every == 0:
+        sec_per_step = sec_per_step_SUM/sec_per_step_NUM
+        print(f'[TRAIN SUMMARY] {500*sec_per_step} sec/ 500 steps')
+        print(f'{sec_per_step_NUM} training steps elapsed.')
+        score, steps_per_episode = run_eval_episode(
+            env, agent, parameters['n_test_episodes'])
+        result['valid_score'].append(score)
+        result['valid_steps_per_ep'].append(steps_per_episode)
+        # Save plots tracking training progress
+        fig, axs = plt.subplots(3, 2, figsize=(7, 10))
+        loss_keys = [
+            'train_loss', 'mf_loss', 'neg_random_loss',
+            'neg_neighbor_loss', 'pos_sample_loss']
+        for key_idx, loss_key in enumerate(loss_keys):
+            ax = axs[key_idx%3][key_idx//3]
+            ax.plot(result[loss_key])
+            ax.set_ylabel(loss_key)
+        plt.tight_layout()
+        plt.savefig(f'{fname_fig_dir}train_losses.png')
+        plt.figure()
+        plt.plot(result['train_score'])
+        plt.ylabel('Training Score'); plt.xlabel('Training Episodes')
+        plt.tight_layout()
+        plt.savefig(f'{fname_fig_dir}train_scores.png')
+        plt.figure()
+        plt.plot(
+            result['episode'][::eval_every],
+            result['valid_score'][::eval_every])
+        plt.ylabel('Validation Score'); plt.xlabel('Training Episodes')
+        plt.tight_layout()
+        plt.savefig(f'{fname_fig_dir}valid_scores.png')
+        plt.figure()
+        plt.plot(
+            result['episode'][::eval_every],
+            result['valid_steps_per_ep'][::eval_every])
+        plt.ylabel('Validation Steps to Goal'); plt.xlabel('Training Episodes')
+        plt.tight_layout()
+        plt.savefig(f'{fname_fig_dir}valid_steps.png')
+        plt.close('all')
+    else:
+        result['valid_score'].append(None)
+        result['valid_steps_per_ep'].append(None)
+    if episode % save_net_every == 0:
+        agent.save_network(fname_nnet_dir, episode)
+
+def finish_run(run_state):
+    # Save pickle
+    with open(f'{pickle_dir}{run_state["fname"]}.p', 'wb') as f:
+        pickle.dump(run_state['result'], f)
+
+def run(arg):
+    run_state = setup_run(arg)
     for episode in range(n_episodes):
         start = time.time()
-        losses, score, steps_per_episode = run_train_episode(env, agent)
+        losses, score, steps_per_episode = run_train_episode(
+            run_state['env'], run_state['agent'], bulk=use_bulk)
         end = time.time()
-        sec_per_step_SUM += (end-start)
-        sec_per_step_NUM += steps_per_episode
-        result['episode'].append(episode)
-        result['step'].append(sec_per_step_NUM)
-        result['train_loss'].append(losses[4])
-        result['mf_loss'].append(losses[3])
-        result['neg_random_loss'].append(losses[2])
-        result['neg_neighbor_loss'].append(losses[1])
-        result['pos_sample_loss'].append(losses[0])
-        result['train_score'].append(score)
-        result['train_steps_per_ep'].append(steps_per_episode)
-        result['model'].append(_fname)
-        result['model_iter'].append(i)
-        if episode % eval_every == 0:
-            sec_per_step = sec_per_step_SUM/sec_per_step_NUM
-            print(f'[TRAIN SUMMARY] {500*sec_per_step} sec/ 500 steps')
-            print(f'{sec_per_step_NUM} training steps elapsed.')
-            score, steps_per_episode = run_eval_episode(
-                env, agent, parameters['n_test_episodes'])
-            result['valid_score'].append(score)
-            result['valid_steps_per_ep'].append(steps_per_episode)
-            # Save plots tracking training progress
-            fig, axs = plt.subplots(3, 2, figsize=(7, 10))
-            loss_keys = [
-                'train_loss', 'mf_loss', 'neg_random_loss',
-                'neg_neighbor_loss', 'pos_sample_loss']
-            for key_idx, loss_key in enumerate(loss_keys):
-                ax = axs[key_idx%3][key_idx//3]
-                ax.plot(result[loss_key])
-                ax.set_ylabel(loss_key)
-            plt.tight_layout()
-            plt.savefig(f'{fname_fig_dir}train_losses.png')
-            plt.figure()
-            plt.plot(result['train_score'])
-            plt.ylabel('Training Score'); plt.xlabel('Training Episodes')
-            plt.tight_layout()
-            plt.savefig(f'{fname_fig_dir}train_scores.png')
-            plt.figure()
-            plt.plot(
-                result['episode'][::eval_every],
-                result['valid_score'][::eval_every])
-            plt.ylabel('Validation Score'); plt.xlabel('Training Episodes')
-            plt.tight_layout()
-            plt.savefig(f'{fname_fig_dir}valid_scores.png')
-            plt.figure()
-            plt.plot(
-                result['episode'][::eval_every],
-                result['valid_steps_per_ep'][::eval_every])
-            plt.ylabel('Validation Steps to Goal'); plt.xlabel('Training Episodes')
-            plt.tight_layout()
-            plt.savefig(f'{fname_fig_dir}valid_steps.png')
-            plt.close('all')
-        else:
-            result['valid_score'].append(None)
-            result['valid_steps_per_ep'].append(None)
-        if episode % save_net_every == 0:
-            agent.save_network(fname_nnet_dir, episode)
+        record_episode(
+            run_state, episode, losses, score, steps_per_episode, end-start)
+    finish_run(run_state)
 
-    # Save pickle
-    with open(f'{pickle_dir}{fname}.p', 'wb') as f:
-        pickle.dump(result, f)
+def run_ensemble(args):
+    """
+    Trains the seeds in ARGS (one configuration) together, with a single
+    vmapped update per step; logs and files are the same as from run.
+    """
+
+    run_states = [setup_run(arg) for arg in args]
+    ensemble = EnsembleAgent([run_state['agent'] for run_state in run_states])
+    runner = EnsembleEpisodeRunner(
+        [run_state['env'] for run_state in run_states], ensemble,
+        random_states=[run_state['random_state'] for run_state in run_states])
+    episodes = [0] * len(run_states)
+    while min(episodes) < n_episodes:
+        active = [k for k in range(len(run_states)) if episodes[k] < n_episodes]
+        finished = runner.step(active)
+        for k, (losses, score, steps_per_episode, sec) in finished.items():
+            with runner.seed_random_state(k): # Evaluation resets the env
+                record_episode(
+                    run_states[k], episodes[k], losses, score,
+                    steps_per_episode, sec)
+            episodes[k] += 1
+    for run_state in run_states:
+        finish_run(run_state)
 
 if __name__ == '__main__':
     # Load model parameters
@@ -276,7 +340,13 @@ if __name__ == '__main__':
                     continue
 
             args.append([fname, loss_weights, param_update, i])
-    split_args = np.array_split(args, n_jobs)
+    if use_ensemble: # One job per configuration, over all its seeds
+        args = [
+            [arg for arg in args if arg[0] == fname]
+            for fname in dict.fromkeys(arg[0] for arg in args)]
+        split_args = [args[k::n_jobs] for k in range(n_jobs)]
+    else:
+        split_args = np.array_split(args, n_jobs)
     
     # Run script (with some CPU/GPU management)
     import time
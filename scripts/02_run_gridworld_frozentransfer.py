@@ -159,7 +159,9 @@ def run(arg):
         'agent_args': {
             'loss_weights': loss_weights, 'lr': 1e-3,
             'replay_capacity': 100_000, 'epsilon': 1.0,
-            'batch_size': 64, 'target_update_frequency': 1000},
+            'batch_size': 64, 'target_update_frequency': 1000,
+            'replay_args': {'intern_obs': freeze_encoder},
+            'cache_latents': freeze_encoder},
         'network_args': {
             'latent_dim': internal_dim, 'network_yaml': nn_yaml,
             'freeze_encoder': freeze_encoder},
@@ -170,7 +170,7 @@ for model_name in os.listdir(nnets_dir):
             if env._layout[_x, _y] != -1:
                 env._start_state = env._state = (_x, _y)
                 obs = env.get_obs()
-                a = agent.select_action(obs, force_greedy=True).item()
+                a = agent.select_action(obs, force_greedy=True)
                 all_possib_inp.append(obs)
                 _quadrant = 0 if _x < maze_width//2 else 2
                 _quadrant += (0 if _y < maze_height//2 else 1)
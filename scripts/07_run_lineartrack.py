@@ -144,7 +144,7 @@ def run(arg):
     for episode in range(n_episodes):
         if continual_transfer and (episode == goal_reset_episode):
             env.reset(reset_goal=True)
-            agent._replay_buffer.flush()
+            agent.flush_replay_buffer()
         start = time.time()
         losses, score, steps_per_episode = run_train_episode(env, agent)
         end = time.time()
@@ -0,0 +1,97 @@
+import time
+import argparse
+import numpy as np
+import torch
+
+from acme import specs
+
+from auxrl.Agent import Agent
+from auxrl.networks.Network import Network
+from auxrl.environments.GridWorld import Env as Env
+
+# Parse optional arguments
+parser = argparse.ArgumentParser(
+    description='Parity and steps/sec of NumPy versus torch greedy acting; '
+    'raises if the NumPy forward drifts from torch.')
+parser.add_argument('-y', '--nn_yamls', type=str, nargs='+',
+    default=['dm', 'noconv'])
+parser.add_argument('-n', '--n_steps', type=int, default=2_000)
+parser.add_argument('-u', '--n_updates', type=int, default=200)
+parser.add_argument('-l', '--latent_dim', type=int, default=10)
+parser.add_argument('-t', '--tolerance', type=float, default=1e-5)
+args = parser.parse_args()
+
+# The dm encoder with its 2x2 max pool swapped for a 1x1, strided one
+SINGLE_WINDOW_POOL = {'encoder': {'convs': [
+    ['Conv2d', 'auto', 16, {'kernel_size': 2}], 'ReLU',
+    ['Conv2d', 16, 32, {'kernel_size': 2}], 'ReLU',
+    ['MaxPool2d', {'kernel_size': 1, 'stride': 2}]]}}
+
+def make_agent(nn_yaml, yaml_mods={}):
+    np.random.seed(0)
+    torch.manual_seed(0)
+    env = Env(8)
+    env_spec = specs.make_environment_spec(env)
+    network = Network(
+        env_spec, latent_dim=args.latent_dim, network_yaml=nn_yaml,
+        yaml_mods=yaml_mods)
+    agent = Agent(
+        env_spec, network, loss_weights=[1e-2, 1e-1, 1e-1, 1],
+        batch_size=64, replay_capacity=10_000, numpy_acting=True,
+        acting_staleness=0)
+    return env, agent
+
+def collect_observations(env, agent):
+    """ Random experience, which also trains the weights away from init. """
+
+    observations = []
+    timestep = env.reset()
+    agent.observe_first(timestep)
+    for _ in range(1_000):
+        action = agent.select_action(timestep.observation)
+        timestep = env.step(action)
+        agent.observe(
+            action, next_timestep=timestep, latent=agent.get_curr_latent())
+        observations.append(timestep.observation)
+        if timestep.last():
+            timestep = env.reset()
+            agent.observe_first(timestep)
+    for _ in range(args.n_updates):
+        agent.update()
+    return np.stack(observations)
+
+def steps_per_sec(agent, observations):
+    start = time.time()
+    for step in range(args.n_steps):
+        agent.select_action(
+            observations[step % len(observations)], force_greedy=True)
+    return args.n_steps / (time.time() - start)
+
+configs = [(nn_yaml, nn_yaml, {}) for nn_yaml in args.nn_yamls]
+configs.append(('dm, 1x1 pool', 'dm', SINGLE_WINDOW_POOL))
+for name, nn_yaml, yaml_mods in configs:
+    env, agent = make_agent(nn_yaml, yaml_mods)
+    observations = collect_observations(env, agent)
+    engine = agent._acting_engine
+    agent.refresh_acting_weights()
+    error = engine.max_abs_error(observations)
+    with torch.no_grad():
+        torch_actions = agent._network.Q(agent._network.encoder(
+            torch.as_tensor(observations))).argmax(1).numpy()
+    numpy_actions = np.array([
+        agent.select_action(obs, force_greedy=True) for obs in observations])
+    agreement = np.mean(torch_actions == numpy_actions)
+    if error > args.tolerance:
+        raise AssertionError(
+            f'{name}: NumPy forward is off by {error:.2e} > {args.tolerance}.')
+    if agreement < 1:
+        raise AssertionError(
+            f'{name}: greedy actions agree on {agreement*100:.1f}% of states.')
+    numpy_rate = steps_per_sec(agent, observations)
+    agent._acting_engine = None # Back to the torch path
+    torch_rate = steps_per_sec(agent, observations)
+    print(
+        f'{name}: max |error| {error:.2e}, greedy actions agree on '
+        f'{agreement*100:.1f}% of states; '
+        f'torch {torch_rate:.0f} steps/s, NumPy {numpy_rate:.0f} steps/s '
+        f'({numpy_rate/torch_rate:.2f}x)')
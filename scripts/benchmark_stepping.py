@@ -0,0 +1,50 @@
+import time
+import argparse
+import numpy as np
+import torch
+
+from acme import specs
+
+from auxrl.Agent import Agent
+from auxrl.networks.Network import Network
+from auxrl.environments.GridWorld import Env as Env
+
+# Parse optional arguments
+parser = argparse.ArgumentParser(
+    description='Steps/sec of environment stepping and replay writes, '
+    'through dm_env TimeSteps versus step_fast with int actions.')
+parser.add_argument('-n', '--n_steps', type=int, default=20_000)
+args = parser.parse_args()
+
+np.random.seed(0)
+torch.manual_seed(0)
+env = Env(8)
+env_spec = specs.make_environment_spec(env)
+network = Network(env_spec, latent_dim=10, network_yaml='dm')
+agent = Agent(
+    env_spec, network, loss_weights=[1e-2, 1e-1, 1e-1, 1],
+    replay_capacity=100_000)
+actions = np.random.randint(env_spec.actions.num_values, size=args.n_steps)
+
+def steps_per_sec(fast):
+    agent.observe_first(env.reset())
+    start = time.time()
+    for action in actions.tolist():
+        if fast:
+            obs, reward, discount, last = env.step_fast(action)
+            agent.observe_fast(action, obs, reward, discount, last, None)
+        else: # Tensor actions, as select_action used to return
+            action = torch.tensor([action])
+            timestep = env.step(action)
+            agent.observe(action, next_timestep=timestep, latent=None)
+            last = timestep.last()
+        if last:
+            agent.observe_first(env.reset())
+    return args.n_steps / (time.time() - start)
+
+steps_per_sec(False) # Warm up
+timestep_rate = steps_per_sec(False)
+fast_rate = steps_per_sec(True)
+print(
+    f'dm_env TimeSteps {timestep_rate:.0f} steps/s, step_fast '
+    f'{fast_rate:.0f} steps/s ({fast_rate/timestep_rate:.2f}x)')
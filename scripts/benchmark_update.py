@@ -0,0 +1,85 @@
+import time
+import argparse
+import numpy as np
+import torch
+
+from acme import specs
+
+from auxrl.environments.GridWorld import Env as Env
+
+# Parse optional arguments
+parser = argparse.ArgumentParser(
+    description='Updates/sec of eager versus compiled agent updates; raises '
+    'if their losses over the warmup updates differ.')
+parser.add_argument('-y', '--nn_yamls', type=str, nargs='+',
+    default=['dm', 'noconv'])
+parser.add_argument('-n', '--n_updates', type=int, default=500)
+parser.add_argument('-w', '--n_warmup', type=int, default=20)
+parser.add_argument('-b', '--batch_size', type=int, default=64)
+parser.add_argument('-l', '--latent_dim', type=int, default=10)
+parser.add_argument('-q', '--iqn', action='store_true')
+parser.add_argument('-t', '--tolerance', type=float, default=1e-4)
+args = parser.parse_args()
+
+if args.iqn:
+    from auxrl.IQNAgent import Agent
+    from auxrl.networks.IQNNetwork import Network
+else:
+    from auxrl.Agent import Agent
+    from auxrl.networks.Network import Network
+
+# IQN draws quantile fractions inside the losses; inductor's own RNG would
+# draw different ones from the eager run
+compile_args = {'options': {'fallback_random': True}} if args.iqn else {}
+
+def make_agent(nn_yaml, compile_update):
+    np.random.seed(0)
+    torch.manual_seed(0)
+    env = Env(8)
+    env_spec = specs.make_environment_spec(env)
+    network = Network(env_spec, latent_dim=args.latent_dim, network_yaml=nn_yaml)
+    agent = Agent(
+        env_spec, network, loss_weights=[1e-2, 1e-1, 1e-1, 1],
+        batch_size=args.batch_size, replay_capacity=10_000,
+        compile_update=compile_update, compile_args=compile_args)
+    timestep = env.reset()
+    agent.observe_first(timestep)
+    for _ in range(2_000): # Random experience to sample from
+        action = agent.select_action(timestep.observation)
+        timestep = env.step(action)
+        agent.observe(
+            action, next_timestep=timestep, latent=agent.get_curr_latent())
+        if timestep.last():
+            timestep = env.reset()
+            agent.observe_first(timestep)
+    return agent
+
+def updates_per_sec(agent):
+    """ Updates/sec, warmup seconds and the losses of the warmup updates. """
+
+    start = time.time()
+    warmup_losses = [agent.update() for _ in range(args.n_warmup)]
+    warmup_time = time.time() - start # Includes compilation
+    start = time.time()
+    for _ in range(args.n_updates):
+        agent.update()
+    return args.n_updates / (time.time() - start), warmup_time, \
+        np.array(warmup_losses)
+
+for nn_yaml in args.nn_yamls:
+    eager_rate, _, eager_losses = updates_per_sec(make_agent(nn_yaml, False))
+    agent = make_agent(nn_yaml, True)
+    compiled_rate, compile_time, compiled_losses = updates_per_sec(agent)
+    if not agent._compile_update:
+        print(f'{nn_yaml}: compilation failed, compiled run was eager')
+    # Same seeds and batches; fused kernels only change float rounding
+    error = np.abs(compiled_losses - eager_losses).max() \
+        / max(np.abs(eager_losses).max(), 1e-12)
+    if error > args.tolerance:
+        raise AssertionError(
+            f'{nn_yaml}: compiled losses are off by {error:.2e} (relative).')
+    print(
+        f'{nn_yaml}: eager {eager_rate:.1f} updates/s, '
+        f'compiled {compiled_rate:.1f} updates/s '
+        f'({compiled_rate/eager_rate:.2f}x, warmup {compile_time:.1f}s, '
+        f'loss error {error:.1e})')
@@ -0,0 +1,83 @@
+import argparse
+import numpy as np
+import torch
+
+from acme import specs
+
+from auxrl.environments.GridWorld import Env as Env
+
+# Parse optional arguments
+parser = argparse.ArgumentParser(
+    description='Checks of dedup_obs; raises if deduplicated encoding changes '
+    'the losses or gradients by more than float rounding.')
+parser.add_argument('-n', '--n_batches', type=int, default=5)
+parser.add_argument('-t', '--tolerance', type=float, default=1e-6)
+args = parser.parse_args()
+
+def make_agent(iqn, dedup_obs, **agent_args):
+    if iqn:
+        from auxrl.IQNAgent import Agent
+        from auxrl.networks.IQNNetwork import Network
+    else:
+        from auxrl.Agent import Agent
+        from auxrl.networks.Network import Network
+    np.random.seed(0)
+    torch.manual_seed(0)
+    env = Env(8)
+    env_spec = specs.make_environment_spec(env)
+    network = Network(env_spec, latent_dim=10, network_yaml='dm')
+    agent = Agent(
+        env_spec, network, loss_weights=[1e-2, 1e-1, 1e-1, 1],
+        batch_size=64, replay_capacity=1000, dedup_obs=dedup_obs,
+        **agent_args)
+    timestep = env.reset()
+    agent.observe_first(timestep)
+    for _ in range(500): # Random experience to sample from
+        action = agent.select_action(timestep.observation)
+        timestep = env.step(action)
+        agent.observe(
+            action, next_timestep=timestep, latent=agent.get_curr_latent())
+        if timestep.last():
+            timestep = env.reset()
+            agent.observe_first(timestep)
+    return agent
+
+def losses_and_grads(agent):
+    """ Losses and flat gradients of the first batches, without stepping. """
+
+    results = []
+    for _ in range(args.n_batches):
+        batch = agent._prepare_batch()
+        tensors = {k: v for k, v in batch.items() if torch.is_tensor(v)}
+        tensors['a'] = torch.as_tensor(batch['a']).long().view(-1)
+        agent._optimizer.zero_grad(set_to_none=False)
+        losses = agent._compute_losses(tensors)
+        losses[4].backward()
+        results.append((
+            torch.stack(losses[:5]).detach(),
+            agent._network._trainable_params.grad.clone()))
+    return results
+
+def check_dedup_matches_per_batch_encoding():
+    """
+    Losses and gradients with dedup_obs equal those of encoding each batch
+    separately, up to float rounding (relative tolerance).
+    """
+
+    configs = [(False, {}), (False, {'pred_TD': True}), (True, {})]
+    for iqn, agent_args in configs:
+        results = [
+            losses_and_grads(make_agent(iqn, dedup_obs, **agent_args))
+            for dedup_obs in [False, True]]
+        for (losses, grads), (dedup_losses, dedup_grads) in zip(*results):
+            for name, a, b in [
+                ('losses', losses, dedup_losses),
+                ('gradients', grads, dedup_grads)]:
+                error = ((a - b).abs().max() / a.abs().max()).item()
+                if error > args.tolerance:
+                    raise AssertionError(
+                        f'dedup_obs {name} are off by {error:.2e} (relative) '
+                        f'for iqn={iqn}, {agent_args}.')
+
+check_dedup_matches_per_batch_encoding()
+print('Dedup checks passed.')
@@ -0,0 +1,110 @@
+import argparse
+import numpy as np
+import torch
+
+from acme import specs
+
+from auxrl.Agent import Agent
+from auxrl.EnsembleAgent import EnsembleAgent
+from auxrl.environments.GridWorld import Env as Env
+from auxrl.networks.Network import Network
+from auxrl.utils import run_train_episode, EnsembleEpisodeRunner
+from auxrl.utils import UpdateScheduler
+
+# Parse optional arguments
+parser = argparse.ArgumentParser(
+    description='Checks of EnsembleAgent; raises if a seed trained in the '
+    'ensemble drifts from the same seed trained alone.')
+parser.add_argument('-s', '--n_seeds', type=int, default=3)
+parser.add_argument('-e', '--n_episodes', type=int, default=2)
+parser.add_argument('-t', '--tolerance', type=float, default=1e-3)
+args = parser.parse_args()
+
+def make_seed(i):
+    """ One seed's environment and agent, seeded as 01_run_gridworld does. """
+
+    np.random.seed(i)
+    torch.manual_seed(i)
+    env = Env(8)
+    env_spec = specs.make_environment_spec(env)
+    network = Network(env_spec, latent_dim=10, network_yaml='dm')
+    agent = Agent(
+        env_spec, network, loss_weights=[1e-2, 1e-1, 1e-1, 1],
+        batch_size=64, replay_capacity=1000, target_update_frequency=50,
+        rng=np.random.default_rng(i))
+    return env, agent, np.random.get_state()
+
+def make_scheduler():
+    return UpdateScheduler(train_every=2, updates_per_step=1.)
+
+def check_seeds_match_lone_runs(use_scheduler):
+    """
+    Per-seed returns and episode lengths equal those of lone runs, and
+    losses agree up to float rounding. Weights are not compared: batched
+    and single kernels round near-zero gradients differently, and Adam's
+    normalization turns that into steps of order lr.
+    """
+
+    lone_results = []
+    for i in range(args.n_seeds):
+        env, agent, _ = make_seed(i)
+        scheduler = make_scheduler() if use_scheduler else None
+        lone_results.append([
+            run_train_episode(env, agent, scheduler=scheduler)
+            for _ in range(args.n_episodes)])
+
+    seeds = [make_seed(i) for i in range(args.n_seeds)]
+    ensemble = EnsembleAgent([agent for _, agent, _ in seeds])
+    runner = EnsembleEpisodeRunner(
+        [env for env, _, _ in seeds], ensemble,
+        schedulers=[make_scheduler() for _ in seeds] if use_scheduler else None,
+        random_states=[state for _, _, state in seeds])
+    results = [[] for _ in seeds]
+    while min(len(r) for r in results) < args.n_episodes:
+        active = [
+            k for k in range(args.n_seeds)
+            if len(results[k]) < args.n_episodes]
+        for k, result in runner.step(active).items():
+            results[k].append(result[:3])
+
+    for i in range(args.n_seeds):
+        for lone, ensembled in zip(lone_results[i], results[i]):
+            if lone[1:] != ensembled[1:]:
+                raise AssertionError(
+                    f'Seed {i} episode differs: {lone[1:]} v. {ensembled[1:]}.')
+            lone_losses = np.array(lone[0])
+            error = np.abs(lone_losses - np.array(ensembled[0])).max() \
+                / max(np.abs(lone_losses).max(), 1e-12)
+            if error > args.tolerance:
+                raise AssertionError(
+                    f'Seed {i} losses are off by {error:.2e} (relative).')
+
+def check_adam_matches_torch():
+    """ One ensemble Adam step equals torch.optim.Adam on each row. """
+
+    seeds = [make_seed(i) for i in range(2)]
+    agents = [agent for _, agent, _ in seeds]
+    ensemble = EnsembleAgent(agents)
+    n = ensemble._n_trainable
+    params = [p.detach().clone().requires_grad_() for p in ensemble._params]
+    optimizers = [torch.optim.Adam([p], lr=ensemble._lr) for p in params]
+    ensemble._steps[1] = 4 # Rows at different step counts
+    for _ in range(4):
+        optimizers[1].zero_grad()
+        params[1].grad = torch.zeros_like(params[1])
+        optimizers[1].step()
+    for _ in range(3):
+        grads = torch.randn(2, n)
+        for p, o, g in zip(params, optimizers, grads):
+            p.grad = g.clone()
+            o.step()
+        ensemble._adam_step(
+            [0, 1], torch.arange(2), grads.clone())
+    for row, p in zip(ensemble._params, params):
+        if not torch.equal(row[:n], p[:n]):
+            raise AssertionError('Ensemble Adam differs from torch.optim.Adam.')
+
+check_adam_matches_torch()
+check_seeds_match_lone_runs(use_scheduler=False)
+check_seeds_match_lone_runs(use_scheduler=True)
+print('Ensemble checks passed.')
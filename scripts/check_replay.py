@@ -0,0 +1,198 @@
+import argparse
+import tempfile
+import dm_env
+import numpy as np
+import torch
+
+from acme import specs
+
+from auxrl.environments.GridWorld import Env as Env
+from auxrl.ReplayBuffer import make_replay_buffer, ReplayBuffer, SumTree
+
+# Parse optional arguments
+parser = argparse.ArgumentParser(
+    description='Checks of the replay buffers; raises on any mismatch.')
+parser.add_argument('-e', '--n_episodes', type=int, default=3)
+args = parser.parse_args()
+
+class WindowCopyingReplayBuffer(ReplayBuffer):
+    """
+    The deque buffer, storing copies of the latent windows. On CPU the deque
+    buffer's latent.cpu().numpy() aliases the encoder's window, which the
+    encoder then rescales in place when eligibility_gamma < 1, whereas array
+    buffers store each window as it was observed.
+    """
+
+    def add_fast(self, action, obs, reward, discount, last, latent):
+        if latent is not None:
+            latent = latent.clone()
+        super().add_fast(action, obs, reward, discount, last, latent)
+
+def train_losses(iqn, replay_type, network_args={}, **agent_args):
+    if iqn:
+        from auxrl.IQNAgent import Agent
+        from auxrl.networks.IQNNetwork import Network
+    else:
+        from auxrl.Agent import Agent
+        from auxrl.networks.Network import Network
+    from auxrl.utils import run_train_episode
+    np.random.seed(0)
+    torch.manual_seed(0)
+    env = Env(8)
+    env_spec = specs.make_environment_spec(env)
+    network = Network(
+        env_spec, latent_dim=10, network_yaml='dm', **network_args)
+    agent_args = dict({'replay_capacity': 300}, **agent_args)
+    agent = Agent(
+        env_spec, network, loss_weights=[1e-2, 1e-1, 1e-1, 1],
+        batch_size=64,
+        replay_type='deque' if replay_type == 'deque_copy' else replay_type,
+        **agent_args)
+    if replay_type == 'deque_copy':
+        agent._replay_buffer = WindowCopyingReplayBuffer(
+            agent_args['replay_capacity'])
+    return np.array([
+        run_train_episode(env, agent)[0] for _ in range(args.n_episodes)])
+
+def check_array_matches_deque():
+    """
+    The default array buffer trains exactly as the original deque, or with
+    eligibility_gamma < 1, as the deque storing the windows it observed.
+    """
+
+    configs = [
+        (False, 'deque', {}, {}),
+        (False, 'deque', {}, {'pred_TD': True, 'pred_gamma': 0.5}),
+        (False, 'deque', {'mem_len': 2}, {'train_seq_len': 2}),
+        (False, 'deque_copy', {'mem_len': 2, 'eligibility_gamma': 0.7},
+            {'train_seq_len': 4, 'replay_capacity': 100}),
+        (True, 'deque', {}, {})]
+    for iqn, deque_type, network_args, agent_args in configs:
+        deque_losses = train_losses(
+            iqn, deque_type, network_args, **agent_args)
+        array_losses = train_losses(iqn, 'array', network_args, **agent_args)
+        if not np.array_equal(deque_losses, array_losses):
+            raise AssertionError(
+                f'Array and deque losses differ for {network_args}, '
+                f'{agent_args}: {np.abs(deque_losses - array_losses).max()}')
+
+def check_latent_windows_after_eviction():
+    """
+    Array buffers (and their snapshots) return the acting latent windows
+    for every slot, also for the oldest ones whose history was evicted.
+    """
+
+    from auxrl.Agent import Agent
+    from auxrl.networks.Network import Network
+    for replay_type in ['array', 'memmap', 'torch']:
+        np.random.seed(0)
+        torch.manual_seed(0)
+        env = Env(8)
+        env_spec = specs.make_environment_spec(env)
+        network = Network(
+            env_spec, latent_dim=10, network_yaml='dm', mem_len=3,
+            eligibility_gamma=0.7)
+        agent = Agent(
+            env_spec, network, loss_weights=[1e-2, 1e-1, 1e-1, 1],
+            replay_type=replay_type, replay_capacity=10, train_seq_len=3)
+        windows = []
+        for _ in range(3):
+            timestep = env.reset()
+            agent.reset()
+            agent.observe_first(timestep)
+            for step in range(15):
+                if (replay_type == 'array') and (step == 7): # Across a flush
+                    agent._replay_buffer.flush()
+                action = agent.select_action(timestep.observation)
+                timestep = env.step(action)
+                latent = agent.get_curr_latent()
+                windows.append(latent.cpu().numpy().copy())
+                agent.observe(action, timestep, latent)
+                if timestep.last():
+                    break
+        buffer = agent._replay_buffer
+        with tempfile.TemporaryDirectory() as path:
+            buffer.save(path)
+            restored = make_replay_buffer(replay_type, 6, **(
+                {'n_actions': 4} if replay_type == 'torch' else {}))
+            restored.set_latent_gamma(0.7)
+            restored.load(path)
+            restored = restored.flush().latent
+        n_stored = len(buffer)
+        stored = buffer.flush().latent
+        for latents, n in [(stored, n_stored), (restored, 6)]:
+            if isinstance(latents, torch.Tensor):
+                latents = latents.cpu().numpy()
+            expected = np.concatenate(windows[-n:])
+            if not np.array_equal(latents.reshape(expected.shape), expected):
+                raise AssertionError(
+                    f'{replay_type} latent windows differ from the acting '
+                    f'ones: {np.abs(latents.reshape(expected.shape) - expected).max()}')
+
+def check_bitpack_snapshot():
+    """ A restored bit-packed buffer decodes without a new observation. """
+
+    np.random.seed(0)
+    buffer = make_replay_buffer('array', None, obs_codec='bitpack')
+    observations = np.random.randint(2, size=(6, 1, 5, 7)).astype(np.float32)
+    buffer.add_first(dm_env.restart(observations[0]))
+    for obs in observations[1:]:
+        buffer.add(0, dm_env.transition(0., obs), None)
+    with tempfile.TemporaryDirectory() as path:
+        buffer.save(path)
+        restored = make_replay_buffer('array', None, obs_codec='bitpack')
+        restored.load(path)
+        restored.sample(4)
+        obs = restored.flush().obs
+    if not np.array_equal(obs, observations[:-1]):
+        raise AssertionError('Restored bit-packed observations differ.')
+
+def check_counted_flush_after_growth():
+    """ An unbounded counted buffer keeps FIFO order across its growth. """
+
+    buffer = make_replay_buffer('counted', None, initial_size=4)
+    obs = np.zeros((1, 4, 4), dtype=np.float32)
+    buffer.add_first(dm_env.restart(obs))
+    for reward in range(1, 7):
+        buffer.add(0, dm_env.transition(reward, obs), None)
+    rewards = buffer.flush().reward.tolist()
+    if rewards != list(range(1, 7)):
+        raise AssertionError(f'Counted flush after growth gave {rewards}.')
+
+def check_prioritized_sampling():
+    """
+    Sum-tree lookups stay on leaves with priority, even for values at the
+    total, and prioritized samples follow the priorities.
+    """
+
+    tree = SumTree(8)
+    tree.update(np.arange(3), [0.1, 0.2, 0.7])
+    leaves = tree.find([0., 0.1, tree.total, 2*tree.total])
+    if leaves.tolist() != [0, 1, 2, 2]:
+        raise AssertionError(f'Sum-tree lookups gave leaves {leaves}.')
+
+    np.random.seed(0)
+    buffer = make_replay_buffer('prioritized', None, initial_size=8)
+    obs = np.zeros((1, 4, 4), dtype=np.float32)
+    buffer.add_first(dm_env.restart(obs))
+    for _ in range(5):
+        buffer.add(0, dm_env.transition(0., obs), None)
+    errors = np.array([1., 2., 3., 4., 10.])
+    buffer.update_priorities(np.arange(5), errors)
+    slots = np.concatenate([
+        buffer.sample(50, return_indices=True)[1] for _ in range(400)])
+    if slots.max() >= 5:
+        raise AssertionError('Prioritized replay sampled an empty slot.')
+    priorities = (errors + buffer._epsilon)**buffer._alpha
+    expected = priorities / priorities.sum()
+    frequencies = np.bincount(slots, minlength=5) / slots.size
+    if np.abs(frequencies - expected).max() > 0.01:
+        raise AssertionError(
+            f'Prioritized frequencies {frequencies}, expected {expected}.')
+
+check_array_matches_deque()
+check_latent_windows_after_eviction()
+check_bitpack_snapshot()
+check_counted_flush_after_growth()
+check_prioritized_sampling()
+print('Replay checks passed.')
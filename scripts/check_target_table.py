@@ -0,0 +1,94 @@
+import argparse
+import numpy as np
+import torch
+
+from acme import specs
+
+from auxrl.environments.GridWorld import Env as Env
+
+# Parse optional arguments
+parser = argparse.ArgumentParser(
+    description='Checks of target_table; raises if table targets differ '
+    'from the targets evaluated on the fly.')
+parser.add_argument('-e', '--n_episodes', type=int, default=3)
+parser.add_argument('-t', '--tolerance', type=float, default=1e-5)
+args = parser.parse_args()
+
+def make_agent(iqn=False, **agent_args):
+    if iqn:
+        from auxrl.IQNAgent import Agent
+        from auxrl.networks.IQNNetwork import Network
+    else:
+        from auxrl.Agent import Agent
+        from auxrl.networks.Network import Network
+    np.random.seed(0)
+    torch.manual_seed(0)
+    env = Env(8)
+    env_spec = specs.make_environment_spec(env)
+    network = Network(env_spec, latent_dim=10, network_yaml='dm')
+    agent = Agent(
+        env_spec, network, loss_weights=[1e-2, 1e-1, 1e-1, 1],
+        batch_size=64, replay_capacity=1000, target_update_frequency=50,
+        replay_args={'intern_obs': True}, **agent_args)
+    return env, agent
+
+def check_table_matches_on_the_fly():
+    """
+    Table targets equal the target network on the sampled next observations,
+    and training with the table follows training without it.
+    """
+
+    from auxrl.utils import run_train_episode
+    all_losses = []
+    for target_table in [False, True]:
+        env, agent = make_agent(target_table=target_table)
+        all_losses.append(np.array([
+            run_train_episode(env, agent)[0]
+            for _ in range(args.n_episodes)]))
+        if not target_table:
+            continue
+        batch = agent._prepare_batch()
+        with torch.no_grad():
+            table_q = agent._lookup_target_q(batch['next_obs_ids'])
+            q = agent._target_network.Q(
+                agent._target_network.encoder(batch['next_obs']))
+        error = (table_q - q).abs().max().item()
+        if error > args.tolerance:
+            raise AssertionError(f'Table targets are off by {error:.2e}.')
+    error = np.abs(all_losses[0] - all_losses[1]).max()
+    if error > args.tolerance:
+        raise AssertionError(
+            f'Losses with the target table are off by {error:.2e}.')
+
+def check_table_size_cap():
+    """
+    Past target_table_rows distinct observations (e.g. noisy ones), the
+    table is dropped and targets are evaluated on the fly.
+    """
+
+    from auxrl.utils import run_train_episode
+    all_losses = []
+    for target_table in [False, True]:
+        env, agent = make_agent(
+            target_table=target_table, target_table_rows=5)
+        all_losses.append(np.array([
+            run_train_episode(env, agent)[0]
+            for _ in range(args.n_episodes)]))
+    if agent._use_target_table or (agent._target_table is not None):
+        raise AssertionError('Target table outgrew target_table_rows.')
+    if not np.array_equal(all_losses[0], all_losses[1]):
+        raise AssertionError('Capped table did not fall back to on the fly.')
+
+def check_iqn_refuses_table():
+    """ IQN targets use fresh quantile fractions, so there is no table. """
+
+    try:
+        make_agent(iqn=True, target_table=True)
+    except ValueError:
+        return
+    raise AssertionError('IQNAgent accepted target_table.')
+
+check_table_matches_on_the_fly()
+check_table_size_cap()
+check_iqn_refuses_table()
+print('Target table checks passed.')
@@ -0,0 +1,77 @@
+import time
+import argparse
+import functools
+import numpy as np
+import torch
+
+from acme import specs
+
+from auxrl.ActorLearner import SharedWeights, run_actor_learner
+from auxrl.environments.GridWorld import Env as Env
+
+# Parse optional arguments
+parser = argparse.ArgumentParser(
+    description='Short actor/learner run on GridWorld; raises if the '
+    'weight publishing or shared replay paths misbehave.')
+parser.add_argument('-a', '--n_actors', type=int, default=2)
+parser.add_argument('-u', '--n_updates', type=int, default=300)
+parser.add_argument('-p', '--publish_every', type=int, default=10)
+parser.add_argument('-e', '--epsilon', type=float, default=0.5)
+parser.add_argument('-q', '--iqn', action='store_true')
+parser.add_argument('-N', '--numpy_acting', action='store_true')
+args = parser.parse_args()
+
+if args.iqn:
+    from auxrl.networks.IQNNetwork import Network
+else:
+    from auxrl.networks.Network import Network
+
+def check_weight_seqlock():
+    """ Pulls see each publish exactly once, as the published values. """
+
+    env = Env(8)
+    env_spec = specs.make_environment_spec(env)
+    learner = Network(env_spec, latent_dim=10, network_yaml='dm')
+    actor = Network(env_spec, latent_dim=10, network_yaml='dm')
+    weights = SharedWeights(learner)
+    if weights.pull(actor):
+        raise AssertionError('Pulled weights before any publish.')
+    for _ in range(2):
+        with torch.no_grad():
+            learner.get_flat_params().add_(1.)
+        weights.publish(learner)
+        if not weights.pull(actor):
+            raise AssertionError('Published weights were not pulled.')
+        if not torch.equal(learner.get_flat_params(), actor.get_flat_params()):
+            raise AssertionError('Pulled weights differ from the published.')
+        if weights.pull(actor):
+            raise AssertionError('Pulled the same weights twice.')
+
+if __name__ == '__main__':
+    check_weight_seqlock()
+    agent_args = {
+        'loss_weights': [1e-2, 1e-1, 1e-1, 1], 'batch_size': 32,
+        'epsilon': args.epsilon}
+    if args.numpy_acting: # Agent only
+        agent_args['numpy_acting'] = True
+    make_env = functools.partial(Env, 8)
+    make_network = functools.partial(
+        Network, latent_dim=10, network_yaml='dm')
+    start = time.time()
+    losses, episodes, agent = run_actor_learner(
+        make_env, make_network, n_actors=args.n_actors,
+        n_updates=args.n_updates, agent_args=agent_args, iqn=args.iqn,
+        replay_capacity=10_000, publish_every=args.publish_every)
+    duration = time.time() - start
+
+    if len(losses) != args.n_updates:
+        raise AssertionError(f'Ran {len(losses)} of {args.n_updates} updates.')
+    if not np.all(np.isfinite(np.array(losses, dtype=np.float64))):
+        raise AssertionError('Non-finite losses.')
+    written = agent._replay_buffer._counts
+    if np.any(written == 0):
+        raise AssertionError(f'Actors wrote {written.tolist()} transitions.')
+    print(
+        f'{args.n_updates} updates in {duration:.1f} s; actors wrote '
+        f'{written.tolist()} transitions and finished {len(episodes)} '
+        f'episodes.')